@@ -1,19 +1,73 @@
 # chatbot/agents.py
-import google.generativeai as genai
 from django.conf import settings
+from celery.exceptions import SoftTimeLimitExceeded
+import copy
 import json
 import logging # Para registrar erros
-from django.apps import apps # Para obter o modelo de utilizador
+
+from .gemini_limiter import GeminiCapacityExceeded
+from .llm_providers import generate_with_hedging, LOCAL_PROVIDER_NAME
+from .prompts import PROMPT_VERSION, build_agent_prompt
 
 logger = logging.getLogger(__name__)
 
-def run_valuation_agent(inputs_data: dict, user_razao_social: str) -> dict:
+# Campos de resumo_para_gamma que a IA pode redigir; os demais são factuais
+# e vêm sempre do motor determinístico.
+NARRATIVE_KEYS = ("principais_drivers", "pontos_fortes", "pontos_atencao")
+
+
+def apply_agent_field(result: dict, key: str, value):
+    """
+    Aplica um campo de primeiro nível da resposta da IA sobre 'result' (in place).
+    Só a narrativa e o prompt_gamma são aceites: a IA nunca sobrescreve valores.
+    """
+    if key == "resumo_para_gamma" and isinstance(value, dict):
+        for narrative_key in NARRATIVE_KEYS:
+            if value.get(narrative_key):
+                result["resumo_para_gamma"][narrative_key] = value[narrative_key]
+    elif key == "prompt_gamma":
+        result["prompt_gamma"] = value
+
+
+def merge_agent_narrative(base_result: dict, agent_json: dict) -> dict:
+    """Combina os números do motor com a narrativa da IA (a IA nunca sobrescreve valores)."""
+    result = copy.deepcopy(base_result)
+    result["prompt_gamma"] = None
+    for key, value in agent_json.items():
+        apply_agent_field(result, key, value)
+    return result
+
+
+def run_valuation_agent(inputs_data: dict, user_razao_social: str, base_result: dict, on_field=None, on_usage=None,
+                        budget_seconds=None, on_timeout=None) -> dict:
     """
-    Chama a API Gemini para analisar os inputs, calcular o valuation
-    e gerar um prompt para o Gamma.
+    Chama a API Gemini para escrever a análise qualitativa e o prompt do Gamma.
+
+    Os números (lucro, múltiplo, valuation e valores formatados) já chegam
+    calculados em 'base_result' (ver valuation_engine.calcular_valuation);
+    o Gemini só redige a narrativa. O retorno é o base_result completado com
+    a narrativa da IA, ou um dicionário com a chave "error".
+
+    As instruções fixas vão como system_instruction (no context cache do
+    Gemini quando possível, ver context_cache.py); o pedido leva só os dados
+    da empresa. A resposta vem em modo JSON validado por prompts.RESPONSE_SCHEMA.
+
+    Com settings.GEMINI_STREAMING a resposta é lida em streaming e
+    on_field(chave, valor) é chamado assim que cada chave de primeiro nível
+    do JSON fica completa, antes do fim da geração. on_usage(dict) recebe
+    a contagem de tokens da resposta (usage_metadata).
+
+    Quem responde é escolhido em llm_providers.generate_with_hedging: o
+    modelo principal, o modelo rápido de reserva (hedge ou erro) ou, passado
+    o SLO, a narrativa padrão do motor (o retorno leva narrativa_padrao=True).
+    on_usage também recebe agent_provider e agent_hedged. budget_seconds
+    limita o SLO ao que resta do prazo do relatório; se acabar sem resposta
+    de nenhum modelo, on_timeout() é chamado.
+
+    Cada chamada passa pelo limitador global (gemini_limiter); se nenhuma
+    tiver capacidade, levanta GeminiCapacityExceeded para a tarefa se adiar.
     """
-    api_key = settings.GEMINI_API_KEY
-    if not api_key:
+    if not settings.GEMINI_API_KEY:
         logger.error("GEMINI_API_KEY não configurada.")
         return {
             "error": "Configuração da API de IA ausente.",
@@ -23,111 +77,55 @@ def run_valuation_agent(inputs_data: dict, user_razao_social: str) -> dict:
             "prompt_gamma": None
         }
 
-    genai.configure(api_key=api_key)
-    # Certifique-se que está a usar um modelo disponível, como 'gemini-pro'
-    # model = genai.GenerativeModel('gemini-1.5-flash') # Este deu erro 404 antes
-    model = genai.GenerativeModel('gemini-2.5-flash')
-
-    # -- Construção do Prompt para Gemini --
-
-    # Prepara os inputs para o prompt de forma legível
-    inputs_str = "\n".join([f"- {key.replace('_', ' ').capitalize()}: {value}" for key, value in inputs_data.items()])
-
-    # --- PROMPT ATUALIZADO COM NOVAS FAIXAS DE MÚLTIPLOS ---
-    prompt = f"""
-    Você é um assistente de análise financeira especializado em valuation simplificado para pequenas e médias empresas (PMEs).
-    Analise os seguintes dados fornecidos para a empresa "{user_razao_social}":
-
-    {inputs_str}
-
-    Sua tarefa é realizar as seguintes ações e retornar a resposta **estritamente** no formato JSON especificado abaixo:
-
-    1.  **Calcular Lucratividade Estimada:** Baseado no faturamento anual, custos operacionais mensais e alíquota de imposto sobre lucro, estime o Lucro Líquido Anual. Considere o custo operacional mensal * 12. O cálculo é: Lucro Líquido = (Faturamento Anual - (Custos Operacionais Mensais * 12)) * (1 - (Alíquota Imposto Lucro % / 100)).
-    2.  **Estimar Valuation:** Use um método de Múltiplo de Faturamento Anual. Escolha um múltiplo *razoável* baseado no setor de atuação, considerando estas faixas típicas para PMEs (pequenas/médias empresas):
-        - Varejo Tradicional: 0.25x - 0.75x
-        - Serviços Gerais/Profissionais: 0.75x - 2.0x
-        - Tecnologia (SaaS/Software): 2.0x - 6.0x (pode ser maior se a Projeção de Crescimento Anual for superior a 30-40%)
-        - Serviços de TI (Consultoria/Agência): 1.0x - 2.5x
-        - Indústria: 0.4x - 1.0x
-        - Outros/Não especificado: 0.5x - 1.5x (use esta faixa se o setor for muito genérico ou não se encaixar)
-
-        Use o setor informado ('{inputs_data.get('setor_atuacao', 'N/A')}') para escolher uma faixa apropriada. Considere também a projeção de crescimento ('{inputs_data.get('projecao_crescimento_anual_perc', 0)}%') e o tempo de operação ('{inputs_data.get('tempo_operacao_anos', 0)} anos') para refinar o múltiplo *dentro* da faixa escolhida (crescimento maior e mais tempo de operação geralmente justificam um múltiplo na parte superior da faixa). Justifique brevemente a escolha do múltiplo (ex: "Múltiplo X.Yx escolhido devido ao setor de Serviços e crescimento projetado moderado."). Calcule o Valuation = Faturamento Anual * Múltiplo Escolhido. Arredonde o valuation final para duas casas decimais.
-    3.  **Gerar Resumo Estruturado:** Crie um resumo conciso com os pontos-chave, formatando os valores monetários.
-    4.  **Gerar Prompt para Gamma:** Baseado no resumo, crie um prompt de texto otimizado para a API do Gamma (gamma.app) gerar uma apresentação de 5-7 slides sobre a empresa e seu valuation.
-
-    **Formato de Resposta JSON OBRIGATÓRIO (Use R$ e formato X.XXX,XX para valores):**
-    {{
-        "valuation_calculado": <valor_numerico_float_do_valuation_arredondado>,
-        "metodologia_usada": "Múltiplo de Faturamento (Setor: [Nome do Setor], Múltiplo: [Valor X.Yx]) - [Breve Justificativa da Escolha]",
-        "resumo_para_gamma": {{
-            "empresa_nome": "{user_razao_social}",
-            "setor": "[Setor de Atuação]",
-            "tempo_operacao": "[Tempo de Operação] anos",
-            "diferencial": "[Diferencial Competitivo]",
-            "snapshot_financeiro": "Faturamento Anual: R$ [Valor Formatado], Lucratividade Líquida Anual Estimada: R$ [Valor Formatado]",
-            "valuation_estimado": "R$ [Valor Formatado]",
-            "metodologia_resumo": "Baseado em Múltiplo de Faturamento de [Valor X.Yx] para o setor.",
-            "principais_drivers": "Faturamento atual de R$ [Valor Formatado] e potencial de crescimento de [{inputs_data.get('projecao_crescimento_anual_perc', 0)}%] no setor [Setor de Atuação].",
-            "pontos_fortes": "Principalmente [Diferencial Competitivo] e {inputs_data.get('tempo_operacao_anos', 0)} anos no mercado.",
-            "pontos_atencao": "Dependência do crescimento projetado ({inputs_data.get('projecao_crescimento_anual_perc', 0)}%), concorrência no setor e necessidade de gestão de custos."
-        }},
-        "prompt_gamma": "Crie uma apresentação concisa sobre a empresa {user_razao_social}. Use um tom profissional e visual atraente. Slide 1: Título 'Valuation Estimado - {user_razao_social}'. Slide 2: Sobre a Empresa (Setor: [Setor], Tempo de Operação: [Tempo], Principal Diferencial: [Diferencial]). Slide 3: Snapshot Financeiro (Faturamento Anual: R$ [Valor], Lucro Anual Estimado: R$ [Valor]). Slide 4: Valuation Estimado (Valor: R$ [Valor], Metodologia: Múltiplo de Faturamento [X.Yx]). Slide 5: Análise Resumida (Principais Drivers, Pontos Fortes e Pontos de Atenção). Slide 6: Próximos Passos (Sugira foco em crescimento sustentável e otimização de custos)."
-    }}
-
-    **Instruções Adicionais:**
-    - Seja realista na escolha do múltiplo dentro das faixas fornecidas.
-    - **Formate TODOS os valores monetários** no JSON final (snapshot_financeiro, valuation_estimado, prompt_gamma) como "R$ X.XXX.XXX,XX" (separador de milhar com ponto, decimal com vírgula). Use formatação brasileira.
-    - Se algum dado crucial faltar ou for inválido para o cálculo (ex: faturamento não numérico), retorne um JSON com uma chave "error" descrevendo o problema e as outras chaves como null ou vazias.
-    - **NÃO inclua nenhuma explicação, comentário ou ```json``` fora do formato JSON.** Sua resposta deve ser *apenas* o JSON solicitado.
-    """
+    # Só a parte variável: os números JÁ vêm calculados pelo motor determinístico
+    prompt = build_agent_prompt(inputs_data, user_razao_social, base_result)
 
+    response_text = ""
     try:
-        # Configurações de Geração (ajuste conforme necessário)
-        generation_config = genai.types.GenerationConfig(
-            # temperature=0.7 # Um pouco de criatividade, mas não muita para finanças
-            # max_output_tokens=2048
-        )
-        # Configurações de Segurança (podem precisar ser ajustadas se o Gemini bloquear respostas)
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        ]
-
-        logger.debug(f"Enviando prompt para Gemini para {user_razao_social}:\n{prompt}")
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config,
-            safety_settings=safety_settings
+        logger.debug(f"Enviando prompt para Gemini para {user_razao_social} (prompt v{PROMPT_VERSION}):\n{prompt}")
+        answer = generate_with_hedging(prompt, user_razao_social, base_result, on_field, budget_seconds)
+        response_text, usage, provider_name = answer.text, answer.usage, answer.provider
+        if on_usage:
+            on_usage(dict(usage, agent_provider=provider_name, agent_hedged=answer.hedged))
+        if answer.timed_out and on_timeout:
+            on_timeout()
+
+        logger.debug(
+            f"Resposta de {provider_name} ({usage.get('cached_tokens') or 0} token(s) do prompt em cache): {response_text}"
         )
 
-        # Tenta limpar e parsear a resposta JSON
-        cleaned_response = response.text.strip().lstrip('```json').rstrip('```').strip()
-
-        logger.debug(f"Resposta bruta da IA: {response.text}")
-        logger.debug(f"Resposta limpa da IA: {cleaned_response}")
+        # Modo JSON: a resposta já é o objeto, sem limpeza de texto
+        result_json = json.loads(response_text)
 
-        result_json = json.loads(cleaned_response)
-
-        # Validação básica do JSON retornado
-        required_keys = ["valuation_calculado", "metodologia_usada", "resumo_para_gamma", "prompt_gamma"]
+        # Validação básica do JSON retornado (o esquema já exige estas chaves)
+        required_keys = ["resumo_para_gamma", "prompt_gamma"]
         if not all(key in result_json for key in required_keys):
-            logger.error(f"Resposta da IA para {user_razao_social} não contém todas as chaves esperadas. Resposta: {cleaned_response}")
+            logger.error(f"Resposta da IA para {user_razao_social} não contém todas as chaves esperadas. Resposta: {response_text}")
             raise ValueError("Resposta da IA não contém todas as chaves esperadas.")
 
-        # Verifica se a IA retornou um erro interno
-        if result_json.get("error"):
-             logger.error(f"IA retornou erro interno para {user_razao_social}: {result_json.get('error')}")
-             # Retorna o dicionário de erro da IA diretamente
-             return result_json
-
-
-        logger.info(f"Análise Gemini concluída com sucesso para {user_razao_social}")
-        return result_json
-
+        if provider_name == LOCAL_PROVIDER_NAME:
+            return dict(merge_agent_narrative(base_result, result_json), narrativa_padrao=True)
+        logger.info(f"Análise Gemini ({provider_name}) concluída com sucesso para {user_razao_social}")
+        return merge_agent_narrative(base_result, result_json)
+
+    except GeminiCapacityExceeded:
+        # Sem capacidade agora: quem chamou decide adiar (não é um erro da IA)
+        raise
+    except SoftTimeLimitExceeded:
+        # soft_time_limit da tarefa: a narrativa padrão do motor entra no lugar
+        logger.error(f"Tempo da tarefa esgotado durante a chamada ao agente para {user_razao_social}.")
+        if on_timeout:
+            on_timeout()
+        return {
+            "error": "Tempo esgotado ao aguardar a resposta da IA.",
+            "valuation_calculado": None,
+            "metodologia_usada": "Erro",
+            "resumo_para_gamma": {},
+            "prompt_gamma": None
+        }
     except json.JSONDecodeError as e:
-        logger.error(f"Erro ao decodificar JSON da resposta da IA para {user_razao_social}: {e}\nResposta recebida: {cleaned_response}")
+        # Só acontece com resposta truncada (ex: limite de tokens de saída)
+        logger.error(f"Erro ao decodificar JSON da resposta da IA para {user_razao_social}: {e}\nResposta recebida: {response_text}")
         return {
             "error": "Não foi possível processar a resposta da IA (formato inválido). Tente novamente.",
             "valuation_calculado": None,
@@ -151,6 +149,3 @@ def run_valuation_agent(inputs_data: dict, user_razao_social: str) -> dict:
             "resumo_para_gamma": {},
             "prompt_gamma": None
         }
-
-# --- É necessário importar 'apps' para obter o modelo de utilizador ---
-from django.apps import apps
\ No newline at end of file
@@ -0,0 +1,217 @@
+# chatbot/batch.py
+"""
+Importação em lote de valuations (carteiras de clientes de contadores).
+
+O ficheiro (JSONL ou CSV) é lido linha a linha a partir do upload em
+streaming e validado com as mesmas regras do chatbot
+(validate_inputs_backend). Cada bloco de BATCH_CHUNK_SIZE relatórios é
+gravado com bulk_create numa transação curta e despachado como um group do
+Celery logo após o commit desse bloco: os workers começam antes do fim do
+ficheiro, e a memória (relatórios e ids em mãos) depende do tamanho do
+bloco, não do tamanho do ficheiro.
+"""
+import csv
+import io
+import json
+import logging
+from celery import group
+from django.db import transaction
+from django.db.models import Count
+from reports.models import ValuationBatch, ValuationReport
+from .deadlines import report_deadline
+from .quota import release_quota
+from .tasks import process_valuation_request
+from .validation import validate_inputs_backend
+
+logger = logging.getLogger(__name__)
+
+BATCH_CHUNK_SIZE = 500 # Relatórios por bulk_create
+MAX_BATCH_ERRORS = 100 # Erros guardados no lote (os demais só são contados)
+SUPPORTED_FORMATS = ('jsonl', 'csv')
+
+# Campos numéricos: aceita vírgula decimal ("15,5"), como o chatbot.js
+NUMERIC_FIELDS = (
+    'faturamento_anual',
+    'custos_operacionais_mensais',
+    'aliquota_imposto_lucro_perc',
+    'projecao_crescimento_anual_perc',
+    'tempo_operacao_anos',
+)
+
+
+class BatchFormatError(ValueError):
+    """Ficheiro num formato não suportado."""
+
+
+def detect_format(filename: str, explicit_format: str = None) -> str:
+    """Formato a partir do parâmetro explícito ou da extensão do ficheiro."""
+    fmt = (explicit_format or filename.rsplit('.', 1)[-1]).lower()
+    if fmt == 'json':
+        fmt = 'jsonl'
+    if fmt not in SUPPORTED_FORMATS:
+        raise BatchFormatError(f"Formato '{fmt}' não suportado. Use JSONL ou CSV.")
+    return fmt
+
+
+def _normalize_row(row: dict) -> dict:
+    row = {str(key).strip(): value for key, value in row.items() if key}
+    for field in NUMERIC_FIELDS:
+        value = row.get(field)
+        if isinstance(value, str) and ',' in value and '.' not in value:
+            row[field] = value.replace(',', '.')
+    return row
+
+
+def iter_input_rows(binary_stream, fmt: str):
+    """
+    Gera (número da linha, dict de inputs ou None, erro ou None) a partir de
+    um ficheiro binário, sem carregá-lo todo em memória.
+    """
+    text_stream = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        for line_number, row in enumerate(csv.DictReader(text_stream), start=2): # linha 1 = cabeçalho
+            yield line_number, _normalize_row(row), None
+    else:
+        for line_number, line in enumerate(text_stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                yield line_number, None, "JSON inválido."
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, "Cada linha deve ser um objeto JSON."
+                continue
+            inputs = row.get('inputs', row)
+            if not isinstance(inputs, dict):
+                yield line_number, None, "O campo 'inputs' deve ser um objeto JSON."
+                continue
+            yield line_number, _normalize_row(inputs), None
+
+
+def _dispatch_chunk(user_id, report_ids):
+    """
+    Enfileira um bloco de relatórios (chamado após o commit do bloco). Se o
+    broker falhar, os relatórios do bloco ficam FAILED e a reserva de quota
+    deles é devolvida, em vez de ficarem PENDING para sempre.
+    """
+    try:
+        group(process_valuation_request.s(report_id) for report_id in report_ids).apply_async()
+    except Exception as e:
+        logger.exception(f"Falha ao enfileirar {len(report_ids)} relatório(s) do lote do user {user_id}: {e}")
+        reports = ValuationReport.objects.filter(id__in=report_ids, status=ValuationReport.StatusChoices.PENDING)
+        # Devolve a reserva uma única vez (UPDATE condicional, como em tasks.py)
+        release_quota(user_id, reports.filter(quota_reserved=True).update(quota_reserved=False))
+        reports.update(
+            status=ValuationReport.StatusChoices.FAILED,
+            result_data={"error": "Não foi possível enfileirar o relatório. Tente novamente."},
+            valuation_calculado=None,
+            has_error=True,
+        )
+
+
+def create_batch(user, binary_stream, fmt: str, source_name: str = '', max_reports: int = None,
+                 quota_reserved: bool = False) -> ValuationBatch:
+    """
+    Valida as linhas do ficheiro e grava-as como relatórios PENDING de um
+    novo ValuationBatch, em blocos: cada bloco é despachado para o Celery
+    após o seu commit (ver _dispatch_chunk).
+
+    max_reports limita quantos relatórios podem ser criados (quota restante
+    do utilizador); as linhas excedentes são recusadas. None = sem limite.
+    quota_reserved marca os relatórios como cobertos por uma reserva de quota
+    (chatbot/quota.py), devolvida pela tarefa se o relatório falhar.
+
+    Um erro de leitura (UnicodeDecodeError, csv.Error) antes do primeiro
+    bloco apaga o lote e é propagado; depois disso os blocos já despachados
+    ficam e o erro é registado no lote.
+    """
+    pending = []
+    errors = []
+    total = accepted = rejected = 0
+
+    def reject(line_number, message):
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < MAX_BATCH_ERRORS:
+            errors.append({'linha': line_number, 'erro': message})
+
+    def save_counts():
+        batch.total_rows = total
+        batch.accepted_count = accepted
+        batch.rejected_count = rejected
+        batch.errors = errors
+        batch.save(update_fields=['total_rows', 'accepted_count', 'rejected_count', 'errors'])
+
+    def flush():
+        # Transação curta por bloco; o prazo conta a partir da gravação do bloco
+        deadline_at = report_deadline()
+        for report in pending:
+            report.deadline_at = deadline_at
+        with transaction.atomic():
+            created = ValuationReport.objects.bulk_create(pending)
+            save_counts()
+            report_ids = [report.id for report in created]
+            # Só despacha depois do commit, para os workers encontrarem os relatórios
+            transaction.on_commit(lambda: _dispatch_chunk(user.pk, report_ids))
+        pending.clear()
+
+    batch = ValuationBatch.objects.create(user=user, source_name=source_name[:255])
+    line_number = 0
+    try:
+        for line_number, row, parse_error in iter_input_rows(binary_stream, fmt):
+            total += 1
+            if parse_error:
+                reject(line_number, parse_error)
+                continue
+            validated_inputs, validation_errors = validate_inputs_backend(row)
+            if validation_errors:
+                reject(line_number, "; ".join(validation_errors.values()))
+                continue
+            if max_reports is not None and accepted >= max_reports:
+                reject(line_number, "Limite de simulações gratuitas atingido.")
+                continue
+            accepted += 1
+            pending.append(ValuationReport(
+                user=user,
+                batch=batch,
+                inputs_data=validated_inputs,
+                status=ValuationReport.StatusChoices.PENDING,
+                quota_reserved=quota_reserved,
+            ))
+            if len(pending) >= BATCH_CHUNK_SIZE:
+                flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        if accepted == len(pending):
+            # Nada foi gravado ainda: um ficheiro ilegível não deixa um lote vazio
+            batch.delete()
+            raise
+        # Blocos anteriores já estão na fila: fica o que foi lido até aqui
+        logger.warning(f"Lote {batch.id}: leitura interrompida após a linha {line_number}: {e}")
+        reject(line_number + 1, f"Não foi possível ler o ficheiro a partir daqui: {e}")
+    if pending:
+        flush()
+    else:
+        save_counts()
+
+    logger.info(f"Lote {batch.id} criado para user {user.pk}: {accepted} relatório(s), {rejected} linha(s) recusada(s).")
+    return batch
+
+
+def batch_progress(batch: ValuationBatch) -> dict:
+    """Progresso agregado do lote: contagem de relatórios por status."""
+    counts = {choice: 0 for choice in ValuationReport.StatusChoices.values}
+    for row in batch.reports.values('status').annotate(total=Count('id')).order_by():
+        counts[row['status']] = row['total']
+    finished = counts[ValuationReport.StatusChoices.SUCCESS] + counts[ValuationReport.StatusChoices.FAILED]
+    return {
+        'batch_id': batch.id,
+        'total_rows': batch.total_rows,
+        'accepted': batch.accepted_count,
+        'rejected': batch.rejected_count,
+        'errors': batch.errors,
+        'status_counts': counts,
+        'finished': finished,
+        'percent_complete': round(100 * finished / batch.accepted_count, 1) if batch.accepted_count else 100.0,
+    }
@@ -0,0 +1,103 @@
+# chatbot/cache.py
+"""
+Cache de respostas do agente Gemini, endereçado pelo conteúdo dos inputs.
+
+A chave é um hash canónico de (inputs validados, razão social, modelo,
+versão do prompt): o mesmo formulário reenviado (duplo clique, retentativa,
+demonstração) reaproveita a resposta anterior sem gastar quota da API.
+Como a chave leva o modelo principal, só as respostas dele são guardadas
+(as do modelo de reserva e a narrativa padrão do SLO não, ver tasks.py).
+
+Estrutura no Redis:
+- agent_cache:entry:<hash>  -> JSON do resultado (com TTL)
+- agent_cache:lru           -> sorted set <hash> -> último acesso (para LRU)
+- agent_cache:stats         -> hash com contadores hits/misses/stores/evictions
+"""
+import hashlib
+import json
+import logging
+import time
+import redis
+from django.conf import settings
+from valuation.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+ENTRY_PREFIX = "agent_cache:entry:"
+LRU_KEY = "agent_cache:lru"
+STATS_KEY = "agent_cache:stats"
+
+
+def agent_cache_key(inputs_data: dict, user_razao_social: str, model_name: str, prompt_version: str) -> str:
+    """Hash SHA-256 da representação JSON canónica (chaves ordenadas) dos dados do pedido."""
+    canonical = json.dumps(
+        {
+            "inputs": inputs_data,
+            "razao_social": user_razao_social,
+            "model": model_name,
+            "prompt_version": prompt_version,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_cached_agent_result(key: str):
+    """Retorna o resultado em cache (dict) ou None. Falhas do Redis contam como miss."""
+    try:
+        client = get_redis()
+        raw = client.get(ENTRY_PREFIX + key)
+        pipe = client.pipeline()
+        if raw is None:
+            pipe.hincrby(STATS_KEY, "misses", 1)
+            pipe.zrem(LRU_KEY, key)  # entrada expirada pelo TTL
+        else:
+            pipe.hincrby(STATS_KEY, "hits", 1)
+            pipe.zadd(LRU_KEY, {key: time.time()})  # marca como usada recentemente
+        pipe.execute()
+        return json.loads(raw) if raw is not None else None
+    except (redis.RedisError, ValueError) as e:
+        logger.warning(f"Cache do agente indisponível na leitura ({key[:12]}...): {e}")
+        return None
+
+
+def store_agent_result(key: str, result: dict):
+    """Guarda um resultado com TTL e aplica o limite de tamanho (remove os menos usados)."""
+    ttl = settings.AGENT_CACHE_TTL_SECONDS
+    max_entries = settings.AGENT_CACHE_MAX_ENTRIES
+    try:
+        client = get_redis()
+        now = time.time()
+        pipe = client.pipeline()
+        pipe.set(ENTRY_PREFIX + key, json.dumps(result, ensure_ascii=False), ex=ttl)
+        pipe.zadd(LRU_KEY, {key: now})
+        pipe.zremrangebyscore(LRU_KEY, "-inf", now - ttl)  # já expiraram pelo TTL
+        pipe.hincrby(STATS_KEY, "stores", 1)
+        pipe.zcard(LRU_KEY)
+        size = pipe.execute()[-1]
+
+        overflow = size - max_entries
+        if overflow > 0:
+            evicted = [member for member, _score in client.zpopmin(LRU_KEY, overflow)]
+            if evicted:
+                pipe = client.pipeline()
+                pipe.delete(*[ENTRY_PREFIX + member for member in evicted])
+                pipe.hincrby(STATS_KEY, "evictions", len(evicted))
+                pipe.execute()
+                logger.info(f"Cache do agente: {len(evicted)} entrada(s) removida(s) por LRU.")
+    except (redis.RedisError, TypeError, ValueError) as e:
+        logger.warning(f"Cache do agente indisponível na escrita ({key[:12]}...): {e}")
+
+
+def cache_stats() -> dict:
+    """Contadores do cache (hits, misses, stores, evictions), tamanho atual e hit rate."""
+    client = get_redis()
+    stats = {name: int(value) for name, value in client.hgetall(STATS_KEY).items()}
+    for name in ("hits", "misses", "stores", "evictions"):
+        stats.setdefault(name, 0)
+    stats["size"] = client.zcard(LRU_KEY)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
@@ -0,0 +1,101 @@
+# chatbot/context_cache.py
+"""
+Context cache do Gemini para as instruções fixas do agente (SYSTEM_INSTRUCTION).
+
+Um único CachedContent por (modelo, PROMPT_VERSION) é partilhado por todos
+os workers: o nome fica no Redis (gemini:context_cache:<modelo>:v<versão>)
+com validade um pouco menor que o TTL do cache na API. As chamadas passam
+a enviar só a parte variável do prompt e os tokens do prefixo são cobrados
+à taxa de cache.
+
+A API só aceita caches a partir de um número mínimo de tokens
+(GEMINI_CONTEXT_CACHE_MIN_TOKENS); abaixo disso, ou se a criação falhar,
+o agente usa o modelo com system_instruction normal (o prefixo continua
+estável, o que ainda favorece o cache implícito do Gemini). Com as
+instruções atuais o mínimo não é atingido, por isso settings.GEMINI_CONTEXT_CACHE
+vem desligado.
+"""
+import logging
+from datetime import timedelta
+import redis
+import google.generativeai as genai
+from django.conf import settings
+from valuation.redis_client import get_redis
+from .prompts import PROMPT_VERSION, SYSTEM_INSTRUCTION
+
+logger = logging.getLogger(__name__)
+
+CREATE_LOCK_SECONDS = 30
+EXPIRY_MARGIN_SECONDS = 300 # Deixa de usar o cache antes de a API o apagar
+RETRY_AFTER_FAILURE_SECONDS = 3600
+
+
+def _cache_key(model_name: str) -> str:
+    return f"gemini:context_cache:{model_name}:v{PROMPT_VERSION}"
+
+
+def _instruction_tokens() -> int:
+    return len(SYSTEM_INSTRUCTION) // 4 # Mesma estimativa do gemini_limiter
+
+
+def get_cached_content_name(model_name: str):
+    """
+    Nome do CachedContent com as instruções do agente, criando-o se preciso.
+    None = usar system_instruction sem cache (desligado, prefixo pequeno,
+    Redis fora ou outro worker a criar o cache neste momento).
+    """
+    if not settings.GEMINI_CONTEXT_CACHE:
+        return None
+    if _instruction_tokens() < settings.GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        return None
+
+    key = _cache_key(model_name)
+    try:
+        client = get_redis()
+        name = client.get(key)
+        if name:
+            return name
+        if client.exists(key + ":failed") or not client.set(key + ":lock", 1, nx=True, ex=CREATE_LOCK_SECONDS):
+            return None
+    except redis.RedisError as e:
+        logger.warning(f"Redis indisponível no context cache do Gemini: {e}")
+        return None
+
+    ttl = settings.GEMINI_CONTEXT_CACHE_TTL_SECONDS
+    try:
+        cached_content = genai.caching.CachedContent.create(
+            model=model_name,
+            display_name=f"valuation-agent-v{PROMPT_VERSION}",
+            system_instruction=SYSTEM_INSTRUCTION,
+            ttl=timedelta(seconds=ttl),
+        )
+    except Exception as e:
+        logger.warning(f"Não foi possível criar o context cache do Gemini ({model_name}): {e}. Usando system_instruction.")
+        try:
+            client.set(key + ":failed", 1, ex=RETRY_AFTER_FAILURE_SECONDS)
+        except redis.RedisError:
+            pass
+        return None
+    finally:
+        try:
+            client.delete(key + ":lock")
+        except redis.RedisError:
+            pass
+
+    try:
+        client.set(key, cached_content.name, ex=max(60, ttl - EXPIRY_MARGIN_SECONDS))
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível guardar o nome do context cache do Gemini: {e}")
+    logger.info(f"Context cache do Gemini criado: {cached_content.name} (modelo {model_name}, prompt v{PROMPT_VERSION}).")
+    return cached_content.name
+
+
+def invalidate_cached_content(model_name: str, name: str):
+    """Esquece um cache que a API já não reconhece (expirou ou foi apagado)."""
+    key = _cache_key(model_name)
+    try:
+        client = get_redis()
+        if client.get(key) == name:
+            client.delete(key)
+    except redis.RedisError as e:
+        logger.warning(f"Redis indisponível ao invalidar o context cache do Gemini: {e}")
@@ -0,0 +1,64 @@
+# chatbot/deadlines.py
+"""
+Prazo global de cada relatório e orçamento de tempo por etapa.
+
+calculate_valuation_view e o lote (chatbot/batch.py, a cada bloco gravado)
+gravam ValuationReport.deadline_at (agora + REPORT_DEADLINE_SECONDS). Cada
+etapa do pipeline (agente, POST Gamma, geração Gamma, e-mail) recebe um
+orçamento calculado a partir do que resta:
+
+    orçamento = min(teto da etapa, restante - reserva das etapas seguintes)
+
+Um orçamento <= 0 significa que a etapa já não cabe no prazo: é cancelada
+e o relatório fica com timeout_reason (ver mark_timeout). Relatórios sem
+prazo (criados antes desta mudança) usam só o teto da etapa.
+
+Os soft_time_limit do Celery (settings.CELERY_TASK_SOFT_TIME_LIMIT e os das
+tarefas) são a rede de segurança: nenhuma tarefa prende um worker além disso.
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from reports.models import ValuationReport
+
+logger = logging.getLogger(__name__)
+
+TimeoutReason = ValuationReport.TimeoutReasonChoices
+
+
+def report_deadline(now=None):
+    """Prazo de um relatório aceite agora."""
+    return (now or timezone.now()) + timedelta(seconds=settings.REPORT_DEADLINE_SECONDS)
+
+
+def remaining_seconds(deadline_at, now=None):
+    """Segundos até ao prazo (negativo se passou); None sem prazo."""
+    if deadline_at is None:
+        return None
+    return (deadline_at - (now or timezone.now())).total_seconds()
+
+
+def stage_budget(deadline_at, cap: float, reserve: float = 0.0, now=None) -> float:
+    """Orçamento (s) da etapa: o teto, limitado ao que resta do prazo menos a reserva das etapas seguintes."""
+    remaining = remaining_seconds(deadline_at, now)
+    if remaining is None:
+        return cap
+    return min(cap, remaining - reserve)
+
+
+def fits_before_deadline(deadline_at, countdown: float, reserve: float = 0.0) -> bool:
+    """Um reagendamento daqui a `countdown` segundos ainda deixa `reserve` segundos antes do prazo?"""
+    remaining = remaining_seconds(deadline_at)
+    return remaining is None or remaining - countdown >= reserve
+
+
+def mark_timeout(report_id, reason):
+    """
+    Regista o motivo do estouro de prazo (só o primeiro: é a etapa que
+    realmente passou do orçamento). Retorna True se gravou.
+    """
+    updated = ValuationReport.objects.filter(pk=report_id, timeout_reason='').update(timeout_reason=reason)
+    if updated:
+        logger.warning(f"Report {report_id} passou do prazo: {TimeoutReason(reason).label}.")
+    return bool(updated)
@@ -0,0 +1,390 @@
+# chatbot/fake_upstreams.py
+"""
+Servidores HTTP locais que substituem o Gemini e o Gamma em testes de carga
+(comando fake_upstreams; o load_test mede o pipeline contra eles).
+
+- Gemini: a API REST generativelanguage v1beta (generateContent,
+  streamGenerateContent e GET de modelos), no formato que o SDK usa com
+  transport="rest". A aplicação aponta para cá com GEMINI_API_ENDPOINT.
+- Gamma: POST /generations e GET /generations/<id> (pending até passar o
+  tempo de geração, depois completed com gammaUrl). A aplicação aponta
+  para cá com GAMMA_API_URL.
+
+Cada upstream tem latência (média ± jitter) e taxa de falhas configuráveis.
+Há três modos:
+
+- synthetic: respostas geradas aqui, com o mesmo formato das APIs reais.
+- record: proxy para a API real; cada resposta é gravada numa cassete JSON
+  (sem cabeçalhos de credenciais).
+- replay: devolve as respostas da cassete (em rodízio por rota), com a
+  latência configurada ou, com latency_ms=None, a latência gravada.
+
+Rotas desconhecidas (ex: cachedContents) respondem 404; o context cache do
+agente trata isso como "sem cache".
+"""
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import requests
+
+logger = logging.getLogger(__name__)
+
+GEMINI_REAL_URL = 'https://generativelanguage.googleapis.com'
+GAMMA_REAL_URL = 'https://public-api.gamma.app/v0.2'
+
+GEMINI_GENERATE_RE = re.compile(r'^/v1beta/(?P<model>(?:models|tunedModels)/[^/:]+):(?P<method>generateContent|streamGenerateContent)$')
+GEMINI_MODEL_RE = re.compile(r'^/v1beta/(?P<model>models/[^/:]+)$')
+GAMMA_GENERATION_RE = re.compile(r'/generations/(?P<generation_id>[^/]+)$')
+
+# Cabeçalhos copiados para o upstream real no modo record (nunca gravados na cassete)
+FORWARDED_HEADERS = ('content-type', 'x-goog-api-key', 'x-goog-api-client', 'x-api-key', 'authorization')
+
+MODES = ('synthetic', 'record', 'replay')
+
+
+class UpstreamProfile:
+    """Latência e falhas simuladas de um upstream."""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, failure_rate=0.0, failure_status=503):
+        self.latency_ms = latency_ms # None = latência gravada na cassete (modo replay)
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+
+    def latency_seconds(self, recorded_ms=None) -> float:
+        base = recorded_ms if self.latency_ms is None else self.latency_ms
+        return max(0.0, ((base or 0) + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+    def should_fail(self) -> bool:
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+
+class Cassette:
+    """
+    Interações gravadas, por upstream e rota (ex: 'POST models/gemini-2.5-flash:generateContent').
+    Gravada em JSON: {"version": 1, "interactions": [{upstream, route, status, content_type, body, elapsed_ms}]}.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._interactions = []
+        self._cursor = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self._interactions = json.load(f).get('interactions', [])
+
+    def __len__(self):
+        return len(self._interactions)
+
+    def record(self, upstream, route, status, content_type, body: bytes, elapsed_ms):
+        with self._lock:
+            self._interactions.append({
+                'upstream': upstream,
+                'route': route,
+                'status': status,
+                'content_type': content_type,
+                'body': body.decode('utf-8', errors='replace'),
+                'elapsed_ms': elapsed_ms,
+            })
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'interactions': self._interactions}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def next(self, upstream, route, status_filter=None):
+        """Próxima interação gravada da rota (em rodízio), ou None."""
+        with self._lock:
+            matches = [
+                item for item in self._interactions
+                if item['upstream'] == upstream and item['route'] == route
+                and (status_filter is None or status_filter(item))
+            ]
+            if not matches:
+                return None
+            key = (upstream, route, status_filter is not None)
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            return matches[index % len(matches)]
+
+
+class FakeUpstream:
+    """Estado partilhado por todos os pedidos a um upstream (perfil, modo, cassete e contadores)."""
+
+    name = None
+    real_url = None
+
+    def __init__(self, profile, mode='synthetic', cassette=None, real_url=None):
+        if mode not in MODES:
+            raise ValueError(f"Modo inválido: {mode} (use {', '.join(MODES)})")
+        if mode != 'synthetic' and cassette is None:
+            raise ValueError(f"O modo {mode} precisa de uma cassete.")
+        self.profile = profile
+        self.mode = mode
+        self.cassette = cassette
+        self.real_url = (real_url or self.real_url).rstrip('/')
+        self._session = requests.Session() if mode == 'record' else None
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'failures_injected': 0, 'errors': 0}
+
+    def count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def handle(self, handler, method, path, body):
+        """Retorna (status, content_type, partes do corpo, atraso antes de cada parte em segundos)."""
+        raise NotImplementedError
+
+    def proxy(self, handler, method, path, route, body):
+        """Modo record: repete o pedido na API real e grava a resposta."""
+        headers = {name: handler.headers[name] for name in FORWARDED_HEADERS if handler.headers.get(name)}
+        started = time.monotonic()
+        response = self._session.request(method, self.real_url + path, headers=headers, data=body or None, timeout=120)
+        elapsed_ms = int((time.monotonic() - started) * 1000)
+        content_type = response.headers.get('Content-Type', 'application/json')
+        self.cassette.record(self.name, route, response.status_code, content_type, response.content, elapsed_ms)
+        return response.status_code, content_type, [response.content], [0]
+
+    def error_body(self, status, message) -> bytes:
+        return json.dumps({'message': message}).encode()
+
+
+class FakeGemini(FakeUpstream):
+    """generativelanguage.googleapis.com (v1beta, REST)."""
+
+    name = 'gemini'
+    real_url = GEMINI_REAL_URL
+
+    def __init__(self, profile, mode='synthetic', cassette=None, real_url=None, stream_chunks=8):
+        super().__init__(profile, mode, cassette, real_url)
+        self.stream_chunks = max(1, stream_chunks)
+
+    def error_body(self, status, message) -> bytes:
+        google_status = {400: 'INVALID_ARGUMENT', 404: 'NOT_FOUND', 429: 'RESOURCE_EXHAUSTED', 500: 'INTERNAL'}
+        return json.dumps({'error': {'code': status, 'message': message, 'status': google_status.get(status, 'UNAVAILABLE')}}).encode()
+
+    def handle(self, handler, method, path, body):
+        match = GEMINI_GENERATE_RE.match(path)
+        if method == 'POST' and match:
+            route = f"POST {match['model']}:{match['method']}"
+            streaming = match['method'] == 'streamGenerateContent'
+            if self.mode == 'record':
+                return self.proxy(handler, method, handler.path, route, body)
+            if self.mode == 'replay':
+                return self._replay(route, streaming)
+            return self._generate(match['model'], json.loads(body or b'{}'), streaming)
+
+        match = GEMINI_MODEL_RE.match(path)
+        if method == 'GET' and match:
+            if self.mode == 'record':
+                return self.proxy(handler, method, handler.path, f"GET {match['model']}", body)
+            model_id = match['model'].split('/', 1)[1]
+            payload = {
+                'name': match['model'],
+                'version': '001',
+                'displayName': model_id,
+                'inputTokenLimit': 1048576,
+                'outputTokenLimit': 65536,
+                'supportedGenerationMethods': ['generateContent', 'countTokens', 'createCachedContent'],
+            }
+            return 200, 'application/json', [json.dumps(payload).encode()], [self.profile.latency_seconds() / 10]
+
+        return 404, 'application/json', [self.error_body(404, f"Rota não simulada: {method} {path}")], [0]
+
+    def _replay(self, route, streaming):
+        interaction = self.cassette.next(self.name, route)
+        if interaction is None:
+            return 404, 'application/json', [self.error_body(404, f"Cassete sem interações para {route}")], [0]
+        body = interaction['body'].encode()
+        latency = self.profile.latency_seconds(interaction.get('elapsed_ms'))
+        if streaming and interaction['status'] == 200:
+            # Resposta gravada = array JSON; cada elemento vira uma parte
+            chunks = [json.dumps(item, ensure_ascii=False).encode() for item in json.loads(body)]
+            return 200, interaction['content_type'], *_json_array_parts(chunks, latency)
+        return interaction['status'], interaction['content_type'], [body], [latency]
+
+    def _generate(self, model, request, streaming):
+        prompt = ''.join(
+            part.get('text', '')
+            for content in request.get('contents', [])
+            for part in content.get('parts', [])
+        )
+        system = ''.join(part.get('text', '') for part in (request.get('systemInstruction') or {}).get('parts', []))
+        company = re.search(r'Empresa: "([^"]*)"', prompt)
+        company = company.group(1) if company else 'a empresa'
+        text = json.dumps({
+            'resumo_para_gamma': {
+                'principais_drivers': f"Receita recorrente e margem operacional consistente sustentam o valor de {company}.",
+                'pontos_fortes': "Diferencial competitivo claro e histórico de operação estável.",
+                'pontos_atencao': "Concentração de clientes e sensibilidade a custos fixos.",
+            },
+            'prompt_gamma': f"Crie uma apresentação concisa sobre a empresa {company}. Use um tom profissional e visual atraente.",
+        }, ensure_ascii=False)
+        usage = {
+            'promptTokenCount': (len(prompt) + len(system)) // 4,
+            'candidatesTokenCount': len(text) // 4,
+            'totalTokenCount': (len(prompt) + len(system) + len(text)) // 4,
+        }
+        model_version = model.split('/', 1)[1]
+        latency = self.profile.latency_seconds()
+        if not streaming:
+            return 200, 'application/json', [json.dumps(_candidate_response(text, usage, model_version), ensure_ascii=False).encode()], [latency]
+
+        size = max(1, -(-len(text) // self.stream_chunks))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        chunks = []
+        for index, piece in enumerate(pieces):
+            last = index == len(pieces) - 1
+            chunk = _candidate_response(piece, usage if last else None, model_version, finished=last)
+            chunks.append(json.dumps(chunk, ensure_ascii=False).encode())
+        return 200, 'application/json', *_json_array_parts(chunks, latency)
+
+
+def _candidate_response(text, usage, model_version, finished=True) -> dict:
+    candidate = {'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}
+    if finished:
+        candidate['finishReason'] = 'STOP'
+    response = {'candidates': [candidate], 'modelVersion': model_version}
+    if usage:
+        response['usageMetadata'] = usage
+    return response
+
+
+def _json_array_parts(chunks, latency):
+    """
+    Corpo do streamGenerateContent no transporte REST (um array JSON enviado aos
+    poucos): ~30% da latência até ao primeiro elemento, o resto entre elementos.
+    """
+    parts = [b'[' + chunks[0]] + [b',\r\n' + chunk for chunk in chunks[1:]]
+    parts[-1] += b']'
+    first = latency * 0.3
+    gap = (latency - first) / max(1, len(parts) - 1)
+    return parts, [first] + [gap] * (len(parts) - 1)
+
+
+class FakeGamma(FakeUpstream):
+    """public-api.gamma.app (v0.2): geração assíncrona de apresentações."""
+
+    name = 'gamma'
+    real_url = GAMMA_REAL_URL
+
+    def __init__(self, profile, mode='synthetic', cassette=None, real_url=None, generation_seconds=15.0, generation_jitter_seconds=5.0):
+        super().__init__(profile, mode, cassette, real_url)
+        self.generation_seconds = generation_seconds
+        self.generation_jitter_seconds = generation_jitter_seconds
+        self._generations = {} # generation_id -> momento (monotonic) em que fica pronta
+        self._generations_lock = threading.Lock()
+
+    def handle(self, handler, method, path, body):
+        latency = self.profile.latency_seconds()
+        if method == 'POST' and path.endswith('/generations'):
+            if self.mode == 'record':
+                return self.proxy(handler, method, path, 'POST /generations', body)
+            generation_id = uuid.uuid4().hex[:20]
+            duration = max(0.0, self.generation_seconds + random.uniform(-self.generation_jitter_seconds, self.generation_jitter_seconds))
+            with self._generations_lock:
+                self._generations[generation_id] = time.monotonic() + duration
+            payload = {'generationId': generation_id}
+            if self.mode == 'replay':
+                interaction = self.cassette.next(self.name, 'POST /generations', lambda item: item['status'] < 300)
+                if interaction is not None:
+                    payload = {**json.loads(interaction['body']), 'generationId': generation_id}
+                    latency = self.profile.latency_seconds(interaction.get('elapsed_ms'))
+            return 200, 'application/json', [json.dumps(payload).encode()], [latency]
+
+        match = GAMMA_GENERATION_RE.search(path)
+        if method == 'GET' and match:
+            generation_id = match['generation_id']
+            if self.mode == 'record':
+                return self.proxy(handler, method, path, 'GET /generations/{id}', body)
+            with self._generations_lock:
+                ready_at = self._generations.get(generation_id)
+            if ready_at is None:
+                return 404, 'application/json', [self.error_body(404, f"Geração {generation_id} não encontrada")], [latency]
+            completed = time.monotonic() >= ready_at
+            payload = {'generationId': generation_id, 'status': 'completed' if completed else 'pending'}
+            if completed:
+                payload['gammaUrl'] = f"https://gamma.app/docs/{generation_id}"
+                payload['credits'] = {'deducted': 40, 'remaining': 1000}
+            if self.mode == 'replay':
+                interaction = self.cassette.next(
+                    self.name, 'GET /generations/{id}',
+                    lambda item: item['status'] < 300 and (json.loads(item['body']).get('status') == 'completed') == completed,
+                )
+                if interaction is not None:
+                    recorded = json.loads(interaction['body'])
+                    if completed and recorded.get('gammaUrl'):
+                        recorded['gammaUrl'] = payload['gammaUrl']
+                    payload = {**recorded, 'generationId': generation_id}
+                    latency = self.profile.latency_seconds(interaction.get('elapsed_ms'))
+            return 200, 'application/json', [json.dumps(payload).encode()], [latency]
+
+        return 404, 'application/json', [self.error_body(404, f"Rota não simulada: {method} {path}")], [0]
+
+
+def _handler_for(upstream):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # Keep-alive, como as APIs reais
+
+        def _dispatch(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            path = urlsplit(self.path).path
+            upstream.count('requests')
+            try:
+                if upstream.mode != 'record' and upstream.profile.should_fail():
+                    upstream.count('failures_injected')
+                    status = upstream.profile.failure_status
+                    time.sleep(upstream.profile.latency_seconds())
+                    parts, delays = [upstream.error_body(status, "Falha simulada")], [0]
+                    content_type = 'application/json'
+                else:
+                    status, content_type, parts, delays = upstream.handle(self, method, path, body)
+            except Exception as e:
+                upstream.count('errors')
+                logger.exception(f"Erro no {upstream.name} simulado ({method} {path}): {e}")
+                status, content_type, parts, delays = 500, 'application/json', [upstream.error_body(500, str(e))], [0]
+
+            # O atraso da primeira parte vem antes do status (tempo até ao primeiro byte)
+            time.sleep(delays[0])
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(sum(len(part) for part in parts)))
+            self.end_headers()
+            for index, part in enumerate(parts):
+                if index:
+                    time.sleep(delays[index])
+                self.wfile.write(part)
+                self.wfile.flush()
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def log_message(self, format, *args):
+            logger.debug(f"[{upstream.name}] {self.address_string()} {format % args}")
+
+    return Handler
+
+
+def start_server(upstream, host='127.0.0.1', port=0):
+    """Inicia o servidor do upstream numa thread daemon. Retorna o ThreadingHTTPServer (server_address tem a porta)."""
+    server = ThreadingHTTPServer((host, port), _handler_for(upstream))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name=f"fake-{upstream.name}", daemon=True)
+    thread.start()
+    logger.info(f"{upstream.name} simulado em http://{host}:{server.server_address[1]} (modo {upstream.mode})")
+    return server
@@ -0,0 +1,55 @@
+# chatbot/gamma_client.py
+"""
+Chamadas à API Gamma, sobre a sessão HTTP compartilhada 'gamma'
+(keep-alive, timeouts e retentativas em valuation/http_client.py).
+
+O endereço base vem de settings.GAMMA_API_URL, o que permite apontar
+para um servidor local substituto em testes.
+"""
+import logging
+from django.conf import settings
+from valuation.http_client import get_session, connection_stats
+from valuation.tracing import start_span
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) em segundos
+START_TIMEOUT = (5, 30)
+STATUS_TIMEOUT = (5, 15)
+
+
+def _generations_url():
+    return f"{settings.GAMMA_API_URL.rstrip('/')}/generations"
+
+
+def _headers():
+    return {"X-API-KEY": settings.GAMMA_API_KEY, "Content-Type": "application/json"}
+
+
+def _timeout(default, budget_seconds):
+    """(connect, read) padrão, com o read limitado ao orçamento da etapa (ver chatbot/deadlines.py)."""
+    if budget_seconds is None:
+        return default
+    connect, read = default
+    return (min(connect, budget_seconds), max(0.1, min(read, budget_seconds)))
+
+
+def start_generation(prompt_gamma, budget_seconds=None):
+    """Inicia uma geração de apresentação. Retorna a resposta HTTP (já validada com raise_for_status)."""
+    payload = {"inputText": prompt_gamma, "format": "presentation", "textMode": "generate", "textOptions": {"language": "pt-br"}}
+    with start_span("gamma.start_generation", kind="client", **{"http.method": "POST"}) as span:
+        response = get_session("gamma").post(_generations_url(), headers=_headers(), json=payload, timeout=_timeout(START_TIMEOUT, budget_seconds))
+        span.set_attribute("http.status_code", response.status_code)
+        response.raise_for_status()
+    logger.debug(f"Conexões HTTP Gamma: {connection_stats().get('gamma')}")
+    return response
+
+
+def get_generation(generation_id, budget_seconds=None):
+    """Consulta o status de uma geração. Retorna a resposta HTTP (já validada com raise_for_status)."""
+    with start_span("gamma.get_generation", kind="client", **{"http.method": "GET", "gamma.generation_id": generation_id}) as span:
+        response = get_session("gamma").get(f"{_generations_url()}/{generation_id}", headers=_headers(), timeout=_timeout(STATUS_TIMEOUT, budget_seconds))
+        span.set_attribute("http.status_code", response.status_code)
+        response.raise_for_status()
+    logger.debug(f"Conexões HTTP Gamma: {connection_stats().get('gamma')}")
+    return response
@@ -0,0 +1,117 @@
+# chatbot/gemini_client.py
+"""
+Registo por processo do cliente Gemini.
+
+genai.configure() e genai.GenerativeModel() custam o setup do canal gRPC e
+a autenticação; aqui eles são feitos uma única vez por processo (no
+worker_process_init dos workers da fila gemini, ver valuation/celery.py) e reaproveitados
+por todas as tarefas. O registo é refeito automaticamente se o processo
+for um fork (PID diferente) ou se a GEMINI_API_KEY mudar.
+
+Com settings.GEMINI_API_ENDPOINT o SDK usa o transporte REST contra esse
+endereço (ex: o Gemini simulado do comando fake_upstreams).
+"""
+import logging
+import os
+import threading
+import google.generativeai as genai
+from django.conf import settings
+from .context_cache import get_cached_content_name, invalidate_cached_content
+from .prompts import PROMPT_VERSION, RESPONSE_SCHEMA, SYSTEM_INSTRUCTION
+
+logger = logging.getLogger(__name__)
+
+GEMINI_MODEL_NAME = 'gemini-2.5-flash'
+
+# Configurações de Geração (ajuste conforme necessário)
+# Modo JSON com esquema: a API valida a resposta (sem texto ou cercas em volta do objeto)
+GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=RESPONSE_SCHEMA,
+    # temperature=0.7 # Um pouco de criatividade, mas não muita para finanças
+    # max_output_tokens=2048
+)
+# Configurações de Segurança (podem precisar ser ajustadas se o Gemini bloquear respostas)
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+_lock = threading.Lock()
+_models = {}          # chave (nome, variante) -> genai.GenerativeModel
+_configured_for = None  # (pid, api_key) usados no último genai.configure()
+
+
+def _ensure_configured(api_key):
+    """(Re)configura o SDK se ainda não foi feito neste processo ou se a chave mudou."""
+    global _configured_for
+    current = (os.getpid(), api_key)
+    if _configured_for != current:
+        if _configured_for is not None:
+            motivo = "fork do processo" if _configured_for[0] != current[0] else "troca de credencial"
+            logger.info(f"Recriando cliente Gemini ({motivo}).")
+        if settings.GEMINI_API_ENDPOINT:
+            genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": settings.GEMINI_API_ENDPOINT})
+        else:
+            genai.configure(api_key=api_key)
+        _models.clear()  # modelos antigos apontam para o canal/credencial anteriores
+        _configured_for = current
+
+
+def get_agent_model(model_name: str = GEMINI_MODEL_NAME, use_context_cache: bool = True):
+    """
+    Modelo do agente de valuation, já com as instruções fixas (prompts.SYSTEM_INSTRUCTION).
+    Retorna (modelo, nome do context cache ou None); modelo None se a
+    GEMINI_API_KEY não estiver configurada.
+    """
+    api_key = settings.GEMINI_API_KEY
+    if not api_key:
+        return None, None
+    with _lock:
+        _ensure_configured(api_key)
+    cached_name = get_cached_content_name(model_name) if use_context_cache else None
+    variant = ("cache", cached_name) if cached_name else ("system", PROMPT_VERSION)
+    with _lock:
+        model = _models.get((model_name, variant))
+    if model is None:
+        # from_cached_content consulta a API uma vez; o modelo fica guardado até o cache mudar
+        if cached_name:
+            try:
+                model = genai.GenerativeModel.from_cached_content(cached_name)
+            except Exception as e:
+                logger.warning(f"Context cache {cached_name} indisponível ({e}). Usando system_instruction.")
+                invalidate_cached_content(model_name, cached_name)
+                cached_name = None
+                variant = ("system", PROMPT_VERSION)
+        if model is None:
+            model = genai.GenerativeModel(model_name, system_instruction=SYSTEM_INSTRUCTION)
+        with _lock:
+            if cached_name:
+                # Descarta modelos de caches anteriores deste modelo
+                for key in [key for key in _models if key[0] == model_name and key[1] and key[1][0] == "cache"]:
+                    del _models[key]
+            _models[(model_name, variant)] = model
+    return model, cached_name
+
+
+def reset():
+    """Descarta o cliente deste processo (a próxima chamada reconecta)."""
+    global _configured_for
+    with _lock:
+        _models.clear()
+        _configured_for = None
+
+
+def warm_up(model_name: str = GEMINI_MODEL_NAME) -> bool:
+    """
+    Aquecimento local: configura o SDK e cria o modelo do agente antes da
+    primeira tarefa. Não faz chamadas à API (nem metadados, nem context
+    cache), por isso não bloqueia o arranque do processo do worker.
+    """
+    if get_agent_model(model_name, use_context_cache=False)[0] is None:
+        logger.warning("Aquecimento do Gemini ignorado: GEMINI_API_KEY não configurada.")
+        return False
+    logger.info(f"Cliente Gemini aquecido (PID {os.getpid()}, modelo {model_name}).")
+    return True
@@ -0,0 +1,228 @@
+# chatbot/gemini_limiter.py
+"""
+Limitador global das chamadas ao Gemini, partilhado por todos os workers via Redis.
+
+Duas restrições verificadas juntas, num único script Lua:
+- concorrência: semáforo distribuído (sorted set com prazo de lease, para
+  que um worker que morre não prenda a vaga para sempre);
+- orçamento de tokens por minuto: token bucket com reposição contínua
+  (GEMINI_TOKENS_PER_MINUTE / 60 por segundo), o que mantém o ritmo
+  constante junto ao teto da quota em vez de gastar tudo no início de cada
+  minuto e ficar parado até ao seguinte.
+
+Quem não consegue vaga espera (até GEMINI_LIMITER_MAX_WAIT segundos) e
+depois recebe GeminiCapacityExceeded com uma sugestão de retry_after; a
+tarefa adia-se (retry do Celery) em vez de falhar. Um 429 do Gemini abre
+um período de pausa para todos os workers. Se o Redis estiver fora, o
+limitador deixa passar.
+
+    with gemini_call(estimated_tokens) as slot:
+        response = model.generate_content(...)
+        slot.record_usage(response.usage_metadata.total_token_count)
+"""
+import logging
+import random
+import time
+import uuid
+from contextlib import contextmanager
+import redis
+from django.conf import settings
+from google.api_core import exceptions as google_exceptions
+from valuation.redis_client import get_redis
+from valuation.tracing import start_span
+
+logger = logging.getLogger(__name__)
+
+SEMAPHORE_KEY = "gemini:limiter:slots"
+BUCKET_KEY = "gemini:limiter:tpm"
+COOLDOWN_KEY = "gemini:limiter:cooldown"
+STATS_KEY = "gemini:limiter:stats"
+
+CONCURRENCY_POLL_SECONDS = 0.25 # Espera entre tentativas quando todas as vagas estão ocupadas
+
+# KEYS = semáforo, bucket, pausa
+# ARGV = agora (s), id da vaga, lease (s), máx. concorrência, capacidade (tokens), tokens/s, custo
+# Retorna {1, 0, 'ok'} ou {0, espera sugerida em ms, motivo}
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cooldown_ms = redis.call('PTTL', KEYS[3])
+if cooldown_ms > 0 then
+    return {0, cooldown_ms, 'cooldown'}
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return {0, 0, 'concurrency'}
+end
+local capacity = tonumber(ARGV[5])
+local rate = tonumber(ARGV[6])
+local cost = math.min(tonumber(ARGV[7]), capacity)
+local bucket = redis.call('HMGET', KEYS[2], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+if tokens < cost then
+    redis.call('HSET', KEYS[2], 'tokens', tostring(tokens), 'ts', tostring(now))
+    return {0, math.ceil((cost - tokens) / rate * 1000), 'budget'}
+end
+redis.call('HSET', KEYS[2], 'tokens', tostring(tokens - cost), 'ts', tostring(now))
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[2])
+return {1, 0, 'ok'}
+"""
+
+# KEYS = semáforo, bucket; ARGV = id da vaga, tokens a devolver (negativo = cobrar a mais), capacidade
+RELEASE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+local adjust = tonumber(ARGV[2])
+if adjust ~= 0 then
+    local tokens = tonumber(redis.call('HGET', KEYS[2], 'tokens'))
+    if tokens then
+        redis.call('HSET', KEYS[2], 'tokens', tostring(math.min(tonumber(ARGV[3]), tokens + adjust)))
+    end
+end
+return 1
+"""
+
+_scripts = {}
+
+
+class GeminiCapacityExceeded(Exception):
+    """Sem vaga ou sem orçamento de tokens dentro do tempo de espera."""
+
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Capacidade do Gemini esgotada ({reason}); tentar de novo em {retry_after}s")
+
+
+def _script(source):
+    client = get_redis()
+    key = (id(client), source)
+    if key not in _scripts:
+        _scripts[key] = client.register_script(source)
+    return _scripts[key]
+
+
+def _incr_stats(**counters):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for name, amount in counters.items():
+            pipe.hincrby(STATS_KEY, name, int(amount))
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def estimate_tokens(prompt: str) -> int:
+    """Estimativa grosseira (~4 caracteres por token) mais a saída esperada."""
+    return len(prompt) // 4 + settings.GEMINI_OUTPUT_TOKENS_ESTIMATE
+
+
+class GeminiSlot:
+    """Vaga obtida no limitador; devolvida no fim da chamada (release)."""
+
+    def __init__(self, slot_id, estimated_tokens):
+        self.slot_id = slot_id
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens = None
+
+    def record_usage(self, total_tokens):
+        """Tokens realmente gastos (usage_metadata): a diferença para a estimativa é acertada no bucket."""
+        if total_tokens:
+            self.used_tokens = int(total_tokens)
+
+    def release(self):
+        if self.slot_id is None:
+            return
+        adjust = self.estimated_tokens - self.used_tokens if self.used_tokens is not None else 0
+        try:
+            _script(RELEASE_SCRIPT)(
+                keys=[SEMAPHORE_KEY, BUCKET_KEY],
+                args=[self.slot_id, adjust, settings.GEMINI_TOKENS_PER_MINUTE],
+            )
+        except redis.RedisError as e:
+            logger.warning(f"Não foi possível libertar a vaga {self.slot_id} do limitador Gemini: {e}")
+        _incr_stats(tokens_estimated=self.estimated_tokens, tokens_used=self.used_tokens or self.estimated_tokens)
+        self.slot_id = None
+
+
+def acquire(estimated_tokens: int, max_wait: float = None) -> GeminiSlot:
+    """
+    Espera por uma vaga com orçamento para `estimated_tokens`. Levanta
+    GeminiCapacityExceeded se não conseguir em `max_wait` segundos.
+    """
+    max_wait = settings.GEMINI_LIMITER_MAX_WAIT if max_wait is None else max_wait
+    slot_id = uuid.uuid4().hex
+    started = time.monotonic()
+    while True:
+        try:
+            granted, retry_ms, reason = _script(ACQUIRE_SCRIPT)(
+                keys=[SEMAPHORE_KEY, BUCKET_KEY, COOLDOWN_KEY],
+                args=[
+                    time.time(), slot_id, settings.GEMINI_SLOT_LEASE_SECONDS, settings.GEMINI_MAX_CONCURRENCY,
+                    settings.GEMINI_TOKENS_PER_MINUTE, settings.GEMINI_TOKENS_PER_MINUTE / 60.0, estimated_tokens,
+                ],
+            )
+        except redis.RedisError as e:
+            logger.warning(f"Redis indisponível no limitador Gemini: {e}. Seguindo sem limite.")
+            return GeminiSlot(None, estimated_tokens)
+
+        waited = time.monotonic() - started
+        if granted:
+            _incr_stats(acquired=1, waited=1 if waited >= 0.05 else 0, wait_ms_total=waited * 1000)
+            if waited >= 1:
+                logger.info(f"Vaga Gemini obtida após {waited:.1f}s de espera")
+            return GeminiSlot(slot_id, estimated_tokens)
+
+        if isinstance(reason, bytes):
+            reason = reason.decode()
+        retry_after = max(CONCURRENCY_POLL_SECONDS, retry_ms / 1000)
+        remaining = max_wait - waited
+        if remaining <= 0:
+            _incr_stats(**{f"rejected_{reason}": 1})
+            raise GeminiCapacityExceeded(reason, int(retry_after) + 1)
+        # Jitter para que os workers em espera não acordem todos ao mesmo tempo
+        time.sleep(min(remaining, retry_after) * random.uniform(1.0, 1.2))
+
+
+def start_cooldown(seconds: float):
+    """Pausa todas as chamadas (todos os workers) depois de um 429 do Gemini."""
+    try:
+        get_redis().set(COOLDOWN_KEY, "1", px=int(seconds * 1000))
+    except redis.RedisError:
+        pass
+
+
+@contextmanager
+def gemini_call(estimated_tokens: int):
+    """Obtém uma vaga, executa a chamada e devolve a vaga; um 429 vira GeminiCapacityExceeded."""
+    # Espera pela vaga num span próprio (separa fila do limitador de latência do Gemini)
+    with start_span("gemini.limiter.acquire", estimated_tokens=estimated_tokens):
+        slot = acquire(estimated_tokens)
+    try:
+        yield slot
+    except (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests) as e:
+        cooldown = settings.GEMINI_THROTTLE_COOLDOWN_SECONDS
+        logger.warning(f"Gemini respondeu 429: pausa de {cooldown}s para todos os workers. {e}")
+        start_cooldown(cooldown)
+        _incr_stats(throttled_429=1)
+        raise GeminiCapacityExceeded('throttled', cooldown) from e
+    finally:
+        slot.release()
+
+
+def record_deferral():
+    _incr_stats(deferred=1)
+
+
+def limiter_stats() -> dict:
+    """Contadores acumulados, vagas em uso e tokens disponíveis agora."""
+    client = get_redis()
+    stats = {name: int(value) for name, value in client.hgetall(STATS_KEY).items()}
+    for name in ("acquired", "waited", "wait_ms_total", "rejected_concurrency", "rejected_budget",
+                 "rejected_cooldown", "throttled_429", "deferred", "tokens_estimated", "tokens_used"):
+        stats.setdefault(name, 0)
+    stats["avg_wait_ms"] = round(stats["wait_ms_total"] / stats["acquired"], 1) if stats["acquired"] else 0.0
+    stats["in_flight"] = client.zcount(SEMAPHORE_KEY, time.time(), "+inf")
+    tokens = client.hget(BUCKET_KEY, "tokens")
+    stats["tokens_available"] = int(float(tokens)) if tokens is not None else settings.GEMINI_TOKENS_PER_MINUTE
+    return stats
@@ -0,0 +1,192 @@
+# chatbot/idempotency.py
+"""
+Pedidos de cálculo repetidos (duplo clique, retentativa de rede) não criam
+relatórios nem chamadas ao Gemini em duplicado.
+
+Duas chaves por utilizador no Redis, verificadas e reservadas juntas num
+script Lua:
+- idem:key:<user_id>:<Idempotency-Key>: o mesmo cabeçalho devolve sempre
+  o mesmo relatório durante IDEMPOTENCY_KEY_TTL_SECONDS (a chave enviada
+  com inputs diferentes é recusada);
+- idem:inputs:<user_id>:<hash dos inputs validados>: inputs idênticos
+  dentro de VALUATION_DEDUPE_WINDOW_SECONDS devolvem o relatório existente,
+  mesmo sem cabeçalho. Com a janela a 0 esta chave não é usada (nem
+  durante a criação): só o Idempotency-Key deduplica.
+
+Enquanto o relatório ainda não foi criado as chaves guardam 'pending' com
+um TTL curto; um segundo pedido nesse intervalo recebe 409 e volta a tentar.
+Se o Redis estiver indisponível, os pedidos seguem sem deduplicação.
+"""
+import hashlib
+import json
+import logging
+import redis
+from django.conf import settings
+from valuation.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+PENDING_TTL_SECONDS = 30 # Tempo máximo entre a reserva e a criação do relatório
+MAX_KEY_LENGTH = 128
+
+# KEYS[1] = chave de idempotência (ou '' se não enviada), KEYS[2] = chave dos inputs (ou '' se desligada)
+# ARGV = impressão digital dos inputs, marcador 'pending', TTL da reserva
+# Retorna {'new'} se reservou as duas, ou {origem, valor guardado}
+CLAIM_SCRIPT = """
+local claim = cjson.encode({report_id = ARGV[2], fingerprint = ARGV[1]})
+if KEYS[1] ~= '' then
+    local existing = redis.call('GET', KEYS[1])
+    if existing then
+        return {'key', existing}
+    end
+end
+if KEYS[2] ~= '' then
+    local existing = redis.call('GET', KEYS[2])
+    if existing then
+        return {'inputs', existing}
+    end
+end
+for _, key in ipairs(KEYS) do
+    if key ~= '' then
+        redis.call('SET', key, claim, 'EX', tonumber(ARGV[3]))
+    end
+end
+return {'new'}
+"""
+
+# Apaga as chaves que ainda apontam para ARGV[1]: 'pending' (pedido não chegou a
+# criar o relatório) ou o id de um relatório que já não serve (ver forget)
+RELEASE_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if key ~= '' then
+        local value = redis.call('GET', key)
+        if value and cjson.decode(value)['report_id'] == ARGV[1] then
+            redis.call('DEL', key)
+        end
+    end
+end
+return 1
+"""
+
+_scripts = {}
+
+
+def _script(source):
+    client = get_redis()
+    key = (id(client), source)
+    if key not in _scripts:
+        _scripts[key] = client.register_script(source)
+    return _scripts[key]
+
+
+class IdempotencyKeyError(ValueError):
+    """Cabeçalho Idempotency-Key inválido."""
+
+
+class IdempotencyConflict(Exception):
+    """A chave já foi usada com outros inputs (reused=True) ou o pedido original ainda está em curso."""
+
+    def __init__(self, reused: bool = False):
+        self.reused = reused
+        super().__init__("Chave de idempotência reutilizada com outros dados." if reused else "Pedido idêntico em processamento.")
+
+
+def inputs_fingerprint(validated_inputs: dict) -> str:
+    """Hash SHA-256 da representação JSON canónica dos inputs validados."""
+    canonical = json.dumps(validated_inputs, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def clean_idempotency_key(raw) -> str:
+    """Valida o cabeçalho (texto ASCII visível, até MAX_KEY_LENGTH caracteres). '' se ausente."""
+    key = (raw or "").strip()
+    if not key:
+        return ""
+    if len(key) > MAX_KEY_LENGTH or not all(33 <= ord(char) <= 126 for char in key):
+        raise IdempotencyKeyError(f"Idempotency-Key inválida (até {MAX_KEY_LENGTH} caracteres ASCII, sem espaços).")
+    return key
+
+
+class ValuationRequestClaim:
+    """
+    Reserva das chaves de um pedido de cálculo.
+
+        claim = ValuationRequestClaim(user.id, idempotency_key, validated_inputs)
+        existing_report_id = claim.acquire() # None = pedido novo
+        ...
+        claim.complete(report.id)   # ou claim.release() se não criar o relatório
+    """
+
+    def __init__(self, user_id, idempotency_key: str, validated_inputs: dict):
+        self.fingerprint = inputs_fingerprint(validated_inputs)
+        self.idempotency_key = f"idem:key:{user_id}:{idempotency_key}" if idempotency_key else ""
+        dedupe_inputs = settings.VALUATION_DEDUPE_WINDOW_SECONDS > 0
+        self.inputs_key = f"idem:inputs:{user_id}:{self.fingerprint}" if dedupe_inputs else ""
+        self.acquired = False
+        self.source = None # 'key' ou 'inputs': qual das chaves devolveu o relatório existente
+
+    @property
+    def _keys(self):
+        return [self.idempotency_key, self.inputs_key]
+
+    def acquire(self):
+        """
+        Retorna o id do relatório já criado para este pedido, ou None se este
+        pedido ficou com a reserva. Levanta IdempotencyConflict se o pedido
+        original ainda está a criar o relatório ou se a chave veio com outros inputs.
+        """
+        try:
+            reply = _script(CLAIM_SCRIPT)(keys=self._keys, args=[self.fingerprint, PENDING, PENDING_TTL_SECONDS])
+        except redis.RedisError as e:
+            logger.warning(f"Redis indisponível na deduplicação de pedidos: {e}")
+            return None
+        if reply[0] == "new":
+            self.acquired = True
+            return None
+
+        self.source, stored = reply[0], json.loads(reply[1])
+        if reply[0] == "key" and stored.get("fingerprint") != self.fingerprint:
+            raise IdempotencyConflict(reused=True)
+        if stored.get("report_id") == PENDING:
+            raise IdempotencyConflict()
+        return int(stored["report_id"])
+
+    def complete(self, report_id):
+        """Associa as chaves reservadas ao relatório criado, com os TTLs definitivos."""
+        if not self.acquired:
+            return
+        value = json.dumps({"report_id": str(report_id), "fingerprint": self.fingerprint})
+        try:
+            pipe = get_redis().pipeline()
+            if self.idempotency_key:
+                pipe.set(self.idempotency_key, value, ex=settings.IDEMPOTENCY_KEY_TTL_SECONDS)
+            if self.inputs_key:
+                pipe.set(self.inputs_key, value, ex=settings.VALUATION_DEDUPE_WINDOW_SECONDS)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Redis indisponível ao gravar a deduplicação do Report {report_id}: {e}")
+
+    def release(self):
+        """Desfaz a reserva (quota esgotada, erro ao criar): o próximo pedido idêntico segue normalmente."""
+        if not self.acquired:
+            return
+        self.acquired = False
+        try:
+            _script(RELEASE_SCRIPT)(keys=self._keys, args=[PENDING])
+        except redis.RedisError as e:
+            logger.warning(f"Redis indisponível ao desfazer a deduplicação: {e}")
+
+    def forget(self, report_id, idempotency_key: bool = False):
+        """
+        Remove as associações ao relatório `report_id` (só se ainda apontarem
+        para ele): a dos inputs quando ele falhou e deve poder ser refeito, e
+        também a da Idempotency-Key (idempotency_key=True) quando foi apagado.
+        """
+        keys = [self.idempotency_key if idempotency_key else "", self.inputs_key]
+        if not any(keys):
+            return
+        try:
+            _script(RELEASE_SCRIPT)(keys=keys, args=[str(report_id)])
+        except redis.RedisError as e:
+            logger.warning(f"Redis indisponível ao limpar a deduplicação: {e}")
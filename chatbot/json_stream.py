@@ -0,0 +1,70 @@
+# chatbot/json_stream.py
+"""
+Parser incremental para um objeto JSON recebido aos pedaços (streaming).
+
+Cada vez que um par chave/valor de PRIMEIRO nível fica completo ele é
+devolvido, sem esperar o fecho do objeto. Texto antes do primeiro '{'
+(ex: a cerca ```json que alguns modelos insistem em enviar) é ignorado.
+
+    parser = IncrementalJSONObjectParser()
+    for chunk in response:
+        for key, value in parser.feed(chunk.text):
+            ...
+"""
+import json
+
+
+class IncrementalJSONObjectParser:
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0             # próximo caractere a analisar
+        self._depth = 0           # profundidade de { e [ (1 = dentro do objeto raiz)
+        self._in_string = False
+        self._escape = False
+        self._member_start = None  # início do membro de primeiro nível atual
+        self.done = False         # objeto raiz já foi fechado
+
+    def feed(self, text: str) -> list:
+        """Acrescenta texto e devolve a lista de pares (chave, valor) completados por ele."""
+        self.buffer += text
+        completed = []
+        while self._pos < len(self.buffer) and not self.done:
+            char = self.buffer[self._pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                    self._member_start = self._pos + 1
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit(self._pos, completed)
+                    self.done = True
+            elif char == "," and self._depth == 1:
+                self._emit(self._pos, completed)
+                self._member_start = self._pos + 1
+
+            self._pos += 1
+        return completed
+
+    def _emit(self, end, completed):
+        member = self.buffer[self._member_start:end]
+        if member.strip():
+            # Um membro isolado ("chave": valor) vira um objeto JSON válido com chaves em volta
+            completed.extend(json.loads("{" + member + "}").items())
+
+    def text(self) -> str:
+        """Texto recebido a partir do primeiro '{' (o JSON completo, se terminou)."""
+        start = self.buffer.find("{")
+        return self.buffer[start:self._pos] if start >= 0 else ""
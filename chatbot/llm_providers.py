@@ -0,0 +1,390 @@
+# chatbot/llm_providers.py
+"""
+Provedores do agente de valuation e pedidos "hedged".
+
+- GeminiProvider: um modelo Gemini (o principal, GEMINI_MODEL_NAME, ou o
+  modelo rápido de reserva, settings.GEMINI_FALLBACK_MODEL_NAME), com o
+  context cache, o limitador global e o streaming de campos.
+- LocalProvider: narrativa determinística do motor (sem rede); é a
+  resposta quando nenhum modelo responde dentro do SLO.
+
+generate_with_hedging() lança o primeiro modelo e, se ele não responder
+até ao p95 observado da sua latência, lança um segundo pedido ao outro
+modelo (hedge); fica com a primeira resposta. Um erro lança o outro modelo
+de imediato. Esgotado o orçamento (settings.LLM_SLO_SECONDS, ou menos se o
+prazo do relatório estiver perto, ver deadlines.py), responde o
+LocalProvider: a latência do agente fica limitada pelo SLO e não pelo
+upstream mais lento.
+
+A latência de cada provedor (últimas LLM_LATENCY_SAMPLES respostas) e os
+contadores de resultados ficam no Redis, partilhados por todos os workers;
+o p95 define o atraso do hedge e, se o modelo principal passar do SLO, o
+modelo de reserva passa a ser tentado primeiro.
+
+Os pedidos correm em threads do processo; os campos em streaming e o
+resultado voltam por uma fila para a thread da tarefa (que grava no banco).
+Cada pedido leva um timeout (request_options) igual ao que resta do
+orçamento, limitado a LLM_REQUEST_TIMEOUT_SECONDS: um pedido que passa do
+orçamento é cancelado pelo próprio cliente HTTP e não fica a ocupar a thread.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+import redis
+from django.conf import settings
+import requests
+from google.api_core import exceptions as google_exceptions
+from valuation.redis_client import get_redis
+from valuation.tracing import start_span
+from .context_cache import invalidate_cached_content
+from .gemini_client import get_agent_model, GEMINI_MODEL_NAME, GENERATION_CONFIG, SAFETY_SETTINGS
+from .gemini_limiter import gemini_call, estimate_tokens, GeminiCapacityExceeded
+from .json_stream import IncrementalJSONObjectParser
+from .prompts import SYSTEM_INSTRUCTION
+from .valuation_engine import gerar_prompt_gamma
+
+logger = logging.getLogger(__name__)
+
+LATENCY_KEY = "llm:latency:{name}"   # lista dos últimos tempos de resposta (ms), mais recente primeiro
+OUTCOMES_KEY = "llm:outcomes:{name}" # hash: ok, error, hedge_won, slo_exceeded
+STATS_TTL_SECONDS = 7 * 24 * 3600
+OUTCOMES = ("ok", "error", "hedge_won", "slo_exceeded")
+
+LOCAL_PROVIDER_NAME = "local"
+# Só as respostas do modelo principal vão para o cache do agente (chave de GEMINI_MODEL_NAME, ver tasks.py)
+PRIMARY_PROVIDER_NAME = f"gemini:{GEMINI_MODEL_NAME}"
+
+# Exceções de timeout do cliente (gRPC ou REST): a duração conta como amostra de latência
+TIMEOUT_ERRORS = (google_exceptions.DeadlineExceeded, requests.exceptions.Timeout, TimeoutError)
+
+# Resposta de generate_with_hedging; timed_out = o orçamento acabou sem resposta de nenhum modelo
+AgentAnswer = namedtuple('AgentAnswer', 'text usage provider hedged timed_out')
+
+
+class ProviderUnavailable(Exception):
+    """O provedor não está configurado (ex: sem GEMINI_API_KEY)."""
+
+
+class GeminiProvider:
+    """Um modelo Gemini como provedor do agente."""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.name = f"gemini:{model_name}"
+
+    def __repr__(self):
+        return f"<GeminiProvider {self.model_name}>"
+
+    def generate(self, prompt: str, label: str, on_field=None, timeout=None):
+        """
+        Uma resposta do modelo. Retorna (texto JSON, usage dict). Passa pelo
+        limitador global; sem capacidade, levanta GeminiCapacityExceeded.
+        timeout: segundos para o pedido HTTP (padrão LLM_REQUEST_TIMEOUT_SECONDS).
+        """
+        timeout = timeout or settings.LLM_REQUEST_TIMEOUT_SECONDS
+        model, cached_content_name = get_agent_model(self.model_name)
+        if model is None:
+            raise ProviderUnavailable("GEMINI_API_KEY não configurada.")
+        # Vaga no limitador global (concorrência + tokens/minuto partilhados por todos os workers);
+        # os tokens em cache também contam para a quota por minuto
+        with gemini_call(estimate_tokens(SYSTEM_INSTRUCTION + prompt)) as slot:
+            try:
+                response, response_text = self._generate(model, prompt, label, on_field, timeout)
+            except google_exceptions.NotFound:
+                if not cached_content_name:
+                    raise
+                # O context cache expirou ou foi apagado na API: repete sem ele
+                logger.warning(f"Context cache do Gemini {cached_content_name} não encontrado. Repetindo sem cache.")
+                invalidate_cached_content(self.model_name, cached_content_name)
+                model, cached_content_name = get_agent_model(self.model_name, use_context_cache=False)
+                response, response_text = self._generate(model, prompt, label, on_field, timeout)
+            usage = getattr(response, 'usage_metadata', None)
+            slot.record_usage(getattr(usage, 'total_token_count', None))
+        return response_text, _usage_dict(usage)
+
+    def _generate(self, model, prompt: str, label: str, on_field, timeout):
+        """Uma chamada ao modelo (em streaming ou não), num span de rastreio. Retorna (resposta, texto JSON)."""
+        with start_span("gemini.generate_content", kind="client", **{
+            "gemini.model": self.model_name,
+            "gemini.streaming": settings.GEMINI_STREAMING,
+            "gemini.context_cache": bool(getattr(model, "cached_content", None)),
+            "gemini.timeout_s": round(timeout, 1),
+        }) as span:
+            response, response_text = self._call_model(model, prompt, label, on_field, timeout)
+            usage = getattr(response, 'usage_metadata', None)
+            if usage is not None:
+                span.set_attribute("gemini.prompt_tokens", getattr(usage, 'prompt_token_count', None))
+                span.set_attribute("gemini.output_tokens", getattr(usage, 'candidates_token_count', None))
+            return response, response_text
+
+    def _call_model(self, model, prompt: str, label: str, on_field, timeout):
+        request_options = {"timeout": timeout}
+        if not settings.GEMINI_STREAMING:
+            response = model.generate_content(
+                prompt,
+                generation_config=GENERATION_CONFIG,
+                safety_settings=SAFETY_SETTINGS,
+                request_options=request_options,
+            )
+            return response, response.text
+
+        response = model.generate_content(
+            prompt,
+            generation_config=GENERATION_CONFIG,
+            safety_settings=SAFETY_SETTINGS,
+            stream=True,
+            request_options=request_options,
+        )
+        parser = IncrementalJSONObjectParser()
+        for chunk in response:
+            try:
+                chunk_text = chunk.text
+            except ValueError:
+                continue # Chunk sem texto (ex: apenas metadados de término)
+            for key, value in parser.feed(chunk_text):
+                logger.debug(f"Campo '{key}' recebido em streaming de {self.model_name} para {label}")
+                if on_field:
+                    on_field(key, value)
+        return response, parser.text()
+
+
+class LocalProvider:
+    """Narrativa padrão do motor determinístico (sem rede, sem custo)."""
+
+    name = LOCAL_PROVIDER_NAME
+
+    def generate(self, base_result: dict):
+        resumo = base_result["resumo_para_gamma"]
+        text = json.dumps({
+            "resumo_para_gamma": {key: resumo.get(key) for key in ("principais_drivers", "pontos_fortes", "pontos_atencao")},
+            "prompt_gamma": gerar_prompt_gamma(base_result),
+        }, ensure_ascii=False)
+        return text, {}
+
+
+def _usage_dict(usage) -> dict:
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": getattr(usage, 'prompt_token_count', None),
+        "cached_tokens": getattr(usage, 'cached_content_token_count', None),
+        "output_tokens": getattr(usage, 'candidates_token_count', None),
+        "total_tokens": getattr(usage, 'total_token_count', None),
+    }
+
+
+# --- Estatísticas de latência (Redis, partilhadas pelos workers) ---
+
+def record_latency(name: str, latency_ms: int):
+    key = LATENCY_KEY.format(name=name)
+    try:
+        pipe = get_redis().pipeline()
+        pipe.lpush(key, int(latency_ms))
+        pipe.ltrim(key, 0, settings.LLM_LATENCY_SAMPLES - 1)
+        pipe.expire(key, STATS_TTL_SECONDS)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível registar a latência de {name}: {e}")
+
+
+def record_outcome(name: str, outcome: str):
+    key = OUTCOMES_KEY.format(name=name)
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hincrby(key, outcome, 1)
+        pipe.expire(key, STATS_TTL_SECONDS)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível registar o resultado de {name}: {e}")
+
+
+def latency_percentile(name: str, percentile: float = 95):
+    """Percentil (ms) das últimas respostas do provedor; None com menos de LLM_LATENCY_MIN_SAMPLES."""
+    try:
+        samples = sorted(int(value) for value in get_redis().lrange(LATENCY_KEY.format(name=name), 0, -1))
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível ler a latência de {name}: {e}")
+        return None
+    if len(samples) < settings.LLM_LATENCY_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+def provider_stats() -> dict:
+    """{provedor: {'samples', 'p50_ms', 'p95_ms', 'ok', 'error', 'hedge_won', 'slo_exceeded'}} (comando llm_provider_stats)."""
+    stats = {}
+    for provider in _configured_providers():
+        try:
+            client = get_redis()
+            samples = sorted(int(value) for value in client.lrange(LATENCY_KEY.format(name=provider.name), 0, -1))
+            outcomes = client.hgetall(OUTCOMES_KEY.format(name=provider.name))
+        except redis.RedisError as e:
+            logger.warning(f"Não foi possível ler as estatísticas de {provider.name}: {e}")
+            continue
+        row = {
+            'samples': len(samples),
+            'p50_ms': samples[len(samples) // 2] if samples else None,
+            'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else None,
+        }
+        row.update({outcome: int(outcomes.get(outcome, 0)) for outcome in OUTCOMES})
+        stats[provider.name] = row
+    return stats
+
+
+# --- Escolha dos provedores e hedge ---
+
+def _configured_providers():
+    """Modelo principal e, se configurado, o de reserva (na ordem de preferência)."""
+    providers = [GeminiProvider(GEMINI_MODEL_NAME)]
+    fallback_model = settings.GEMINI_FALLBACK_MODEL_NAME
+    if fallback_model and fallback_model != GEMINI_MODEL_NAME:
+        providers.append(GeminiProvider(fallback_model))
+    return providers
+
+
+def choose_providers():
+    """
+    (primeiro, hedge) conforme a latência observada: se o p95 do principal passou
+    do SLO e o de reserva é mais rápido, a reserva vai primeiro. Só com um modelo
+    configurado o hedge é um segundo pedido ao mesmo modelo.
+    """
+    providers = _configured_providers()
+    if len(providers) == 1:
+        return providers[0], providers[0]
+    primary, fallback = providers
+    slo_ms = settings.LLM_SLO_SECONDS * 1000
+    primary_p95 = latency_percentile(primary.name)
+    fallback_p95 = latency_percentile(fallback.name)
+    if primary_p95 is not None and primary_p95 > slo_ms and (fallback_p95 is None or fallback_p95 < primary_p95):
+        logger.info(f"p95 de {primary.name} ({primary_p95}ms) acima do SLO: {fallback.name} vai primeiro.")
+        return fallback, primary
+    return primary, fallback
+
+
+def hedge_delay_seconds(provider) -> float:
+    """Espera antes do hedge: p95 observado do provedor, entre o mínimo configurado e o SLO."""
+    p95 = latency_percentile(provider.name)
+    delay = p95 / 1000 if p95 is not None else settings.LLM_HEDGE_DEFAULT_DELAY_SECONDS
+    return min(max(delay, settings.LLM_HEDGE_MIN_DELAY_SECONDS), settings.LLM_SLO_SECONDS)
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Pool de threads do processo (recriado depois de um fork do worker)."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=settings.LLM_MAX_PARALLEL_REQUESTS, thread_name_prefix="llm")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _attempt(provider, index, prompt, label, events, timeout):
+    """Corre numa thread do pool: envia ('field' | 'done' | 'error', índice, dados) para a fila."""
+    started = time.monotonic()
+    try:
+        result = provider.generate(prompt, label, on_field=lambda key, value: events.put(("field", index, (key, value))), timeout=timeout)
+    except Exception as e:
+        if isinstance(e, TIMEOUT_ERRORS):
+            # Amostra censurada (o provedor demoraria pelo menos isto), mas mantém o p95 realista
+            record_latency(provider.name, (time.monotonic() - started) * 1000)
+        if not isinstance(e, GeminiCapacityExceeded):
+            record_outcome(provider.name, "error")
+        events.put(("error", index, e))
+        return
+    # Também os pedidos abandonados contam: o p95 reflete a latência real do provedor
+    record_latency(provider.name, (time.monotonic() - started) * 1000)
+    record_outcome(provider.name, "ok")
+    events.put(("done", index, result))
+
+
+def generate_with_hedging(prompt: str, label: str, base_result: dict, on_field=None, budget_seconds=None):
+    """
+    Resposta do primeiro provedor a terminar (principal, hedge ou, no fim do
+    orçamento, o LocalProvider), como AgentAnswer. budget_seconds limita o SLO
+    (ex: o que resta do prazo do relatório); <= 0 responde já com o LocalProvider.
+
+    on_field(chave, valor) recebe os campos em streaming de um único pedido (o
+    primeiro a enviar um campo), sempre na thread de quem chamou.
+    Se todos os pedidos falharem por falta de capacidade no Gemini, levanta
+    GeminiCapacityExceeded (a tarefa adia, como antes).
+    """
+    budget = settings.LLM_SLO_SECONDS if budget_seconds is None else min(settings.LLM_SLO_SECONDS, budget_seconds)
+    if budget <= 0:
+        text, usage = LocalProvider().generate(base_result)
+        return AgentAnswer(text, usage, LocalProvider.name, False, True)
+
+    first, hedge = choose_providers()
+    events = queue.Queue()
+    attempts = []
+    errors = {} # índice do pedido -> exceção
+    started = time.monotonic()
+    deadline = started + budget
+
+    def launch(provider):
+        attempts.append(provider)
+        timeout = min(settings.LLM_REQUEST_TIMEOUT_SECONDS, max(0.1, deadline - time.monotonic()))
+        _get_executor().submit(copy_context().run, _attempt, provider, len(attempts) - 1, prompt, label, events, timeout)
+
+    launch(first)
+    hedge_at = started + hedge_delay_seconds(first) if settings.LLM_HEDGING else None
+    hedge_pending = True # O segundo pedido ainda pode ser lançado (por tempo ou por erro)
+    field_owner = None
+
+    while True:
+        wake_at = min(deadline, hedge_at) if hedge_pending and hedge_at is not None else deadline
+        try:
+            kind, index, payload = events.get(timeout=max(0.0, wake_at - time.monotonic()))
+        except queue.Empty:
+            if time.monotonic() >= deadline:
+                break
+            logger.info(f"{first.name} sem resposta em {time.monotonic() - started:.1f}s para {label}: hedge para {hedge.name}.")
+            launch(hedge)
+            hedge_pending = False
+            continue
+
+        if kind == "field":
+            if field_owner is None:
+                field_owner = index
+            if index == field_owner and on_field:
+                try:
+                    on_field(*payload)
+                except Exception as e_field:
+                    logger.warning(f"Falha ao gravar campo parcial '{payload[0]}' para {label}: {e_field}")
+        elif kind == "done":
+            text, usage = payload
+            provider = attempts[index]
+            if index > 0:
+                record_outcome(provider.name, "hedge_won")
+            return AgentAnswer(text, usage, provider.name, len(attempts) > 1, False)
+        else:
+            errors[index] = payload
+            logger.warning(f"{attempts[index].name} falhou para {label}: {payload}")
+            # Sem capacidade no limitador, repetir o mesmo modelo não adianta
+            same_capacity = hedge is attempts[index] and isinstance(payload, GeminiCapacityExceeded)
+            if hedge_pending and not same_capacity:
+                launch(hedge)
+                hedge_pending = False
+            elif len(errors) == len(attempts):
+                break
+
+    if len(errors) == len(attempts) and all(isinstance(error, GeminiCapacityExceeded) for error in errors.values()):
+        raise next(iter(errors.values()))
+    timed_out = len(errors) < len(attempts)
+    if timed_out:
+        for index, provider in enumerate(attempts):
+            if index not in errors:
+                record_outcome(provider.name, "slo_exceeded")
+        logger.warning(f"Nenhum modelo respondeu em {budget:.1f}s para {label}: usando a narrativa padrão.")
+    text, usage = LocalProvider().generate(base_result)
+    return AgentAnswer(text, usage, LocalProvider.name, len(attempts) > 1, timed_out)
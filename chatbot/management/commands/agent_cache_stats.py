@@ -0,0 +1,11 @@
+# chatbot/management/commands/agent_cache_stats.py
+from django.core.management.base import BaseCommand
+from chatbot.cache import cache_stats
+
+
+class Command(BaseCommand):
+    help = "Mostra os contadores do cache de respostas do agente Gemini (hits, misses, evictions, hit rate)."
+
+    def handle(self, *args, **options):
+        for name, value in cache_stats().items():
+            self.stdout.write(f"{name}: {value}")
@@ -0,0 +1,72 @@
+# chatbot/management/commands/benchmark_pages.py
+import statistics
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from reports.models import ValuationReport
+
+
+class Command(BaseCommand):
+    help = "Mede o tempo de resposta (renderização incluída) do dashboard, histórico e detalhe de relatório."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cnpj', help="CNPJ do utilizador usado nas páginas (por omissão, o que tem mais relatórios)")
+        parser.add_argument('--iterations', type=int, default=50, help="Pedidos por página (padrão: 50)")
+        parser.add_argument('--warmup', type=int, default=3, help="Pedidos descartados antes de medir (padrão: 3)")
+
+    def _get_user(self, cnpj):
+        User = get_user_model()
+        if cnpj:
+            try:
+                return User.objects.get(cnpj=cnpj)
+            except User.DoesNotExist:
+                raise CommandError(f"Utilizador com CNPJ {cnpj} não encontrado.")
+        report = ValuationReport.objects.values('user_id').order_by().first()
+        user = User.objects.filter(pk=report['user_id']).first() if report else User.objects.first()
+        if user is None:
+            raise CommandError("Não há utilizadores no banco.")
+        return user
+
+    def handle(self, *args, **options):
+        user = self._get_user(options['cnpj'])
+        host = next((h for h in settings.ALLOWED_HOSTS if h and h != '*' and not h.startswith('.')), 'localhost')
+        client = Client(HTTP_HOST=host)
+        client.force_login(user)
+
+        pages = [
+            ('dashboard', reverse('chatbot:dashboard')),
+            ('histórico', reverse('reports:report_history')),
+        ]
+        latest = ValuationReport.objects.filter(user=user).order_by('-created_at').values_list('pk', flat=True).first()
+        if latest:
+            pages.append(('detalhe', reverse('reports:report_detail', args=[latest])))
+        else:
+            self.stdout.write(self.style.WARNING("Utilizador sem relatórios: página de detalhe ignorada."))
+
+        self.stdout.write(
+            f"Utilizador {user.cnpj}, {options['iterations']} pedidos por página, "
+            f"cache de templates {'ligado' if settings.TEMPLATE_CACHE else 'desligado'}"
+        )
+        self.stdout.write(f"{'página':<12}{'média':>10}{'p50':>10}{'p95':>10}{'máx':>10}{'queries':>9}")
+        for label, url in pages:
+            for _ in range(options['warmup']):
+                client.get(url)
+            timings = []
+            for _ in range(options['iterations']):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = client.get(url)
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(f"{url} respondeu {response.status_code}")
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(
+                f"{label:<12}{statistics.mean(timings):>8.2f}ms{statistics.median(timings):>8.2f}ms"
+                f"{p95:>8.2f}ms{timings[-1]:>8.2f}ms{len(queries):>9}"
+            )
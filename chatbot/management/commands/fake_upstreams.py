@@ -0,0 +1,80 @@
+# chatbot/management/commands/fake_upstreams.py
+import time
+from django.core.management.base import BaseCommand, CommandError
+from chatbot.fake_upstreams import MODES, Cassette, FakeGamma, FakeGemini, UpstreamProfile, start_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Sobe o Gemini e o Gamma simulados (latência e falhas configuráveis, cassetes record/replay). "
+        "Aponte a aplicação para eles com GEMINI_API_ENDPOINT e GAMMA_API_URL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--gemini-port', type=int, default=8701)
+        parser.add_argument('--gamma-port', type=int, default=8702)
+        parser.add_argument('--mode', choices=MODES, default='synthetic', help="synthetic (padrão), record ou replay")
+        parser.add_argument('--cassette', help="Ficheiro JSON da cassete (obrigatório em record/replay)")
+        parser.add_argument('--gemini-latency-ms', type=float, default=4000, help="Latência da resposta completa (padrão: 4000)")
+        parser.add_argument('--gemini-jitter-ms', type=float, default=1500)
+        parser.add_argument('--gemini-failure-rate', type=float, default=0.0, help="Fração de pedidos com erro (0-1)")
+        parser.add_argument('--gemini-failure-status', type=int, default=503)
+        parser.add_argument('--gemini-stream-chunks', type=int, default=8, help="Elementos por resposta em streaming")
+        parser.add_argument('--gamma-latency-ms', type=float, default=300)
+        parser.add_argument('--gamma-jitter-ms', type=float, default=100)
+        parser.add_argument('--gamma-failure-rate', type=float, default=0.0)
+        parser.add_argument('--gamma-failure-status', type=int, default=503)
+        parser.add_argument('--gamma-generation-seconds', type=float, default=20, help="Tempo até a apresentação ficar pronta")
+        parser.add_argument('--gamma-generation-jitter-seconds', type=float, default=5)
+        parser.add_argument('--recorded-latency', action='store_true', help="Em replay, usa a latência gravada na cassete")
+        parser.add_argument('--stats-interval', type=int, default=30, help="Segundos entre contagens de pedidos (0 = nunca)")
+
+    def handle(self, *args, **options):
+        mode = options['mode']
+        if mode != 'synthetic' and not options['cassette']:
+            raise CommandError(f"O modo {mode} precisa de --cassette.")
+        cassette = Cassette(options['cassette']) if mode != 'synthetic' else None
+        if mode == 'replay' and not len(cassette):
+            raise CommandError(f"Cassete {options['cassette']} vazia ou inexistente.")
+
+        def profile(prefix):
+            latency = None if options['recorded_latency'] else options[f'{prefix}_latency_ms']
+            return UpstreamProfile(
+                latency_ms=latency,
+                jitter_ms=options[f'{prefix}_jitter_ms'],
+                failure_rate=options[f'{prefix}_failure_rate'],
+                failure_status=options[f'{prefix}_failure_status'],
+            )
+
+        gemini = FakeGemini(profile('gemini'), mode, cassette, stream_chunks=options['gemini_stream_chunks'])
+        gamma = FakeGamma(
+            profile('gamma'), mode, cassette,
+            generation_seconds=options['gamma_generation_seconds'],
+            generation_jitter_seconds=options['gamma_generation_jitter_seconds'],
+        )
+        servers = [
+            start_server(gemini, options['host'], options['gemini_port']),
+            start_server(gamma, options['host'], options['gamma_port']),
+        ]
+
+        host = options['host']
+        self.stdout.write(self.style.SUCCESS(f"Upstreams simulados no modo {mode}. Configure a aplicação e os workers com:"))
+        self.stdout.write(f"  GEMINI_API_ENDPOINT=http://{host}:{servers[0].server_address[1]}")
+        self.stdout.write(f"  GAMMA_API_URL=http://{host}:{servers[1].server_address[1]}")
+        self.stdout.write("Ctrl+C para terminar.")
+
+        try:
+            while True:
+                time.sleep(options['stats_interval'] or 3600)
+                if options['stats_interval']:
+                    self.stdout.write(f"gemini: {gemini.stats} | gamma: {gamma.stats}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+            self.stdout.write(f"Final — gemini: {gemini.stats} | gamma: {gamma.stats}")
+            if mode == 'record':
+                self.stdout.write(f"{len(cassette)} interação(ões) gravada(s) em {options['cassette']}")
@@ -0,0 +1,11 @@
+# chatbot/management/commands/gemini_limiter_stats.py
+from django.core.management.base import BaseCommand
+from chatbot.gemini_limiter import limiter_stats
+
+
+class Command(BaseCommand):
+    help = "Mostra os contadores do limitador global do Gemini (esperas, rejeições, 429, tokens)."
+
+    def handle(self, *args, **options):
+        for name, value in limiter_stats().items():
+            self.stdout.write(f"{name}: {value}")
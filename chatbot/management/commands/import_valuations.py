@@ -0,0 +1,34 @@
+# chatbot/management/commands/import_valuations.py
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from chatbot.batch import create_batch, detect_format, BatchFormatError
+
+
+class Command(BaseCommand):
+    help = "Importa um ficheiro JSONL ou CSV de inputs como um lote de valuations para um utilizador (CNPJ)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('cnpj', help="CNPJ (login) do utilizador dono dos relatórios")
+        parser.add_argument('path', help="Caminho do ficheiro .jsonl ou .csv")
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help="Força o formato (por omissão, pela extensão)")
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        try:
+            user = User.objects.get(cnpj=options['cnpj'])
+        except User.DoesNotExist:
+            raise CommandError(f"Utilizador com CNPJ {options['cnpj']} não encontrado.")
+        try:
+            fmt = detect_format(options['path'], options['format'])
+        except BatchFormatError as e:
+            raise CommandError(str(e))
+
+        with open(options['path'], 'rb') as stream:
+            batch = create_batch(user, stream, fmt, source_name=options['path'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Lote #{batch.id}: {batch.total_rows} linha(s), {batch.accepted_count} relatório(s) despachado(s), "
+            f"{batch.rejected_count} recusada(s)."
+        ))
+        for error in batch.errors:
+            self.stdout.write(f"  linha {error['linha']}: {error['erro']}")
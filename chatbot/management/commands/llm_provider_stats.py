@@ -0,0 +1,15 @@
+# chatbot/management/commands/llm_provider_stats.py
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chatbot.llm_providers import provider_stats, choose_providers, hedge_delay_seconds
+
+
+class Command(BaseCommand):
+    help = "Mostra a latência observada (p50/p95) e os resultados de cada provedor do agente, e a ordem/atraso de hedge atuais."
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"SLO: {settings.LLM_SLO_SECONDS}s, hedge {'ligado' if settings.LLM_HEDGING else 'desligado'}")
+        for name, row in provider_stats().items():
+            self.stdout.write(f"{name}: " + ", ".join(f"{key}={value}" for key, value in row.items()))
+        first, hedge = choose_providers()
+        self.stdout.write(f"Ordem atual: {first.name} -> {hedge.name} (hedge após {hedge_delay_seconds(first):.1f}s)")
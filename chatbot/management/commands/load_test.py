@@ -0,0 +1,287 @@
+# chatbot/management/commands/load_test.py
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import redis
+import requests
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from django.urls import reverse
+from django.utils import timezone
+from chatbot.quota import sync_quota
+from chatbot.views import MAX_FREE_USES
+from reports.metrics import PERCENTILES, interpolated_percentile, stage_percentiles
+from reports.models import ReportMetrics, ValuationReport
+from valuation.celery import app
+from valuation.redis_client import get_redis
+
+BENCH_CNPJ_PREFIX = '99' # CNPJs 99000000000001, 99000000000002, ... (só números, fora do uso real)
+BENCH_INPUTS = {
+    'faturamento_anual': 1200000.0,
+    'custos_operacionais_mensais': 50000.0,
+    'aliquota_imposto_lucro_perc': 15.0,
+    'projecao_crescimento_anual_perc': 20.0,
+    'setor_atuacao': 'Tecnologia',
+    'tempo_operacao_anos': 4,
+    'diferencial_competitivo': 'Atendimento personalizado',
+}
+# Fila Celery -> campos de ReportMetrics com o tempo ocupado nos workers dessa fila
+QUEUE_BUSY_FIELDS = {
+    'gemini': ('valuation_ms',),
+    'gamma': ('gamma_post_ms', 'gamma_poll_http_ms'),
+}
+IN_FLIGHT = (ValuationReport.StatusChoices.PENDING, ValuationReport.StatusChoices.PROCESSING)
+
+
+class Command(BaseCommand):
+    help = (
+        "Teste de carga do pipeline: N utilizadores simultâneos fazem login, pedem o valuation em "
+        "/chatbot/api/calculate/ e esperam o relatório (e o Gamma) concluir. Mostra pedidos/s, "
+        "percentis de latência ponta a ponta e utilização dos workers. Use com o servidor e os "
+        "workers apontados para os upstreams simulados (comando fake_upstreams)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://localhost:8000', help="Endereço do servidor web (padrão: http://localhost:8000)")
+        parser.add_argument('--users', type=int, default=10, help="Utilizadores simultâneos (padrão: 10)")
+        parser.add_argument('--iterations', type=int, default=1, help=f"Simulações por utilizador (máx. {MAX_FREE_USES})")
+        parser.add_argument('--ramp-up', type=float, default=0, help="Segundos para distribuir a entrada dos utilizadores")
+        parser.add_argument('--timeout', type=float, default=300, help="Segundos máximos por relatório (padrão: 300)")
+        parser.add_argument('--poll-wait', type=int, default=20, help="Long-poll do endpoint de status, em segundos")
+        parser.add_argument('--skip-gamma', action='store_true', help="Conclusão = valuation pronto (não espera o Gamma)")
+        parser.add_argument('--same-inputs', action='store_true', help="Todos pedem os mesmos dados (exercita o cache do agente)")
+        parser.add_argument('--password', default='benchmark-load-test')
+        parser.add_argument('--output', help="Grava o resumo em JSON neste ficheiro (comparação entre execuções)")
+
+    def handle(self, *args, **options):
+        if not 1 <= options['iterations'] <= MAX_FREE_USES:
+            raise CommandError(f"--iterations deve estar entre 1 e {MAX_FREE_USES} (quota por utilizador).")
+        if options['users'] < 1:
+            raise CommandError("--users deve ser pelo menos 1.")
+
+        users = self._prepare_users(options['users'], options['password'])
+        self.base_url = options['base_url'].rstrip('/')
+        self.options = options
+        self._counter_lock = threading.Lock()
+        self.http_requests = 0
+        self.samples = []
+
+        self.stdout.write(
+            f"{len(users)} utilizador(es) x {options['iterations']} simulação(ões) contra {self.base_url}"
+            f"{' (sem esperar o Gamma)' if options['skip_gamma'] else ''}..."
+        )
+        started_at = timezone.now()
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(users)) as executor:
+            for index, user in enumerate(users):
+                delay = options['ramp_up'] * index / len(users)
+                executor.submit(self._simulate_user, index, user, delay)
+        wall_seconds = time.monotonic() - started
+
+        summary = self._summary(wall_seconds, started_at)
+        self._print_summary(summary)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2, default=str)
+            self.stdout.write(f"Resumo gravado em {options['output']}")
+
+    # --- Preparação ---
+
+    def _prepare_users(self, count, password):
+        """Cria (ou repõe) os utilizadores de benchmark: ativos, com quota zerada e sem limite de taxa acumulado."""
+        User = get_user_model()
+        users = []
+        for index in range(1, count + 1):
+            cnpj = f"{BENCH_CNPJ_PREFIX}{index:012d}"
+            user, created = User.objects.get_or_create(
+                cnpj=cnpj,
+                defaults={'email': f"benchmark{index}@example.invalid", 'razao_social': f"Empresa Benchmark {index}"},
+            )
+            user.set_password(password)
+            user.is_active = True
+            user.usage_count = 0
+            user.save(update_fields=['password', 'is_active', 'usage_count'])
+            users.append(user)
+        try:
+            client = get_redis()
+            client.delete(*[f"ratelimit:{user.id}" for user in users])
+            for user in users:
+                sync_quota(user.id)
+        except redis.RedisError as e:
+            raise CommandError(f"Redis indisponível para repor as quotas dos utilizadores de benchmark: {e}")
+        return users
+
+    # --- Utilizador simulado ---
+
+    def _request(self, session, method, url, **kwargs):
+        with self._counter_lock:
+            self.http_requests += 1
+        return session.request(method, url, **kwargs)
+
+    def _simulate_user(self, index, user, delay):
+        time.sleep(delay)
+        session = requests.Session()
+        login_url = self.base_url + reverse('users:login')
+        try:
+            self._request(session, 'GET', login_url, timeout=30)
+            response = self._request(session, 'POST', login_url, data={
+                'username': user.cnpj,
+                'password': self.options['password'],
+                'csrfmiddlewaretoken': session.cookies.get('csrftoken', ''),
+            }, headers={'Referer': login_url}, allow_redirects=False, timeout=30)
+            if response.status_code != 302:
+                raise RuntimeError(f"login respondeu {response.status_code}")
+        except Exception as e:
+            self._add_sample({'user': user.cnpj, 'outcome': 'login_error', 'error': str(e)})
+            return
+
+        for iteration in range(self.options['iterations']):
+            try:
+                self._add_sample(self._run_valuation(session, user, index, iteration))
+            except Exception as e:
+                self._add_sample({'user': user.cnpj, 'outcome': 'error', 'error': str(e)})
+
+    def _add_sample(self, sample):
+        with self._counter_lock:
+            self.samples.append(sample)
+
+    def _run_valuation(self, session, user, index, iteration):
+        inputs = dict(BENCH_INPUTS)
+        if not self.options['same_inputs']:
+            # Dados distintos por pedido: sem acertos no cache do agente nem deduplicação
+            inputs['faturamento_anual'] += 1000 * (index * MAX_FREE_USES + iteration + 1)
+
+        started = time.monotonic()
+        response = self._request(
+            session, 'POST', self.base_url + reverse('chatbot:api_calculate'),
+            json={'inputs': inputs}, headers={'Idempotency-Key': str(uuid.uuid4())}, timeout=30,
+        )
+        sample = {'user': user.cnpj, 'accepted_ms': (time.monotonic() - started) * 1000, 'http_status': response.status_code}
+        if response.status_code != 200:
+            sample.update(outcome='rejected', error=response.text[:200])
+            return sample
+        report_id = response.json()['report_id']
+        sample['report_id'] = report_id
+
+        status_url = self.base_url + reverse('chatbot:api_status')
+        poll_wait = self.options['poll_wait']
+        deadline = started + self.options['timeout']
+        etag = None
+        while time.monotonic() < deadline:
+            response = self._request(
+                session, 'GET', status_url,
+                params={'ids': report_id, 'wait': poll_wait},
+                headers={'If-None-Match': etag} if etag else {},
+                timeout=poll_wait + 15,
+            )
+            if response.status_code == 304:
+                continue
+            if response.status_code == 503: # Sem long-poll (Redis): polling simples
+                etag = None
+                time.sleep(1)
+                continue
+            response.raise_for_status()
+            etag = response.headers.get('ETag')
+            item = response.json()['reports'][0]
+            if item['status'] not in IN_FLIGHT and 'valuation_ms' not in sample:
+                sample['valuation_ms'] = (time.monotonic() - started) * 1000
+            if item['final'] or (self.options['skip_gamma'] and item['status'] not in IN_FLIGHT):
+                sample['e2e_ms'] = (time.monotonic() - started) * 1000
+                succeeded = item['status'] == ValuationReport.StatusChoices.SUCCESS and (
+                    self.options['skip_gamma'] or item['gamma_status'] == ValuationReport.GammaStatusChoices.COMPLETED
+                )
+                sample['outcome'] = 'ok' if succeeded else 'failed'
+                return sample
+        sample['outcome'] = 'timeout'
+        return sample
+
+    # --- Resultados ---
+
+    def _summary(self, wall_seconds, started_at):
+        outcomes = {}
+        for sample in self.samples:
+            outcomes[sample['outcome']] = outcomes.get(sample['outcome'], 0) + 1
+        ok = [sample for sample in self.samples if sample['outcome'] == 'ok']
+        latencies = {}
+        for field, samples in (('accepted_ms', self.samples), ('valuation_ms', self.samples), ('e2e_ms', ok)):
+            values = sorted(sample[field] for sample in samples if field in sample)
+            latencies[field] = {f'p{percentile}': interpolated_percentile(values, percentile) for percentile in PERCENTILES}
+            latencies[field]['max'] = values[-1] if values else None
+            latencies[field]['count'] = len(values)
+        report_ids = [sample['report_id'] for sample in self.samples if 'report_id' in sample]
+        return {
+            'users': self.options['users'],
+            'iterations': self.options['iterations'],
+            'wall_seconds': wall_seconds,
+            'outcomes': outcomes,
+            'completed_per_second': len(ok) / wall_seconds if wall_seconds else None,
+            'http_requests': self.http_requests,
+            'http_requests_per_second': self.http_requests / wall_seconds if wall_seconds else None,
+            'latency_ms': latencies,
+            'worker_utilisation': self._worker_utilisation(report_ids, wall_seconds),
+            'stages': stage_percentiles(since=started_at),
+            'errors': sorted({sample['error'] for sample in self.samples if sample.get('error')})[:10],
+        }
+
+    def _worker_utilisation(self, report_ids, wall_seconds):
+        """
+        Tempo ocupado por fila (somado de ReportMetrics) / (duração x concorrência
+        dos workers que consomem a fila, obtida do Celery). Sem workers a responder,
+        só o tempo ocupado é reportado.
+        """
+        fields = [field for queue_fields in QUEUE_BUSY_FIELDS.values() for field in queue_fields]
+        totals = ReportMetrics.objects.filter(report_id__in=report_ids).aggregate(**{field: Sum(field) for field in fields})
+        try:
+            inspector = app.control.inspect(timeout=2)
+            stats = inspector.stats() or {}
+            active_queues = inspector.active_queues() or {}
+        except Exception as e:
+            self.stderr.write(f"Não foi possível consultar os workers Celery: {e}")
+            stats, active_queues = {}, {}
+
+        utilisation = {}
+        for queue, queue_fields in QUEUE_BUSY_FIELDS.items():
+            busy_seconds = sum(totals[field] or 0 for field in queue_fields) / 1000
+            concurrency = sum(
+                stats.get(worker, {}).get('pool', {}).get('max-concurrency', 0)
+                for worker, queues in active_queues.items()
+                if any(item.get('name') == queue for item in queues)
+            )
+            utilisation[queue] = {
+                'busy_seconds': busy_seconds,
+                'concurrency': concurrency or None,
+                'utilisation': busy_seconds / (wall_seconds * concurrency) if concurrency and wall_seconds else None,
+            }
+        return utilisation
+
+    def _print_summary(self, summary):
+        def ms(value):
+            return f"{value:>9.0f}" if value is not None else f"{'-':>9}"
+
+        self.stdout.write(self.style.SUCCESS(f"\nDuração: {summary['wall_seconds']:.1f}s"))
+        self.stdout.write("Resultados: " + ", ".join(f"{name}={total}" for name, total in sorted(summary['outcomes'].items())))
+        completed = summary['completed_per_second']
+        self.stdout.write(f"Relatórios concluídos/s: {completed:.3f}" if completed is not None else "Relatórios concluídos/s: -")
+        self.stdout.write(f"Pedidos HTTP: {summary['http_requests']} ({summary['http_requests_per_second']:.2f}/s)")
+
+        self.stdout.write(f"\n{'latência (ms)':<22}{'n':>6}" + "".join(f"{'p' + str(p):>9}" for p in PERCENTILES) + f"{'máx':>9}")
+        labels = {'accepted_ms': 'aceitação (POST)', 'valuation_ms': 'valuation pronto', 'e2e_ms': 'ponta a ponta'}
+        for field, label in labels.items():
+            row = summary['latency_ms'][field]
+            self.stdout.write(f"{label:<22}{row['count']:>6}" + "".join(ms(row[f'p{p}']) for p in PERCENTILES) + ms(row['max']))
+
+        self.stdout.write(f"\n{'fila':<10}{'ocupado (s)':>12}{'concorrência':>14}{'utilização':>12}")
+        for queue, row in summary['worker_utilisation'].items():
+            utilisation = f"{row['utilisation']:.0%}" if row['utilisation'] is not None else '-'
+            self.stdout.write(f"{queue:<10}{row['busy_seconds']:>12.1f}{row['concurrency'] or '-':>14}{utilisation:>12}")
+
+        self.stdout.write(f"\n{'etapa (ReportMetrics)':<36}{'n':>6}" + "".join(f"{'p' + str(p):>9}" for p in PERCENTILES))
+        for row in summary['stages']:
+            if row['count']:
+                self.stdout.write(f"{row['label']:<36}{row['count']:>6}" + "".join(ms(row[f'p{p}']) for p in PERCENTILES))
+
+        for error in summary['errors']:
+            self.stdout.write(self.style.WARNING(f"Erro: {error}"))
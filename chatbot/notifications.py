@@ -0,0 +1,61 @@
+# chatbot/notifications.py
+"""
+Notificações de mudança de estado dos relatórios via Redis pub/sub.
+
+As tarefas Celery publicam um aviso curto (id do relatório) no canal do
+utilizador sempre que um relatório muda; o endpoint de status (SSE ou
+long-poll) fica inscrito nesse canal e só volta a consultar o banco
+quando chega um aviso. Falhas do Redis nunca interrompem as tarefas.
+"""
+import json
+import logging
+import time
+import redis
+from valuation.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+def user_channel(user_id) -> str:
+    return f"report-status:user:{user_id}"
+
+
+def publish_report_update(report_id, user_id, status=None):
+    """Avisa os ouvintes do utilizador que o relatório mudou."""
+    try:
+        message = json.dumps({"report_id": report_id, "status": status})
+        get_redis().publish(user_channel(user_id), message)
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível publicar atualização do Report {report_id}: {e}")
+
+
+class ReportUpdateListener:
+    """Inscrição no canal de um utilizador, filtrando os relatórios de interesse."""
+
+    def __init__(self, user_id, report_ids):
+        self.report_ids = {int(report_id) for report_id in report_ids}
+        self.pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(user_channel(user_id))
+
+    def wait(self, timeout: float) -> bool:
+        """Bloqueia até chegar um aviso sobre um dos relatórios (True) ou o timeout passar (False)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            message = self.pubsub.get_message(timeout=min(remaining, 1.0))
+            if not message:
+                continue
+            try:
+                report_id = json.loads(message["data"]).get("report_id")
+            except (TypeError, ValueError):
+                continue
+            if not self.report_ids or report_id in self.report_ids:
+                return True
+
+    def close(self):
+        try:
+            self.pubsub.close()
+        except redis.RedisError:
+            pass
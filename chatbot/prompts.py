@@ -0,0 +1,77 @@
+# chatbot/prompts.py
+"""
+Prompt do agente de valuation, separado em duas partes:
+
+- SYSTEM_INSTRUCTION: instruções fixas (papel, tarefa, regras e o roteiro
+  de slides do Gamma). É igual em todas as chamadas, vai como
+  system_instruction do modelo e pode ficar no context cache do Gemini
+  (chatbot/context_cache.py), por isso não é reenviada a cada pedido.
+- build_agent_prompt(): só os dados do pedido (inputs e números já
+  calculados pelo motor determinístico).
+
+A resposta é pedida em modo JSON com RESPONSE_SCHEMA: a API valida o
+formato e devolve apenas o objeto, sem cercas ```json```.
+
+Qualquer mudança aqui exige incrementar PROMPT_VERSION (invalida o cache de
+respostas e cria um novo context cache).
+"""
+
+PROMPT_VERSION = '3'
+
+SYSTEM_INSTRUCTION = """
+Você é um assistente de análise financeira especializado em valuation simplificado para pequenas e médias empresas (PMEs).
+
+Em cada pedido você recebe os dados informados por uma empresa e o valuation JÁ CALCULADO por um motor determinístico. Não refaça nenhuma conta e não altere nenhum valor.
+
+Sua tarefa é escrever a análise qualitativa:
+
+1. Resumo estruturado (campo resumo_para_gamma): redija, em uma ou duas frases cada,
+   - principais_drivers: os principais drivers de valor;
+   - pontos_fortes: os pontos fortes, destacando o principal diferencial informado;
+   - pontos_atencao: os pontos de atenção e riscos.
+2. Prompt para o Gamma (campo prompt_gamma): um prompt de texto otimizado para a API do Gamma (gamma.app) gerar uma apresentação de 5-7 slides sobre a empresa e seu valuation, neste roteiro:
+   "Crie uma apresentação concisa sobre a empresa <razão social>. Use um tom profissional e visual atraente. Slide 1: Título 'Valuation Estimado - <razão social>'. Slide 2: Sobre a Empresa (Setor, Tempo de Operação, Principal Diferencial). Slide 3: Snapshot Financeiro. Slide 4: Valuation Estimado (<valuation estimado>, Múltiplo de Faturamento <múltiplo>x). Slide 5: Análise Resumida (Principais Drivers, Pontos Fortes e Pontos de Atenção). Slide 6: Próximos Passos (Sugira foco em crescimento sustentável e otimização de custos)."
+   Substitua os marcadores <...> pelos dados do pedido.
+
+Regras:
+- Use os valores monetários exatamente como informados no pedido (formato "R$ X.XXX.XXX,XX").
+- Escreva em português do Brasil.
+- Responda apenas com o objeto JSON do esquema pedido, sem explicações ou comentários.
+""".strip()
+
+# Esquema da resposta (subconjunto OpenAPI aceite por response_schema)
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "resumo_para_gamma": {
+            "type": "object",
+            "properties": {
+                "principais_drivers": {"type": "string"},
+                "pontos_fortes": {"type": "string"},
+                "pontos_atencao": {"type": "string"},
+            },
+            "required": ["principais_drivers", "pontos_fortes", "pontos_atencao"],
+        },
+        "prompt_gamma": {"type": "string"},
+    },
+    "required": ["resumo_para_gamma", "prompt_gamma"],
+}
+
+
+def build_agent_prompt(inputs_data: dict, user_razao_social: str, base_result: dict) -> str:
+    """Parte variável do prompt: dados da empresa e números calculados pelo motor."""
+    inputs_str = "\n".join(f"- {key.replace('_', ' ').capitalize()}: {value}" for key, value in inputs_data.items())
+    resumo = base_result["resumo_para_gamma"]
+    calculo = base_result["calculo"]
+    return f"""Empresa: "{user_razao_social}"
+
+Dados informados:
+{inputs_str}
+
+Valuation já calculado:
+- {resumo['snapshot_financeiro']}
+- Setor de referência: {calculo['setor_referencia']} (faixa de múltiplos {calculo['faixa_multiplo'][0]}x - {calculo['faixa_multiplo'][1]}x)
+- Múltiplo aplicado: {calculo['multiplo']}x
+- Valuation Estimado: {resumo['valuation_estimado']}
+- Metodologia: {base_result['metodologia_usada']}
+- Principal diferencial: {resumo['diferencial']}"""
@@ -0,0 +1,167 @@
+# chatbot/quota.py
+"""
+Quota de simulações e limite de taxa por utilizador, atómicos no Redis.
+
+Quota: o contador quota:used:<user_id> soma as simulações já consumidas
+(CustomUser.usage_count) e as reservadas por relatórios ainda em curso.
+A reserva é feita no pedido, num script Lua (verifica o limite e
+incrementa numa só operação), por isso pedidos paralelos não conseguem
+ultrapassar o limite. O relatório guarda quota_reserved=True; se falhar,
+a tarefa devolve a reserva (release_quota). Quando a chave não existe
+(primeiro uso ou expirou), é semeada a partir do banco, que continua a
+ser a fonte da verdade. Quem altera usage_count fora do pipeline (ex: o
+admin de utilizadores) chama sync_quota para reconciliar o contador.
+
+Limite de taxa: token bucket por utilizador (ratelimit:<user_id>), também
+em Lua, verificado antes de qualquer escrita no banco ou tarefa Celery.
+"""
+import logging
+import time
+import redis
+from django.conf import settings
+from valuation.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+QUOTA_KEY_TTL_SECONDS = 24 * 3600 # Depois disto a chave é semeada de novo a partir do banco
+
+# KEYS[1] = contador; ARGV = pedido, limite, valor do banco (semente), TTL
+# Reserva até ARGV[1] unidades sem passar do limite; retorna quantas concedeu,
+# ou -1 se a chave não existe e não foi enviada semente (ARGV[3] = -1)
+RESERVE_SCRIPT = """
+local used = redis.call('GET', KEYS[1])
+if not used then
+    if tonumber(ARGV[3]) < 0 then
+        return -1
+    end
+    used = tonumber(ARGV[3])
+    -- Semente já com TTL: mesmo sem conceder nada, a chave volta a ser lida do banco depois
+    redis.call('SET', KEYS[1], used, 'EX', tonumber(ARGV[4]))
+else
+    used = tonumber(used)
+end
+local granted = math.min(tonumber(ARGV[1]), tonumber(ARGV[2]) - used)
+if granted <= 0 then
+    return 0
+end
+redis.call('INCRBY', KEYS[1], granted)
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+return granted
+"""
+
+# Devolve ARGV[1] unidades (nunca abaixo de zero); sem chave, nada a fazer
+RELEASE_SCRIPT = """
+local used = redis.call('GET', KEYS[1])
+if not used then
+    return 0
+end
+local value = math.max(0, tonumber(used) - tonumber(ARGV[1]))
+redis.call('SET', KEYS[1], value, 'KEEPTTL')
+return value
+"""
+
+# KEYS[1] = bucket; ARGV = capacidade, tokens por segundo, agora (s), custo
+# Retorna {1, 0} se permitido ou {0, segundos até haver token}
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = math.ceil((cost - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, retry_after}
+"""
+
+_scripts = {}
+
+
+def _script(source):
+    # register_script faz EVALSHA (e EVAL se o script ainda não estiver no servidor)
+    client = get_redis()
+    key = (id(client), source)
+    if key not in _scripts:
+        _scripts[key] = client.register_script(source)
+    return _scripts[key]
+
+
+def quota_key(user_id) -> str:
+    return f"quota:used:{user_id}"
+
+
+def _database_usage(user_id) -> int:
+    """Consumidas (usage_count) + reservadas por relatórios ainda em curso."""
+    from django.contrib.auth import get_user_model
+    from reports.models import ValuationReport
+
+    usage_count = get_user_model().objects.filter(pk=user_id).values_list('usage_count', flat=True).first() or 0
+    in_flight = ValuationReport.objects.filter(
+        user_id=user_id,
+        quota_reserved=True,
+        status__in=[ValuationReport.StatusChoices.PENDING, ValuationReport.StatusChoices.PROCESSING],
+    ).count()
+    return usage_count + in_flight
+
+
+def reserve_quota(user_id, limit: int, count: int = 1) -> int:
+    """
+    Reserva até `count` simulações sem ultrapassar `limit`. Retorna quantas
+    foram concedidas (0 = limite atingido). Se o Redis estiver indisponível,
+    decide pelo banco (sem garantia contra pedidos simultâneos).
+    """
+    reserve = _script(RESERVE_SCRIPT)
+    try:
+        # Caminho normal: só o Redis. O banco só é lido para semear a chave.
+        granted = int(reserve(keys=[quota_key(user_id)], args=[count, limit, -1, QUOTA_KEY_TTL_SECONDS]))
+        if granted < 0:
+            granted = int(reserve(keys=[quota_key(user_id)], args=[count, limit, _database_usage(user_id), QUOTA_KEY_TTL_SECONDS]))
+        return granted
+    except redis.RedisError as e:
+        logger.warning(f"Redis indisponível ao reservar quota do user {user_id}: {e}. Usando o banco.")
+        return max(0, min(count, limit - _database_usage(user_id)))
+
+
+def release_quota(user_id, count: int = 1):
+    """Devolve reservas de relatórios que falharam (ou não chegaram a ser criados)."""
+    if count <= 0:
+        return
+    try:
+        _script(RELEASE_SCRIPT)(keys=[quota_key(user_id)], args=[count])
+    except redis.RedisError as e:
+        logger.warning(f"Redis indisponível ao devolver quota do user {user_id}: {e}")
+
+
+def sync_quota(user_id) -> int:
+    """Reconcilia o contador do Redis com o banco. Retorna o valor gravado."""
+    value = _database_usage(user_id)
+    get_redis().set(quota_key(user_id), value, ex=QUOTA_KEY_TTL_SECONDS)
+    return value
+
+
+def check_rate_limit(user_id, cost: int = 1):
+    """
+    Token bucket do utilizador: RATE_LIMIT_BURST pedidos de uma vez e
+    RATE_LIMIT_PER_MINUTE em regime contínuo. Retorna (permitido, retry_after).
+    Falha aberta se o Redis estiver indisponível.
+    """
+    capacity = settings.RATE_LIMIT_BURST
+    rate = settings.RATE_LIMIT_PER_MINUTE / 60.0
+    try:
+        allowed, retry_after = _script(TOKEN_BUCKET_SCRIPT)(
+            keys=[f"ratelimit:{user_id}"], args=[capacity, rate, time.time(), cost]
+        )
+    except redis.RedisError as e:
+        logger.warning(f"Redis indisponível no limite de taxa do user {user_id}: {e}")
+        return True, 0
+    return bool(allowed), int(retry_after)
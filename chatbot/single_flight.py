@@ -0,0 +1,110 @@
+# chatbot/single_flight.py
+"""
+Coalescência (single-flight) de chamadas idênticas ao agente Gemini entre workers.
+
+Quando vários relatórios com os mesmos inputs são processados ao mesmo
+tempo (lote com linhas repetidas, pedidos quase simultâneos de contas
+diferentes da mesma empresa), só o primeiro worker chama o Gemini; os
+outros esperam pelo resultado dele em vez de gastar quota com a mesma
+pergunta.
+
+Estrutura no Redis (a chave é o hash de chatbot/cache.agent_cache_key):
+- agent_flight:lock:<hash>   -> token do worker que está a chamar (com TTL)
+- agent_flight:result:<hash> -> JSON do resultado, por pouco tempo
+
+Se o líder falhar, a trava é libertada sem resultado e o próximo worker à
+espera assume a chamada. Se o Redis estiver fora, cada worker chama sozinho.
+"""
+import json
+import logging
+import time
+import uuid
+import redis
+from django.conf import settings
+from valuation.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+LOCK_PREFIX = "agent_flight:lock:"
+RESULT_PREFIX = "agent_flight:result:"
+RESULT_TTL_SECONDS = 300 # Só precisa de durar até os workers à espera o lerem
+POLL_SECONDS = 0.5
+
+# Liberta a trava apenas se ainda for deste worker (o TTL pode ter expirado e outro a ter)
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_scripts = {}
+
+
+def _release_lock(client, key, token):
+    script_key = id(client)
+    if script_key not in _scripts:
+        _scripts[script_key] = client.register_script(RELEASE_SCRIPT)
+    try:
+        _scripts[script_key](keys=[LOCK_PREFIX + key], args=[token])
+    except redis.RedisError as e:
+        logger.warning(f"Não foi possível libertar a trava single-flight ({key[:12]}...): {e}")
+
+
+def _wait_for_leader(client, key, deadline):
+    """Espera o resultado do líder. Retorna o resultado, ou None se a trava ficou livre sem ele ou o prazo passou."""
+    while time.monotonic() < deadline:
+        raw, locked = client.pipeline().get(RESULT_PREFIX + key).exists(LOCK_PREFIX + key).execute()
+        if raw is not None:
+            return json.loads(raw)
+        if not locked:
+            return None
+        time.sleep(POLL_SECONDS)
+    return None
+
+
+def run_single_flight(key: str, compute, max_wait: float = None):
+    """
+    Executa compute() uma única vez por chave entre todos os workers.
+    Retorna (resultado, partilhado): partilhado=True quando o resultado veio
+    de outro worker. Resultados com "error" não são partilhados. Exceções de
+    compute() (ex: GeminiCapacityExceeded) propagam normalmente.
+
+    max_wait limita a espera pelo líder (ex: ao que sobra do prazo depois de
+    reservar a própria chamada); <= 0 chama compute() sem coalescer.
+    """
+    wait_seconds = settings.AGENT_SINGLE_FLIGHT_WAIT_SECONDS
+    if max_wait is not None:
+        wait_seconds = min(wait_seconds, max_wait)
+    if wait_seconds <= 0:
+        return compute(), False
+
+    client = get_redis()
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + wait_seconds
+    acquired = False
+    while not acquired:
+        try:
+            acquired = client.set(LOCK_PREFIX + key, token, nx=True, ex=settings.AGENT_SINGLE_FLIGHT_LOCK_SECONDS)
+            if not acquired:
+                shared = _wait_for_leader(client, key, deadline)
+                if shared is not None:
+                    return shared, True
+        except (redis.RedisError, ValueError) as e:
+            logger.warning(f"Single-flight indisponível ({key[:12]}...): {e}")
+            return compute(), False
+        if not acquired and time.monotonic() >= deadline:
+            logger.info(f"Single-flight: espera esgotada ({key[:12]}...). Chamando o Gemini sem coalescer.")
+            return compute(), False
+        # Sem resultado e trava livre: o líder falhou, este worker tenta assumir a chamada
+
+    try:
+        result = compute()
+        if not result.get("error"):
+            try:
+                client.set(RESULT_PREFIX + key, json.dumps(result, ensure_ascii=False), ex=RESULT_TTL_SECONDS)
+            except redis.RedisError as e:
+                logger.warning(f"Não foi possível partilhar o resultado single-flight ({key[:12]}...): {e}")
+        return result, False
+    finally:
+        _release_lock(client, key, token)
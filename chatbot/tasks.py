@@ -1,117 +1,326 @@
 # chatbot/tasks.py
 from celery import shared_task
-from reports.models import ValuationReport
+from celery.exceptions import Retry, SoftTimeLimitExceeded
+from reports.models import ValuationReport, ReportMetrics
 from django.db.models import F
-from .agents import run_valuation_agent
+from django.db.models.functions import Coalesce
+from .agents import run_valuation_agent, apply_agent_field, PROMPT_VERSION
+from .gemini_client import GEMINI_MODEL_NAME
+from .llm_providers import PRIMARY_PROVIDER_NAME
+from .cache import agent_cache_key, get_cached_agent_result, store_agent_result
+from .valuation_engine import calcular_valuation, gerar_prompt_gamma
+from . import gamma_client
+from .notifications import publish_report_update
+from .quota import release_quota
+from .gemini_limiter import GeminiCapacityExceeded, record_deferral
+from .single_flight import run_single_flight
+from .deadlines import TimeoutReason, fits_before_deadline, mark_timeout, remaining_seconds, stage_budget
+from reports.metrics import record_metrics, elapsed_ms, ms_between
+from reports.page_cache import invalidate_report_page
+import copy
 import requests
-import time
 import logging
+import time
+from datetime import timedelta
+from django.utils import timezone
 from django.conf import settings
 from django.apps import apps # <-- ADICIONADO PARA OBTER O MODELO DE UTILIZADOR
 import random # <-- ADICIONADO PARA RETRY DELAY
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
+from users.mail import enqueue_email, render_email
 
 logger = logging.getLogger(__name__)
 
-@shared_task
-def process_valuation_request(report_id):
+ReportMetricsSource = ReportMetrics.AgentSourceChoices
+
+# Folga antes do soft_time_limit para gravar o resultado e disparar o Gamma
+TASK_SOFT_LIMIT_MARGIN_SECONDS = 10
+
+
+def _notify(report):
+    """Avisa o dashboard (SSE/long-poll) que o relatório mudou e descarta a página em cache."""
+    invalidate_report_page(report.id, report.user_id)
+    publish_report_update(report.id, report.user_id, report.status)
+
+
+@shared_task(bind=True, max_retries=None)
+def process_valuation_request(self, report_id):
     """
-    Tarefa do Celery para processar o valuation usando o agente Gemini
-    e disparar a geração Gamma.
+    Tarefa do Celery para processar o valuation: calcula os números com o
+    motor determinístico, pede a narrativa ao agente Gemini e dispara a
+    geração Gamma.
+
+    Sem capacidade no limitador do Gemini (gemini_limiter) a tarefa é
+    adiada até GEMINI_DEFER_MAX_RETRIES vezes; depois disso o relatório
+    segue com a narrativa padrão do motor.
+
+    Tempos de cada etapa e tokens usados vão para ReportMetrics (reports/metrics.py).
+    O agente só recebe o que resta do prazo do relatório (chatbot/deadlines.py)
+    depois de reservar o tempo do POST Gamma e do e-mail.
     """
     user = None # Inicializa user
+    task_started = time.monotonic()
     try:
         report = ValuationReport.objects.get(id=report_id)
         report.status = ValuationReport.StatusChoices.PROCESSING
         report.save(update_fields=['status']) # Salva apenas o status por enquanto
+        _notify(report)
+
+        metrics = {'valuation_retries': self.request.retries}
+        if not self.request.retries:
+            # Espera na fila só na primeira execução (as seguintes são adiamentos)
+            metrics['processing_started_at'] = timezone.now()
+            metrics['queue_wait_ms'] = ms_between(report.created_at, metrics['processing_started_at'])
 
         user = report.user
         inputs = report.inputs_data
+        if (remaining_seconds(report.deadline_at) or 0) < 0:
+            # Ficou na fila além do prazo: segue só com os números e a narrativa padrão
+            mark_timeout(report_id, TimeoutReason.QUEUE)
+        later_stages = settings.GAMMA_START_BUDGET_SECONDS + settings.EMAIL_BUDGET_SECONDS
+
+        # 1. Calcula os números com o motor determinístico e salva já como
+        #    primeiro resultado (o utilizador vê o valuation sem esperar a IA)
+        stage_started = time.monotonic()
+        base_result = calcular_valuation(inputs, user.razao_social)
+        report.save(update_fields=report.set_result_data(copy.deepcopy(base_result)))
+        metrics['engine_ms'] = elapsed_ms(stage_started)
+        _notify(report)
+        logger.info(f"Valuation determinístico salvo para Report {report_id}: {base_result['valuation_calculado']}")
+
+        # 2. Chama o Agente Gemini apenas para a narrativa e o prompt do Gamma
+        #    (antes consulta o cache: o mesmo pedido reenviado não gasta quota)
+        cache_key = agent_cache_key(inputs, user.razao_social, GEMINI_MODEL_NAME, PROMPT_VERSION)
+        agent_result = get_cached_agent_result(cache_key) if settings.AGENT_CACHE_ENABLED else None
+        if agent_result is not None:
+            metrics['agent_source'] = ReportMetricsSource.CACHE
+            logger.info(f"Resposta do Agente Gemini obtida do cache para Report {report_id}")
+        else:
+            logger.info(f"Iniciando chamada ao Agente Gemini para Report {report_id}")
+
+            def save_partial_field(key, value):
+                # Streaming: cada campo da narrativa aparece no relatório assim que fica completo
+                apply_agent_field(report.result_data, key, value)
+                report.save(update_fields=['result_data'])
+                logger.info(f"Campo '{key}' do Agente Gemini salvo para Report {report_id}")
+
+            def call_agent():
+                return run_valuation_agent(
+                    inputs_data=inputs,
+                    user_razao_social=user.razao_social,
+                    base_result=base_result,
+                    on_field=save_partial_field,
+                    on_usage=metrics.update, # Tokens de usage_metadata
+                    budget_seconds=stage_budget(report.deadline_at, settings.LLM_SLO_SECONDS, reserve=later_stages),
+                    on_timeout=lambda: mark_timeout(report_id, TimeoutReason.AGENT),
+                )
 
-        # 1. Chama o Agente Gemini
-        logger.info(f"Iniciando chamada ao Agente Gemini para Report {report_id}")
-        agent_result = run_valuation_agent(inputs_data=inputs, user_razao_social=user.razao_social)
-        logger.info(f"Agente Gemini retornou para Report {report_id}")
+            # Quem espera por outro worker ainda precisa de tempo para a própria chamada
+            # (fila do limitador + SLO) dentro do soft_time_limit e do prazo do relatório
+            own_call = settings.GEMINI_LIMITER_MAX_WAIT + settings.LLM_SLO_SECONDS
+            task_left = (
+                (self.soft_time_limit or settings.CELERY_TASK_SOFT_TIME_LIMIT)
+                - (time.monotonic() - task_started) - TASK_SOFT_LIMIT_MARGIN_SECONDS
+            )
+            flight_wait = stage_budget(report.deadline_at, task_left - own_call, reserve=later_stages + own_call)
 
-        # 2. Salva o resultado (incluindo possíveis erros do agente)
-        report.result_data = agent_result # Sobrescreve/define result_data
+            stage_started = time.monotonic()
+            try:
+                # Pedidos idênticos em curso noutros workers: só um chama o Gemini
+                agent_result, shared = run_single_flight(cache_key, call_agent, max_wait=flight_wait)
+                metrics['agent_source'] = ReportMetricsSource.SHARED if shared else ReportMetricsSource.GEMINI
+                if shared:
+                    logger.info(f"Resposta do Agente Gemini partilhada por outro worker para Report {report_id}")
+            except GeminiCapacityExceeded as e:
+                countdown = e.retry_after + random.randint(0, settings.GEMINI_DEFER_JITTER_SECONDS)
+                # Só adia se depois do adiamento ainda couber o agente e as etapas seguintes
+                if (self.request.retries < settings.GEMINI_DEFER_MAX_RETRIES
+                        and fits_before_deadline(report.deadline_at, countdown, reserve=settings.LLM_SLO_SECONDS + later_stages)):
+                    # Adia em vez de falhar; o relatório continua com os números do motor
+                    record_deferral()
+                    record_metrics(report_id, valuation_retries=self.request.retries + 1)
+                    logger.info(f"Gemini sem capacidade ({e.reason}) para Report {report_id}. Adiando {countdown}s.")
+                    raise self.retry(countdown=countdown)
+                if self.request.retries < settings.GEMINI_DEFER_MAX_RETRIES:
+                    mark_timeout(report_id, TimeoutReason.AGENT)
+                agent_result = {"error": str(e)}
+            metrics['gemini_ms'] = elapsed_ms(stage_started)
+            logger.info(f"Agente Gemini retornou para Report {report_id}")
+            # A chave é a do modelo principal: só as respostas dele vão para o cache (nem erros,
+            # nem o modelo de reserva, nem a narrativa padrão do SLO). Quem recebeu a resposta
+            # de outro worker (single-flight) não grava; o worker que chamou o Gemini já gravou.
+            if (settings.AGENT_CACHE_ENABLED and metrics.get('agent_provider') == PRIMARY_PROVIDER_NAME
+                    and not agent_result.get("error")):
+                store_agent_result(cache_key, agent_result)
+
+        # 3. Se a IA falhar, o relatório continua válido com a narrativa padrão do motor
+        if agent_result.get("error"):
+            logger.warning(f"Agente Gemini falhou para Report {report_id}: {agent_result.get('error')}. Usando narrativa padrão.")
+            agent_result = dict(base_result, prompt_gamma=gerar_prompt_gamma(base_result), narrativa_padrao=True)
+            metrics['agent_source'] = ReportMetricsSource.FALLBACK
+        elif agent_result.get("narrativa_padrao"):
+            # Nenhum modelo respondeu dentro do SLO (llm_providers.generate_with_hedging)
+            metrics['agent_source'] = ReportMetricsSource.FALLBACK
+        result_fields = report.set_result_data(agent_result) # Sobrescreve/define result_data (e colunas derivadas)
 
         gamma_generation_triggered = False # Flag para saber se tentamos gerar
 
-        # 3. Define o status do relatório baseado no resultado do agente Gemini
-        if agent_result.get("error"):
-            report.status = ValuationReport.StatusChoices.FAILED
-            logger.error(f"Agente Gemini falhou para Report {report_id}: {agent_result.get('error')}")
+        # 4. Define o status do relatório (os números do motor são sempre válidos)
+        report.status = ValuationReport.StatusChoices.SUCCESS
+        logger.info(f"Valuation concluído com sucesso para Report {report_id}.")
+
+        # 5. Atualiza o contador de uso
+        if user: # Garante que user não é None
+            # Obtém a classe do modelo de utilizador a partir de settings.AUTH_USER_MODEL
+            User = apps.get_model(settings.AUTH_USER_MODEL)
+            # Atualiza diretamente no banco de dados para evitar race conditions
+            User.objects.filter(pk=user.pk).update(usage_count=F('usage_count') + 1)
+            # A reserva de quota (se houver) passa a consumo: o contador do Redis já a conta
+            report.quota_reserved = False
+            logger.info(f"Contador de uso incrementado para user {user.pk}")
         else:
-            report.status = ValuationReport.StatusChoices.SUCCESS
-            logger.info(f"Agente Gemini concluiu com sucesso para Report {report_id}.")
-
-            # 4. Atualiza o contador de uso APENAS em caso de sucesso do Gemini
-            if user: # Garante que user não é None
-                # Obtém a classe do modelo de utilizador a partir de settings.AUTH_USER_MODEL
-                User = apps.get_model(settings.AUTH_USER_MODEL)
-                # Atualiza diretamente no banco de dados para evitar race conditions
-                User.objects.filter(pk=user.pk).update(usage_count=F('usage_count') + 1)
-                logger.info(f"Contador de uso incrementado para user {user.pk}")
-            else:
-                 logger.warning(f"Objeto User não disponível para incrementar usage_count no Report {report_id}")
-
+             logger.warning(f"Objeto User não disponível para incrementar usage_count no Report {report_id}")
+
+
+        # 6. Prepara para disparar Gamma: Adiciona status pendente
+        #    (só se o POST ainda couber no prazo, deixando tempo para o e-mail)
+        gamma_fits = stage_budget(report.deadline_at, settings.GAMMA_START_BUDGET_SECONDS, reserve=settings.EMAIL_BUDGET_SECONDS) > 0
+        if report.result_data and report.result_data.get('prompt_gamma') and not gamma_fits:
+            mark_timeout(report_id, TimeoutReason.GAMMA_START)
+            logger.warning(f"Sem tempo para a apresentação Gamma do Report {report_id}. Geração Gamma não será disparada.")
+        elif report.result_data and report.result_data.get('prompt_gamma'):
+            report.gamma_status = ValuationReport.GammaStatusChoices.PENDING # Indica que vamos tentar gerar
+            gamma_generation_triggered = True
+            logger.info(f"Gamma status definido como 'pending' para Report {report_id}")
+        else:
+             logger.warning(f"Prompt Gamma não encontrado no resultado do Report {report_id}. Geração Gamma não será disparada.")
 
-            # 5. Prepara para disparar Gamma: Adiciona status pendente
-            if report.result_data and report.result_data.get('prompt_gamma'):
-                report.result_data['gamma_status'] = 'pending' # Indica que vamos tentar gerar
-                gamma_generation_triggered = True
-                logger.info(f"Gamma status definido como 'pending' para Report {report_id}")
-            else:
-                 logger.warning(f"Prompt Gamma não encontrado na resposta do Gemini para Report {report_id}. Geração Gamma não será disparada.")
 
+        # 7. Salva o resultado final e o status do relatório (e gamma_status se aplicável)
+        report.save(update_fields=result_fields + ['status', 'gamma_status', 'quota_reserved'])
+        _notify(report)
+        logger.info(f"Resultado final e status salvos para Report {report_id}")
 
-        # 6. Salva o resultado final do Gemini e o status do relatório (e gamma_status se aplicável)
-        report.save(update_fields=['result_data', 'status'])
-        logger.info(f"Resultado Gemini e status final salvos para Report {report_id}")
+        metrics['processing_finished_at'] = timezone.now()
+        metrics['valuation_ms'] = elapsed_ms(task_started)
+        if not gamma_generation_triggered:
+            metrics['end_to_end_ms'] = ms_between(report.created_at, metrics['processing_finished_at'])
+        record_metrics(report_id, **metrics)
 
 
-        # 7. Dispara a tarefa Gamma APENAS SE o Gemini teve sucesso e gerou prompt
+        # 8. Dispara a tarefa Gamma APENAS SE existe prompt
         if gamma_generation_triggered:
             logger.info(f"Disparando tarefa generate_gamma_presentation para Report {report_id}")
             generate_gamma_presentation.delay(report_id)
 
     # REMOVIDOS BLOCOS except DUPLICADOS DAQUI
 
+    except Retry:
+        raise # Adiamento pedido acima (self.retry), não é falha
     except ValuationReport.DoesNotExist:
         logger.error(f"Erro CRÍTICO: Relatório {report_id} não encontrado em process_valuation_request.")
     except Exception as e:
         logger.exception(f"Erro CRÍTICO inesperado em process_valuation_request para Report {report_id}: {e}")
+        if isinstance(e, SoftTimeLimitExceeded):
+            mark_timeout(report_id, TimeoutReason.VALUATION_TASK)
         try:
             # Tenta marcar o relatório como falho se ainda existir
             report_qs = ValuationReport.objects.filter(id=report_id)
+            # Devolve a reserva de quota uma única vez (UPDATE condicional)
+            if report_qs.filter(quota_reserved=True).update(quota_reserved=False):
+                release_quota(report_qs.values_list('user_id', flat=True).first())
             if report_qs.exists():
                 report_qs.update(
                     status=ValuationReport.StatusChoices.FAILED,
-                    result_data={"error": f"Erro inesperado na tarefa Celery: {str(e)}"}
+                    result_data={"error": f"Erro inesperado na tarefa Celery: {str(e)}"},
+                    valuation_calculado=None,
+                    has_error=True,
+                )
+                user_id = report_qs.values_list('user_id', flat=True).first()
+                invalidate_report_page(report_id, user_id)
+                publish_report_update(report_id, user_id, ValuationReport.StatusChoices.FAILED)
+                finished_at = timezone.now()
+                record_metrics(
+                    report_id,
+                    processing_finished_at=finished_at,
+                    valuation_ms=elapsed_ms(task_started),
+                    end_to_end_ms=ms_between(report_qs.values_list('created_at', flat=True).first(), finished_at),
                 )
         except Exception as inner_e:
              logger.error(f"Erro ao tentar marcar Report {report_id} como falho após exceção principal: {inner_e}")
 
 
-# --- TAREFA PARA GERAR APRESENTAÇÃO GAMMA (COM RETENTATIVAS) ---
-@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+# --- GERAÇÃO GAMMA: MÁQUINA DE ESTADOS SEM BLOQUEAR O WORKER ---
+# generate_gamma_presentation inicia a geração (POST) e agenda a primeira
+# consulta; cada poll_gamma_generation faz UM GET de status e, se ainda não
+# terminou, reagenda-se com countdown. O estado (generation_id, tentativas e
+# prazo) fica no próprio relatório, então o worker só fica ocupado durante
+# a chamada HTTP.
+GAMMA_TIMEOUT_SECONDS = 480 # 8 minutos para a geração terminar
+GAMMA_POLL_MIN_INTERVAL = 5 # primeiras consultas rápidas...
+GAMMA_POLL_MAX_INTERVAL = 60 # ...e depois no máximo 1 por minuto
+GAMMA_POLL_BACKOFF = 1.5
+
+
+def next_gamma_poll_interval(attempt):
+    """Intervalo (s) até a próxima consulta: 5, 7, 11, 16, 25, 37, 56, 60, 60..."""
+    return int(min(GAMMA_POLL_MAX_INTERVAL, GAMMA_POLL_MIN_INTERVAL * (GAMMA_POLL_BACKOFF ** attempt)))
+
+
+def _mark_gamma_failed(report, timeout_reason=None):
+    """
+    Marca a geração Gamma como falha definitiva (apenas se ainda estava
+    pendente). Com timeout_reason regista também o estouro de prazo.
+    """
+    if report is None:
+        return
+    # UPDATE condicional de uma coluna: não reescreve o result_data nem corre contra um 'completed'
+    updated = ValuationReport.objects.filter(
+        pk=report.pk, gamma_status=ValuationReport.GammaStatusChoices.PENDING
+    ).update(gamma_status=ValuationReport.GammaStatusChoices.FAILED)
+    if updated:
+        report.gamma_status = ValuationReport.GammaStatusChoices.FAILED
+        if timeout_reason:
+            mark_timeout(report.pk, timeout_reason)
+        _notify(report)
+        finished_at = timezone.now()
+        record_metrics(report.pk, gamma_finished_at=finished_at, end_to_end_ms=ms_between(report.created_at, finished_at))
+
+
+def _gamma_poll_deadline(report):
+    """Prazo efetivo do polling: o da geração ou o do relatório menos a reserva do e-mail, o que vier antes."""
+    deadlines = [report.gamma_deadline]
+    if report.deadline_at:
+        deadlines.append(report.deadline_at - timedelta(seconds=settings.EMAIL_BUDGET_SECONDS))
+    deadlines = [deadline for deadline in deadlines if deadline]
+    return min(deadlines) if deadlines else None
+
+
+def _schedule_gamma_poll(report):
+    """Agenda a próxima consulta de status, sem ultrapassar o prazo da geração."""
+    countdown = next_gamma_poll_interval(report.gamma_poll_attempts)
+    remaining = remaining_seconds(_gamma_poll_deadline(report))
+    if remaining is not None:
+        countdown = max(1, min(countdown, int(remaining) + 1))
+    poll_gamma_generation.apply_async((report.id,), countdown=countdown)
+    logger.info(f"Próxima consulta Gamma do Report {report.id} em {countdown}s (tentativa {report.gamma_poll_attempts + 1}).")
+
+
+# acks_late desligado: o POST cria uma geração (não é idempotente) e não deve
+# ser repetido só porque o worker caiu antes de confirmar a mensagem
+@shared_task(bind=True, max_retries=3, default_retry_delay=60, acks_late=False)
 def generate_gamma_presentation(self, report_id):
     """
-    Tarefa Celery para pegar o prompt do report, chamar a API Gamma,
-    fazer polling e salvar a URL da apresentação gerada.
+    Tarefa Celery para pegar o prompt do report e iniciar a geração na API
+    Gamma. O acompanhamento do status é feito por poll_gamma_generation.
     """
     logger.info(f"Iniciando geração Gamma para Report ID: {report_id} (Tentativa {self.request.retries + 1})")
     report = None # Inicializa report como None
-    generation_id = None # Inicializa generation_id
     try:
         report = ValuationReport.objects.get(id=report_id)
 
         # 1. Verificar prompt e status
         prompt_gamma = report.result_data.get('prompt_gamma')
-        current_gamma_status = report.result_data.get('gamma_status')
+        current_gamma_status = report.gamma_status
 
         if not prompt_gamma:
             logger.warning(f"Report {report_id} não possui prompt_gamma. Abortando tarefa Gamma.")
@@ -120,113 +329,186 @@ def generate_gamma_presentation(self, report_id):
         if current_gamma_status in ['completed', 'failed']:
              logger.warning(f"Report {report_id} já tem gamma_status '{current_gamma_status}'. Abortando tarefa Gamma.")
              return
+        # Geração já iniciada (ex: retentativa após o POST): apenas retoma o polling
+        if report.gamma_generation_id:
+            logger.info(f"Report {report_id} já tem geração Gamma {report.gamma_generation_id}. Retomando polling.")
+            _schedule_gamma_poll(report)
+            return
 
         # 2. Verificar API Key
-        gamma_api_key = settings.GAMMA_API_KEY
-        if not gamma_api_key:
+        if not settings.GAMMA_API_KEY:
             logger.error(f"GAMMA_API_KEY não configurada. Marcando falha para Report {report_id}.")
-            if report.result_data:
-                report.result_data['gamma_status'] = 'failed'
-                report.save(update_fields=['result_data'])
+            _mark_gamma_failed(report)
             return
 
-        # 3. Preparar chamada API
-        headers = {"X-API-KEY": gamma_api_key, "Content-Type": "application/json"}
-        gamma_payload = {"inputText": prompt_gamma, "format": "presentation", "textMode": "generate", "textOptions": {"language": "pt-br"}}
-        gamma_endpoint = "https://public-api.gamma.app/v0.2/generations"
+        # Orçamento do POST: o que resta do prazo do relatório, reservando o e-mail
+        budget = stage_budget(report.deadline_at, settings.GAMMA_START_BUDGET_SECONDS, reserve=settings.EMAIL_BUDGET_SECONDS)
+        if budget <= 0:
+            logger.error(f"Prazo do Report {report_id} esgotado antes do POST Gamma. Marcando falha.")
+            _mark_gamma_failed(report, TimeoutReason.GAMMA_START)
+            return
 
-        # 4. Iniciar Geração
+        # 3. Iniciar Geração (sessão HTTP com keep-alive; ver gamma_client)
         logger.info(f"Enviando prompt para Gamma API para Report {report_id}")
-        response_post = requests.post(gamma_endpoint, headers=headers, json=gamma_payload, timeout=30)
-        response_post.raise_for_status()
-        generation_id = response_post.json().get("generationId") # Atribui a generation_id
+        requested_at = timezone.now()
+        stage_started = time.monotonic()
+        response_post = gamma_client.start_generation(prompt_gamma, budget_seconds=budget)
+        record_metrics(
+            report_id,
+            gamma_requested_at=requested_at,
+            gamma_started_at=timezone.now(),
+            gamma_post_ms=elapsed_ms(stage_started),
+            gamma_post_status=response_post.status_code,
+            gamma_post_retries=self.request.retries,
+        )
+        generation_id = response_post.json().get("generationId")
         if not generation_id:
             logger.error(f"Gamma API não retornou generationId para Report {report_id}. Resposta: {response_post.text}")
             raise ValueError("Gamma API não retornou ID de geração.")
 
+        # 4. Guarda o estado no relatório e agenda a primeira consulta
+        report.gamma_generation_id = generation_id
+        report.gamma_poll_attempts = 0
+        report.gamma_deadline = timezone.now() + timedelta(seconds=GAMMA_TIMEOUT_SECONDS)
+        report.save(update_fields=['gamma_generation_id', 'gamma_poll_attempts', 'gamma_deadline'])
         logger.info(f"Gamma iniciou geração (ID: {generation_id}) para Report {report_id}. Iniciando polling...")
-        status_endpoint = f"{gamma_endpoint}/{generation_id}"
-        start_time = time.time()
-        timeout_seconds = 480 # 8 minutos
-
-        # 5. Polling
-        while (time.time() - start_time) < timeout_seconds:
-            time.sleep(30) # Verifica a cada 30 segundos
-            try:
-                response_get = requests.get(status_endpoint, headers=headers, timeout=15)
-                response_get.raise_for_status()
-                status_data = response_get.json()
-                current_status = status_data.get('status')
-                logger.info(f"Status Gamma para {generation_id} (Report {report_id}): {current_status}")
-
-                if current_status == "completed":
-                    gamma_url = status_data.get("gammaUrl")
-                    if gamma_url:
-                        # 6. Sucesso: Salvar URL e status
-                        report.gamma_presentation_url = gamma_url
-                        if report.result_data:
-                            report.result_data['gamma_status'] = 'completed'
-                        report.save(update_fields=['gamma_presentation_url', 'result_data'])
-                        logger.info(f"Apresentação Gamma concluída e URL salva para Report {report_id}: {gamma_url}")                        
-                        try:
-                            send_gamma_report_email.delay(report_id)
-                            logger.info(f"Tarefa de envio de email disparada para Report {report_id}")
-                        except Exception as e_email:
-                            logger.error(f"Falha ao disparar tarefa send_gamma_report_email para Report {report_id}: {e_email}")                        
-                        return # Sucesso! Termina a tarefa
-                    else:
-                        logger.error(f"Status Gamma 'completed' mas sem gammaUrl para {generation_id}. Resposta: {status_data}")
-                        raise ValueError("Resposta Gamma 'completed' sem URL.")
-
-                elif current_status in ["failed", "error"]:
-                     logger.error(f"Geração Gamma falhou explicitamente para {generation_id}. Status: {current_status}. Resposta: {status_data}")
-                     raise ValueError(f"Geração Gamma falhou com status: {current_status}")
-
-            except requests.exceptions.Timeout:
-                logger.warning(f"Timeout durante polling do status Gamma para {generation_id}. Tentando novamente...")
-            except requests.exceptions.RequestException as poll_error:
-                # Erros 4xx/5xx no polling são tratados aqui
-                if poll_error.response is not None and 400 <= poll_error.response.status_code < 500:
-                     logger.error(f"Erro cliente ({poll_error.response.status_code}) durante polling Gamma para {generation_id}. Abortando retentativas. Erro: {poll_error}")
-                     raise # Não tentar novamente para erros cliente
-                else:
-                     logger.warning(f"Erro de rede/servidor durante polling Gamma para {generation_id}: {poll_error}. Tentando novamente...")
-            # Continua o loop até timeout ou sucesso/falha explícita
-
-        # Saiu do loop por timeout geral
-        logger.error(f"Timeout geral ({timeout_seconds}s) atingido ao esperar geração Gamma para Report {report_id} (ID: {generation_id}).")
-        raise TimeoutError("Geração Gamma demorou demasiado.")
+        _schedule_gamma_poll(report)
 
     except ValuationReport.DoesNotExist:
         logger.error(f"Erro CRÍTICO: Report {report_id} não encontrado em generate_gamma_presentation.")
-    except (requests.exceptions.RequestException, ValueError, TimeoutError) as e:
+    except (requests.exceptions.RequestException, ValueError) as e:
         # Erros esperados que podem justificar retentativa
         logger.warning(f"Erro tratável ({type(e).__name__}) na tarefa Gamma para Report {report_id}: {e}. Verificando retentativas...")
+        error_response = getattr(e, 'response', None)
+        record_metrics(
+            report_id,
+            gamma_post_status=error_response.status_code if error_response is not None else None,
+            gamma_post_retries=self.request.retries,
+        )
         try:
             # Tentar novamente com delay exponencial + jitter
             retry_delay = int(random.uniform(2, 5) * (2 ** self.request.retries))
+            if report is not None and not fits_before_deadline(report.deadline_at, retry_delay, reserve=settings.EMAIL_BUDGET_SECONDS):
+                logger.error(f"Retentativa Gamma do Report {report_id} não cabe no prazo do relatório.")
+                _mark_gamma_failed(report, TimeoutReason.GAMMA_START)
+                return
             logger.info(f"Agendando retentativa para Report {report_id} em {retry_delay}s.")
             raise self.retry(exc=e, countdown=retry_delay)
         except self.MaxRetriesExceededError:
              logger.error(f"Máximo de retentativas atingido para Report {report_id} na tarefa Gamma.")
-             if report and report.result_data and report.result_data.get('gamma_status') == 'pending':
-                 report.result_data['gamma_status'] = 'failed'
-                 report.save(update_fields=['result_data'])
+             _mark_gamma_failed(report)
     except Exception as e:
         # Erros inesperados
         logger.exception(f"Erro INESPERADO na tarefa generate_gamma_presentation para Report {report_id}: {e}")
-        if report and report.result_data and report.result_data.get('gamma_status') == 'pending':
-            report.result_data['gamma_status'] = 'failed'
-            report.save(update_fields=['result_data']) # Marca como falha final
-            
-            
+        # Marca como falha final
+        _mark_gamma_failed(report, TimeoutReason.GAMMA_START if isinstance(e, SoftTimeLimitExceeded) else None)
+
+
+@shared_task
+def poll_gamma_generation(report_id):
+    """
+    Uma única consulta de status da geração Gamma. Reagenda-se enquanto a
+    geração estiver em andamento e o prazo (gamma_deadline, limitado pelo
+    prazo do relatório menos a reserva do e-mail) não tiver passado.
+    """
+    report = None
+    try:
+        report = ValuationReport.objects.get(id=report_id)
+        generation_id = report.gamma_generation_id
+
+        if report.gamma_status != ValuationReport.GammaStatusChoices.PENDING or not generation_id:
+            logger.warning(f"Report {report_id} não tem geração Gamma pendente. Polling encerrado.")
+            return
+
+        # 1. Prazo da geração
+        poll_deadline = _gamma_poll_deadline(report)
+        if poll_deadline and timezone.now() >= poll_deadline:
+            logger.error(f"Prazo atingido ao esperar geração Gamma para Report {report_id} (ID: {generation_id}).")
+            _mark_gamma_failed(report, TimeoutReason.GAMMA_GENERATION)
+            return
+
+        # 2. Consulta o status (uma única chamada HTTP)
+        report.gamma_poll_attempts += 1
+        report.save(update_fields=['gamma_poll_attempts'])
+        poll_started = time.monotonic()
+        poll_status = None
+        try:
+            response_get = gamma_client.get_generation(generation_id, budget_seconds=remaining_seconds(poll_deadline))
+            poll_status = response_get.status_code
+        except requests.exceptions.Timeout:
+            logger.warning(f"Timeout durante polling do status Gamma para {generation_id}. Tentando novamente...")
+            _schedule_gamma_poll(report)
+            return
+        except requests.exceptions.RequestException as poll_error:
+            poll_status = poll_error.response.status_code if poll_error.response is not None else None
+            # Erros 4xx/5xx no polling são tratados aqui
+            if poll_error.response is not None and 400 <= poll_error.response.status_code < 500:
+                 logger.error(f"Erro cliente ({poll_error.response.status_code}) durante polling Gamma para {generation_id}. Abortando. Erro: {poll_error}")
+                 _mark_gamma_failed(report) # Não tentar novamente para erros cliente
+            else:
+                 logger.warning(f"Erro de rede/servidor durante polling Gamma para {generation_id}: {poll_error}. Tentando novamente...")
+                 _schedule_gamma_poll(report)
+            return
+        finally:
+            record_metrics(
+                report_id,
+                gamma_poll_count=F('gamma_poll_count') + 1,
+                gamma_poll_http_ms=Coalesce(F('gamma_poll_http_ms'), 0) + elapsed_ms(poll_started),
+                gamma_last_poll_status=poll_status,
+            )
+
+        status_data = response_get.json()
+        current_status = status_data.get('status')
+        logger.info(f"Status Gamma para {generation_id} (Report {report_id}): {current_status}")
+
+        if current_status == "completed":
+            gamma_url = status_data.get("gammaUrl")
+            if not gamma_url:
+                logger.error(f"Status Gamma 'completed' mas sem gammaUrl para {generation_id}. Resposta: {status_data}")
+                _mark_gamma_failed(report)
+                return
+            # 3. Sucesso: Salvar URL e status
+            report.gamma_presentation_url = gamma_url
+            report.gamma_status = ValuationReport.GammaStatusChoices.COMPLETED
+            report.save(update_fields=['gamma_presentation_url', 'gamma_status'])
+            _notify(report)
+            finished_at = timezone.now()
+            # O POST foi aceite GAMMA_TIMEOUT_SECONDS antes do prazo
+            gamma_started_at = report.gamma_deadline - timedelta(seconds=GAMMA_TIMEOUT_SECONDS) if report.gamma_deadline else None
+            record_metrics(report_id, gamma_finished_at=finished_at, gamma_generation_ms=ms_between(gamma_started_at, finished_at))
+            logger.info(f"Apresentação Gamma concluída e URL salva para Report {report_id}: {gamma_url}")
+            try:
+                send_gamma_report_email.delay(report_id)
+                logger.info(f"Tarefa de envio de email disparada para Report {report_id}")
+            except Exception as e_email:
+                logger.error(f"Falha ao disparar tarefa send_gamma_report_email para Report {report_id}: {e_email}")
+
+        elif current_status in ["failed", "error"]:
+            logger.error(f"Geração Gamma falhou explicitamente para {generation_id}. Status: {current_status}. Resposta: {status_data}")
+            _mark_gamma_failed(report)
+
+        else:
+            # 4. Ainda em andamento: reagenda (intervalo cresce a cada tentativa)
+            _schedule_gamma_poll(report)
+
+    except ValuationReport.DoesNotExist:
+        logger.error(f"Erro CRÍTICO: Report {report_id} não encontrado em poll_gamma_generation.")
+    except Exception as e:
+        logger.exception(f"Erro INESPERADO na tarefa poll_gamma_generation para Report {report_id}: {e}")
+        _mark_gamma_failed(report, TimeoutReason.GAMMA_GENERATION if isinstance(e, SoftTimeLimitExceeded) else None)
+
+
 # --- NOVA TAREFA PARA ENVIAR O EMAIL DO RELATÓRIO ---
 @shared_task(bind=True, max_retries=3, default_retry_delay=180) # Tenta novamente após 3 mins se falhar
 def send_gamma_report_email(self, report_id):
     """
-    Envia um email para o usuário com o link da apresentação Gamma concluída.
+    Prepara o email para o usuário com o link da apresentação Gamma concluída
+    e coloca-o na fila de saída (users/mail.py). A primeira tentativa corre
+    sempre; as retentativas só se ainda couberem no prazo do relatório.
     """
     logger.info(f"Iniciando envio de email do relatório Gamma para Report ID: {report_id}")
+    task_started = time.monotonic()
+    report = None
     try:
         report = ValuationReport.objects.get(id=report_id)
         
@@ -235,33 +517,34 @@ def send_gamma_report_email(self, report_id):
             return
 
         user = report.user
-        subject = render_to_string('users/gamma_report_subject.txt', {'report': report, 'user': user}).strip()
-        
-        context = {
-            'report': report,
-            'user': user,
-        }
-        
-        html_message = render_to_string('users/gamma_report_email.html', context)
-        # Cria uma versão em texto plano a partir do HTML (fallback)
-        plain_message = strip_tags(html_message) 
-        
-        from_email = settings.DEFAULT_FROM_EMAIL
-        to_email = user.email
-
-        msg = EmailMultiAlternatives(subject, plain_message, from_email, [to_email])
-        msg.attach_alternative(html_message, "text/html")
-        msg.send()
-
-        logger.info(f"Email do relatório Gamma enviado com sucesso para {to_email} (Report {report_id})")
+        # Assunto, texto plano (template compilado uma vez) e HTML
+        subject, plain_message, html_message = render_email('users/gamma_report', {'report': report, 'user': user})
+
+        # Vai para a fila de saída: o envio é feito em lote, numa conexão SMTP reutilizada
+        enqueue_email(user.email, subject, plain_message, html_body=html_message, kind='gamma_report')
+        queued_at = timezone.now()
+        record_metrics(
+            report_id,
+            email_queued_at=queued_at,
+            email_ms=elapsed_ms(task_started),
+            email_retries=self.request.retries,
+            end_to_end_ms=ms_between(report.created_at, queued_at),
+        )
+
+        logger.info(f"Email do relatório Gamma enfileirado para {user.email} (Report {report_id})")
 
     except ValuationReport.DoesNotExist:
          logger.error(f"Erro CRÍTICO: Report {report_id} não encontrado em send_gamma_report_email.")
          # Não fazer retry se o report não existe
     except Exception as e:
         logger.error(f"Erro ao enviar email do relatório Gamma para Report {report_id}: {e}", exc_info=True)
+        countdown = int(random.uniform(2, 5) * (self.request.retries + 1))
+        if report is not None and not fits_before_deadline(report.deadline_at, countdown):
+            logger.error(f"Retentativa do email do Report {report_id} não cabe no prazo do relatório.")
+            mark_timeout(report_id, TimeoutReason.EMAIL)
+            return
         try:
             # Tentar novamente (até max_retries)
-            raise self.retry(exc=e, countdown=int(random.uniform(2, 5) * (self.request.retries + 1)))
+            raise self.retry(exc=e, countdown=countdown)
         except self.MaxRetriesExceededError:
              logger.error(f"Máximo de retentativas atingido para envio de email do Report {report_id}.")
\ No newline at end of file
@@ -1,3 +1,755 @@
-from django.test import TestCase
+import time
+import io
+import json
+from datetime import timedelta
+from unittest import mock
+import requests
+from redis import exceptions as redis_exceptions
+from google.api_core import exceptions as google_exceptions
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from chatbot import batch as batch_import, cache as agent_cache, gemini_client, llm_providers
+from chatbot.agents import merge_agent_narrative
+from chatbot.deadlines import TimeoutReason, fits_before_deadline, mark_timeout, remaining_seconds, report_deadline, stage_budget
+from chatbot import gemini_limiter
+from chatbot.gemini_limiter import GeminiCapacityExceeded, gemini_call, limiter_stats
+from chatbot.json_stream import IncrementalJSONObjectParser
+from chatbot.llm_providers import AgentAnswer
+from chatbot.idempotency import ValuationRequestClaim
+from chatbot.quota import check_rate_limit, quota_key, release_quota, reserve_quota, sync_quota
+from chatbot import tasks
+from chatbot.single_flight import LOCK_PREFIX, RESULT_PREFIX, run_single_flight
+from chatbot.tasks import process_valuation_request
+from chatbot.valuation_engine import (
+    calcular_lucro_liquido, calcular_valuation, faixa_multiplo, formatar_brl, gerar_prompt_gamma,
+    identificar_setor, refinar_multiplo,
+)
+from reports.models import ReportMetrics, ValuationBatch, ValuationReport
+from users.models import CustomUser
+from valuation import celery as celery_app
+from valuation.testing import FakeRedisMixin
 
-# Create your tests here.
+INPUTS = {
+    'faturamento_anual': 1200000.0,
+    'custos_operacionais_mensais': 50000.0,
+    'aliquota_imposto_lucro_perc': 15.0,
+    'projecao_crescimento_anual_perc': 20.0,
+    'setor_atuacao': 'Tecnologia',
+    'tempo_operacao_anos': 4,
+    'diferencial_competitivo': 'Atendimento',
+}
+
+AGENT_REPLY = json.dumps({
+    'resumo_para_gamma': {'principais_drivers': 'D', 'pontos_fortes': 'F', 'pontos_atencao': 'A'},
+    'prompt_gamma': 'PROMPT',
+})
+
+
+def create_report(user, **fields):
+    return ValuationReport.objects.create(user=user, inputs_data=dict(INPUTS), **fields)
+
+
+class ValuationEngineTests(SimpleTestCase):
+    def test_calcular_valuation(self):
+        result = calcular_valuation(INPUTS, 'ACME')
+        # Faixa (2.0, 6.0); posição 0.6 * (20/30) + 0.4 * (4/10) = 0.56 -> 4.24x
+        self.assertEqual(result['calculo']['multiplo'], 4.24)
+        self.assertEqual(result['calculo']['faixa_multiplo'], [2.0, 6.0])
+        self.assertEqual(result['calculo']['lucro_liquido_anual'], 510000.0)
+        self.assertEqual(result['valuation_calculado'], 5088000.0)
+        self.assertEqual(result['resumo_para_gamma']['valuation_estimado'], 'R$ 5.088.000,00')
+        self.assertEqual(result['resumo_para_gamma']['empresa_nome'], 'ACME')
+        self.assertIn('Tecnologia (SaaS/Software)', result['metodologia_usada'])
+
+    def test_loss_does_not_produce_negative_tax(self):
+        self.assertEqual(calcular_lucro_liquido(100000, 10000, 30), -20000.0)
+        self.assertEqual(calcular_lucro_liquido(240000, 10000, 50), 60000.0)
+
+    def test_identificar_setor(self):
+        self.assertEqual(identificar_setor('Serviços de TI')['nome'], 'Serviços de TI (Consultoria/Agência)')
+        self.assertEqual(identificar_setor('Fábrica de móveis')['nome'], 'Indústria')
+        # "ti" só casa como palavra inteira
+        self.assertEqual(identificar_setor('Têxtil')['nome'], 'Outros/Não especificado')
+        self.assertEqual(identificar_setor('')['nome'], 'Outros/Não especificado')
+
+    def test_premium_technology_range(self):
+        self.assertEqual(faixa_multiplo('SaaS', 40), (2.0, 6.0))
+        self.assertEqual(faixa_multiplo('SaaS', 41), (2.0, 8.0))
+
+    def test_refinar_multiplo_is_clamped_to_range(self):
+        self.assertEqual(refinar_multiplo((1.0, 2.0), -10, 0), 1.0)
+        self.assertEqual(refinar_multiplo((1.0, 2.0), 100, 50), 2.0)
+
+    def test_formatar_brl(self):
+        self.assertEqual(formatar_brl(1234567.8), 'R$ 1.234.567,80')
+        self.assertEqual(formatar_brl(-1500), '-R$ 1.500,00')
+
+    def test_gerar_prompt_gamma(self):
+        prompt = gerar_prompt_gamma(calcular_valuation(INPUTS, 'ACME'))
+        self.assertIn("Valuation Estimado - ACME", prompt)
+        self.assertIn("4.24x", prompt)
+
+    def test_agent_narrative_never_overrides_numbers(self):
+        base = calcular_valuation(INPUTS, 'ACME')
+        merged = merge_agent_narrative(base, {
+            'valuation_calculado': 1,
+            'resumo_para_gamma': {'valuation_estimado': 'R$ 1,00', 'pontos_fortes': ['Marca']},
+            'prompt_gamma': 'Apresentação',
+        })
+        self.assertEqual(merged['valuation_calculado'], 5088000.0)
+        self.assertEqual(merged['resumo_para_gamma']['valuation_estimado'], 'R$ 5.088.000,00')
+        self.assertEqual(merged['resumo_para_gamma']['pontos_fortes'], ['Marca'])
+        self.assertEqual(merged['prompt_gamma'], 'Apresentação')
+        self.assertNotIn('prompt_gamma', base) # O resultado do motor não é alterado
+
+
+
+class IncrementalJSONObjectParserTests(SimpleTestCase):
+    def feed_all(self, parser, chunks):
+        pairs = []
+        for chunk in chunks:
+            pairs.extend(parser.feed(chunk))
+        return pairs
+
+    def test_fields_are_emitted_as_soon_as_complete(self):
+        parser = IncrementalJSONObjectParser()
+        self.assertEqual(parser.feed('```json\n{"a": 1, "b"'), [('a', 1)])
+        self.assertEqual(parser.feed(': {"x": [1, 2]}'), [])
+        self.assertEqual(parser.feed(', "c": "d"}\n```'), [('b', {'x': [1, 2]}), ('c', 'd')])
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.text(), '{"a": 1, "b": {"x": [1, 2]}, "c": "d"}')
+
+    def test_commas_braces_and_escapes_inside_strings(self):
+        text = '{"a": "x, {y} [z]", "b": "aspas \\" e \\\\", "c": null}'
+        pairs = self.feed_all(IncrementalJSONObjectParser(), [text[i:i + 3] for i in range(0, len(text), 3)])
+        self.assertEqual(pairs, [('a', 'x, {y} [z]'), ('b', 'aspas " e \\'), ('c', None)])
+
+    def test_empty_and_incomplete_objects(self):
+        parser = IncrementalJSONObjectParser()
+        self.assertEqual(parser.feed('{}'), [])
+        self.assertTrue(parser.done)
+        parser = IncrementalJSONObjectParser()
+        self.assertEqual(parser.feed('{"a": 1'), [])
+        self.assertFalse(parser.done)
+
+@override_settings(GEMINI_API_KEY='test-key', GEMINI_API_ENDPOINT='', GEMINI_FALLBACK_MODEL_NAME='')
+class GeminiWarmUpTests(SimpleTestCase):
+    def setUp(self):
+        gemini_client.reset()
+        self.addCleanup(gemini_client.reset)
+
+    def test_warm_up_builds_model_without_api_calls(self):
+        with mock.patch.object(gemini_client.genai, 'get_model') as get_model, \
+             mock.patch.object(gemini_client, 'get_cached_content_name') as cached_name:
+            self.assertTrue(gemini_client.warm_up())
+        get_model.assert_not_called()
+        cached_name.assert_not_called()
+        self.assertIn((gemini_client.GEMINI_MODEL_NAME, ('system', gemini_client.PROMPT_VERSION)), gemini_client._models)
+
+    @override_settings(GEMINI_API_KEY=None)
+    def test_warm_up_without_api_key(self):
+        with self.assertLogs('chatbot.gemini_client', 'WARNING'):
+            self.assertFalse(gemini_client.warm_up())
+
+    def test_worker_init_warms_only_on_gemini_queue(self):
+        queues = celery_app.app.amqp.queues
+        with mock.patch('chatbot.gemini_client.warm_up') as warm_up:
+            with mock.patch.object(queues, '_consume_from', {'email': queues['email']}):
+                celery_app.init_worker_process()
+            warm_up.assert_not_called()
+            with mock.patch.object(queues, '_consume_from', {'gemini': queues['gemini']}):
+                celery_app.init_worker_process()
+            warm_up.assert_called_once_with()
+            warm_up.reset_mock()
+            with mock.patch.object(queues, '_consume_from', None): # Sem -Q: todas as filas
+                celery_app.init_worker_process()
+            warm_up.assert_called_once_with()
+
+    @override_settings(GEMINI_FALLBACK_MODEL_NAME='gemini-fallback')
+    def test_worker_init_warms_fallback_model_only_on_gemini_queue(self):
+        queues = celery_app.app.amqp.queues
+        with mock.patch('chatbot.gemini_client.warm_up') as warm_up:
+            with mock.patch.object(queues, '_consume_from', {'gamma': queues['gamma']}):
+                celery_app.init_worker_process()
+            warm_up.assert_not_called()
+            with mock.patch.object(queues, '_consume_from', {'gemini': queues['gemini']}):
+                celery_app.init_worker_process()
+        self.assertEqual(warm_up.call_args_list, [mock.call(), mock.call('gemini-fallback')])
+
+
+@override_settings(
+    GEMINI_FALLBACK_MODEL_NAME='gemini-fallback', LLM_HEDGING=True, LLM_SLO_SECONDS=1.0,
+    LLM_HEDGE_DEFAULT_DELAY_SECONDS=0.1, LLM_HEDGE_MIN_DELAY_SECONDS=0.05, LLM_LATENCY_MIN_SAMPLES=3,
+)
+class HedgedGenerationTests(FakeRedisMixin, SimpleTestCase):
+    PRIMARY = f"gemini:{gemini_client.GEMINI_MODEL_NAME}"
+    FALLBACK = "gemini:gemini-fallback"
+
+    def tearDown(self):
+        # Espera os pedidos abandonados (ainda gravam latência no fakeredis)
+        if llm_providers._executor is not None:
+            llm_providers._executor.shutdown(wait=True)
+            llm_providers._executor = None
+        super().tearDown()
+
+    def run_hedged(self, behaviours, budget_seconds=None):
+        """behaviours: nome do modelo -> (atraso em segundos, resposta ou exceção)."""
+        def generate(provider, prompt, label, on_field=None, timeout=None):
+            delay, outcome = behaviours[provider.model_name]
+            time.sleep(delay)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome, {"total_tokens": 1}
+
+        with mock.patch.object(llm_providers.GeminiProvider, 'generate', generate), \
+             mock.patch.object(llm_providers.LocalProvider, 'generate', return_value=("local", {})):
+            return llm_providers.generate_with_hedging("prompt", "Report 1", {}, budget_seconds=budget_seconds)
+
+    def outcomes(self, name):
+        return self.redis.hgetall(llm_providers.OUTCOMES_KEY.format(name=name))
+
+    def test_fast_primary_answers_without_hedge(self):
+        answer = self.run_hedged({gemini_client.GEMINI_MODEL_NAME: (0, "primary"), "gemini-fallback": (0, "fallback")})
+        self.assertEqual((answer.text, answer.provider, answer.hedged, answer.timed_out), ("primary", self.PRIMARY, False, False))
+
+    def test_slow_primary_is_hedged_to_fallback(self):
+        answer = self.run_hedged({gemini_client.GEMINI_MODEL_NAME: (0.6, "primary"), "gemini-fallback": (0, "fallback")})
+        self.assertEqual((answer.text, answer.provider, answer.hedged), ("fallback", self.FALLBACK, True))
+        self.assertEqual(self.outcomes(self.FALLBACK).get("hedge_won"), "1")
+
+    def test_primary_error_launches_fallback_immediately(self):
+        started = time.monotonic()
+        answer = self.run_hedged({gemini_client.GEMINI_MODEL_NAME: (0, RuntimeError("boom")), "gemini-fallback": (0, "fallback")})
+        self.assertEqual(answer.provider, self.FALLBACK)
+        self.assertLess(time.monotonic() - started, 0.1) # Não esperou pelo atraso do hedge
+        self.assertEqual(self.outcomes(self.PRIMARY).get("error"), "1")
+
+    @override_settings(LLM_SLO_SECONDS=0.3)
+    def test_slo_exceeded_falls_back_to_local_narrative(self):
+        answer = self.run_hedged({gemini_client.GEMINI_MODEL_NAME: (0.8, "primary"), "gemini-fallback": (0.8, "fallback")})
+        self.assertEqual((answer.text, answer.provider, answer.hedged, answer.timed_out), ("local", "local", True, True))
+        self.assertEqual(self.outcomes(self.PRIMARY).get("slo_exceeded"), "1")
+
+    def test_exhausted_budget_answers_locally_at_once(self):
+        answer = self.run_hedged({}, budget_seconds=0)
+        self.assertEqual((answer.provider, answer.timed_out), ("local", True))
+
+    def test_capacity_exhausted_everywhere_is_raised(self):
+        error = GeminiCapacityExceeded("sem vaga", retry_after=5)
+        with self.assertRaises(GeminiCapacityExceeded):
+            self.run_hedged({gemini_client.GEMINI_MODEL_NAME: (0, error), "gemini-fallback": (0, error)})
+
+    def test_fallback_goes_first_when_primary_p95_breaks_slo(self):
+        for latency in (5000, 5000, 5000):
+            llm_providers.record_latency(self.PRIMARY, latency)
+        first, hedge = llm_providers.choose_providers()
+        self.assertEqual((first.name, hedge.name), (self.FALLBACK, self.PRIMARY))
+
+
+@override_settings(AGENT_CACHE_TTL_SECONDS=3600, AGENT_CACHE_MAX_ENTRIES=2)
+class AgentCacheTests(FakeRedisMixin, SimpleTestCase):
+    def test_key_is_canonical_and_covers_model_and_prompt(self):
+        key = agent_cache.agent_cache_key({'a': 1, 'b': 2}, 'ACME', 'model', 'v1')
+        self.assertEqual(key, agent_cache.agent_cache_key({'b': 2, 'a': 1}, 'ACME', 'model', 'v1'))
+        self.assertNotEqual(key, agent_cache.agent_cache_key({'a': 1, 'b': 2}, 'ACME', 'other-model', 'v1'))
+        self.assertNotEqual(key, agent_cache.agent_cache_key({'a': 1, 'b': 2}, 'ACME', 'model', 'v2'))
+
+    def test_store_then_hit(self):
+        self.assertIsNone(agent_cache.get_cached_agent_result('k1'))
+        agent_cache.store_agent_result('k1', {'valuation_calculado': 1.0})
+        self.assertEqual(agent_cache.get_cached_agent_result('k1'), {'valuation_calculado': 1.0})
+        self.assertLessEqual(self.redis.ttl(agent_cache.ENTRY_PREFIX + 'k1'), 3600)
+        stats = agent_cache.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores'], stats['size']), (1, 1, 1, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        agent_cache.store_agent_result('k1', {'n': 1})
+        agent_cache.store_agent_result('k2', {'n': 2})
+        agent_cache.get_cached_agent_result('k1') # k1 passa a ser o mais recente
+        agent_cache.store_agent_result('k3', {'n': 3})
+        self.assertIsNone(self.redis.get(agent_cache.ENTRY_PREFIX + 'k2'))
+        self.assertEqual(agent_cache.get_cached_agent_result('k1'), {'n': 1})
+        self.assertEqual(agent_cache.cache_stats()['evictions'], 1)
+
+
+@override_settings(GEMINI_API_KEY='test-key', AGENT_CACHE_ENABLED=True, REPORT_DEADLINE_SECONDS=600)
+class AgentCacheTaskTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw')
+        gamma = mock.patch('chatbot.tasks.generate_gamma_presentation.delay')
+        gamma.start()
+        self.addCleanup(gamma.stop)
+
+    def run_task(self, provider):
+        report = create_report(self.user)
+        answer = AgentAnswer(AGENT_REPLY, {'total_tokens': 10}, provider, provider != llm_providers.PRIMARY_PROVIDER_NAME, False)
+        with mock.patch('chatbot.agents.generate_with_hedging', return_value=answer) as generate:
+            process_valuation_request.apply(args=(report.id,))
+        return ReportMetrics.objects.get(report=report), generate
+
+    def test_primary_answer_is_cached_and_reused(self):
+        self.run_task(llm_providers.PRIMARY_PROVIDER_NAME)
+        metrics, generate = self.run_task(llm_providers.PRIMARY_PROVIDER_NAME)
+        generate.assert_not_called()
+        self.assertEqual(metrics.agent_source, ReportMetrics.AgentSourceChoices.CACHE)
+
+    def test_fallback_answer_is_not_cached(self):
+        self.run_task('gemini:gemini-fallback')
+        self.assertEqual(agent_cache.cache_stats()['size'], 0)
+        metrics, generate = self.run_task(llm_providers.PRIMARY_PROVIDER_NAME)
+        generate.assert_called_once()
+        self.assertEqual(metrics.agent_source, ReportMetrics.AgentSourceChoices.GEMINI)
+
+
+def gamma_response(status_code=200, **payload):
+    response = mock.Mock(status_code=status_code, text=json.dumps(payload))
+    response.json.return_value = payload
+    return response
+
+
+@override_settings(GAMMA_API_KEY='test-key', REPORT_DEADLINE_SECONDS=600)
+class GammaPollingTests(FakeRedisMixin, TestCase):
+    Gamma = ValuationReport.GammaStatusChoices
+
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw')
+        self.report = create_report(
+            user, status=ValuationReport.StatusChoices.SUCCESS, gamma_status=self.Gamma.PENDING,
+            result_data={'prompt_gamma': 'PROMPT'}, deadline_at=timezone.now() + timedelta(seconds=600),
+        )
+        for target in ('poll_gamma_generation.apply_async', 'send_gamma_report_email.delay'):
+            patcher = mock.patch(f'chatbot.tasks.{target}')
+            setattr(self, target.split('.')[0], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def start_generation(self):
+        self.report.gamma_generation_id = 'gen-1'
+        self.report.gamma_deadline = timezone.now() + timedelta(seconds=tasks.GAMMA_TIMEOUT_SECONDS)
+        self.report.save(update_fields=['gamma_generation_id', 'gamma_deadline'])
+
+    def poll(self, response=None, error=None):
+        with mock.patch('chatbot.gamma_client.get_generation', return_value=response, side_effect=error):
+            tasks.poll_gamma_generation(self.report.id)
+        self.report.refresh_from_db()
+
+    def test_poll_interval_backs_off_up_to_the_cap(self):
+        self.assertEqual([tasks.next_gamma_poll_interval(n) for n in range(9)], [5, 7, 11, 16, 25, 37, 56, 60, 60])
+
+    def test_start_saves_state_and_schedules_first_poll(self):
+        with mock.patch('chatbot.gamma_client.start_generation', return_value=gamma_response(generationId='gen-1')):
+            tasks.generate_gamma_presentation(self.report.id)
+        self.report.refresh_from_db()
+        self.assertEqual((self.report.gamma_generation_id, self.report.gamma_poll_attempts), ('gen-1', 0))
+        self.assertIsNotNone(self.report.gamma_deadline)
+        self.poll_gamma_generation.assert_called_once_with((self.report.id,), countdown=5)
+
+    def test_existing_generation_resumes_polling_without_new_post(self):
+        self.start_generation()
+        with mock.patch('chatbot.gamma_client.start_generation') as start:
+            tasks.generate_gamma_presentation(self.report.id)
+        start.assert_not_called()
+        self.poll_gamma_generation.assert_called_once()
+
+    def test_pending_generation_is_polled_again_later(self):
+        self.start_generation()
+        self.poll(gamma_response(status='pending'))
+        self.assertEqual((self.report.gamma_status, self.report.gamma_poll_attempts), (self.Gamma.PENDING, 1))
+        self.poll_gamma_generation.assert_called_once_with((self.report.id,), countdown=7)
+        self.assertEqual(ReportMetrics.objects.get(report=self.report).gamma_poll_count, 1)
+
+    def test_completed_generation_saves_url_and_sends_email(self):
+        self.start_generation()
+        self.poll(gamma_response(status='completed', gammaUrl='https://gamma.app/docs/1'))
+        self.assertEqual(self.report.gamma_status, self.Gamma.COMPLETED)
+        self.assertEqual(self.report.gamma_presentation_url, 'https://gamma.app/docs/1')
+        self.send_gamma_report_email.assert_called_once_with(self.report.id)
+        self.poll_gamma_generation.assert_not_called()
+
+    def test_client_error_fails_without_retry(self):
+        self.start_generation()
+        error = requests.exceptions.HTTPError(response=mock.Mock(status_code=404))
+        self.poll(error=error)
+        self.assertEqual(self.report.gamma_status, self.Gamma.FAILED)
+        self.poll_gamma_generation.assert_not_called()
+
+    def test_server_error_is_polled_again(self):
+        self.start_generation()
+        self.poll(error=requests.exceptions.HTTPError(response=mock.Mock(status_code=503)))
+        self.assertEqual(self.report.gamma_status, self.Gamma.PENDING)
+        self.poll_gamma_generation.assert_called_once()
+
+    def test_expired_deadline_marks_timeout_without_calling_gamma(self):
+        self.start_generation()
+        ValuationReport.objects.filter(pk=self.report.pk).update(gamma_deadline=timezone.now() - timedelta(seconds=1))
+        with mock.patch('chatbot.gamma_client.get_generation') as get_generation:
+            tasks.poll_gamma_generation(self.report.id)
+        get_generation.assert_not_called()
+        self.report.refresh_from_db()
+        self.assertEqual(self.report.gamma_status, self.Gamma.FAILED)
+        self.assertEqual(self.report.timeout_reason, TimeoutReason.GAMMA_GENERATION)
+
+
+@override_settings(STATUS_REALTIME_ENABLED=False)
+class ReportStatusAPITests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw')
+        self.client.force_login(self.user)
+        self.report = create_report(self.user, status=ValuationReport.StatusChoices.PENDING)
+        other = CustomUser.objects.create_user('98765432000199', 'other@example.com', 'Other', 'pw')
+        self.other_report = create_report(other)
+        self.url = reverse('chatbot:api_status')
+
+    def get(self, ids, **extra):
+        return self.client.get(self.url, {'ids': ids}, **extra)
+
+    def test_etag_and_not_modified(self):
+        response = self.get(f'{self.report.id},{self.other_report.id}')
+        self.assertEqual(response.status_code, 200)
+        reports = response.json()['reports']
+        self.assertEqual([item['id'] for item in reports], [self.report.id]) # Só os relatórios do utilizador
+        self.assertEqual((reports[0]['queue_position'], reports[0]['final']), (0, False))
+        etag = response['ETag']
+        response = self.get(str(self.report.id), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_change_produces_new_etag(self):
+        etag = self.get(str(self.report.id))['ETag']
+        ValuationReport.objects.filter(pk=self.report.pk).update(status=ValuationReport.StatusChoices.FAILED)
+        response = self.get(str(self.report.id), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertTrue(response.json()['reports'][0]['final'])
+
+    def test_missing_ids(self):
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+
+    def test_wait_and_stream_are_ignored_without_realtime(self):
+        etag = self.get(str(self.report.id))['ETag']
+        with mock.patch('chatbot.views.ReportUpdateListener') as listener:
+            response = self.client.get(self.url, {'ids': self.report.id, 'wait': 20, 'stream': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        listener.assert_not_called()
+
+    @override_settings(STATUS_REALTIME_ENABLED=True)
+    def test_stream_sends_state_then_done_for_final_reports(self):
+        ValuationReport.objects.filter(pk=self.report.pk).update(status=ValuationReport.StatusChoices.FAILED)
+        response = self.client.get(self.url, {'ids': self.report.id, 'stream': 1})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = b''.join(response.streaming_content).decode()
+        self.assertIn(f'"id": {self.report.id}', events)
+        self.assertTrue(events.endswith("event: done\ndata: {}\n\n"))
+
+
+def jsonl(*rows):
+    return io.BytesIO("\n".join(row if isinstance(row, str) else json.dumps(row) for row in rows).encode())
+
+
+@mock.patch.object(batch_import, 'BATCH_CHUNK_SIZE', 2)
+class BatchImportTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw')
+        patcher = mock.patch.object(batch_import, 'group')
+        self.group = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, stream, fmt='jsonl', **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return batch_import.create_batch(self.user, stream, fmt, source_name='carteira.jsonl', **kwargs)
+
+    def dispatched_chunks(self):
+        return [[sig.args[0] for sig in call.args[0]] for call in self.group.call_args_list]
+
+    def test_each_chunk_is_dispatched_with_a_deadline(self):
+        rows = [dict(INPUTS, faturamento_anual=1000000 + n) for n in range(5)]
+        batch = self.create(jsonl(rows[0], '{quebrado', rows[1], '[1, 2]', {'inputs': 3}, *rows[2:], dict(INPUTS, setor_atuacao='')))
+        self.assertEqual((batch.total_rows, batch.accepted_count, batch.rejected_count), (9, 5, 4))
+        self.assertEqual([error['linha'] for error in batch.errors], [2, 4, 5, 9])
+        chunks = self.dispatched_chunks()
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(sorted(sum(chunks, [])), sorted(batch.reports.values_list('id', flat=True)))
+        self.assertFalse(batch.reports.filter(deadline_at__isnull=True).exists())
+
+    def test_csv_accepts_decimal_comma(self):
+        header = ','.join(INPUTS)
+        line = ','.join(f'"{str(value).replace(".", ",")}"' for value in INPUTS.values())
+        batch = self.create(io.BytesIO(f"{header}\n{line}\n".encode()), fmt='csv')
+        self.assertEqual(batch.accepted_count, 1)
+        self.assertEqual(batch.reports.get().inputs_data['faturamento_anual'], 1200000.0)
+
+    def test_rows_beyond_max_reports_are_rejected(self):
+        batch = self.create(jsonl(INPUTS, INPUTS, INPUTS), max_reports=2, quota_reserved=True)
+        self.assertEqual((batch.accepted_count, batch.rejected_count), (2, 1))
+        self.assertEqual(batch.reports.filter(quota_reserved=True).count(), 2)
+
+    def test_unreadable_file_leaves_no_batch(self):
+        with self.assertRaises(UnicodeDecodeError):
+            self.create(io.BytesIO(b'\xff\xfe\xfa'))
+        self.assertFalse(ValuationBatch.objects.exists())
+
+    def test_read_error_after_a_dispatched_chunk_keeps_the_batch(self):
+        # O TextIOWrapper decodifica em blocos de 8 KB: o erro só aparece depois de várias linhas
+        stream = io.BytesIO(b"\n".join(json.dumps(INPUTS).encode() for _ in range(100)) + b"\n\xff\xfe\n")
+        batch = self.create(stream)
+        self.assertGreater(batch.accepted_count, 0)
+        self.assertEqual(sum(len(chunk) for chunk in self.dispatched_chunks()), batch.accepted_count)
+        self.assertEqual(batch.reports.count(), batch.accepted_count)
+        self.assertIn("Não foi possível ler", batch.errors[-1]['erro'])
+
+    def test_broker_failure_fails_chunk_and_releases_quota(self):
+        self.redis.set(quota_key(self.user.pk), 3)
+        self.group.return_value.apply_async.side_effect = ConnectionError("broker fora")
+        with self.assertLogs('chatbot.batch', 'ERROR'):
+            batch = self.create(jsonl(INPUTS, INPUTS, INPUTS), max_reports=3, quota_reserved=True)
+        self.assertEqual(batch.reports.filter(status=ValuationReport.StatusChoices.FAILED, quota_reserved=False, has_error=True).count(), 3)
+        self.assertEqual(self.redis.get(quota_key(self.user.pk)), '0')
+
+    def test_api_releases_unused_quota(self):
+        self.client.force_login(self.user)
+        upload = SimpleUploadedFile('carteira.jsonl', jsonl(INPUTS, {'faturamento_anual': -1}).getvalue())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('chatbot:api_batch'), {'file': upload})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.json()['accepted'], response.json()['rejected']), (1, 1))
+        self.assertEqual(self.redis.get(quota_key(self.user.pk)), '1') # 3 reservadas, 2 devolvidas
+
+
+@override_settings(RATE_LIMIT_BURST=2, RATE_LIMIT_PER_MINUTE=6)
+class QuotaTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw')
+
+    def test_reserve_is_seeded_from_database_and_capped(self):
+        CustomUser.objects.filter(pk=self.user.pk).update(usage_count=1)
+        create_report(self.user, status=ValuationReport.StatusChoices.PROCESSING, quota_reserved=True)
+        self.assertEqual(reserve_quota(self.user.pk, 3, count=5), 1) # 1 consumida + 1 em curso
+        self.assertEqual(reserve_quota(self.user.pk, 3), 0)
+        self.assertEqual(self.redis.get(quota_key(self.user.pk)), '3')
+        self.assertGreater(self.redis.ttl(quota_key(self.user.pk)), 0)
+
+    def test_release_never_goes_below_zero(self):
+        self.assertEqual(reserve_quota(self.user.pk, 3, count=2), 2)
+        release_quota(self.user.pk, count=5)
+        self.assertEqual(self.redis.get(quota_key(self.user.pk)), '0')
+        release_quota(self.user.pk + 1) # Sem chave: nada a devolver
+        self.assertIsNone(self.redis.get(quota_key(self.user.pk + 1)))
+
+    def test_sync_overwrites_counter_with_database(self):
+        self.redis.set(quota_key(self.user.pk), 3)
+        CustomUser.objects.filter(pk=self.user.pk).update(usage_count=1)
+        self.assertEqual(sync_quota(self.user.pk), 1)
+        self.assertEqual(reserve_quota(self.user.pk, 3, count=3), 2)
+
+    def test_rate_limit_burst_then_retry_after(self):
+        self.assertEqual(check_rate_limit(self.user.pk), (True, 0))
+        self.assertEqual(check_rate_limit(self.user.pk), (True, 0))
+        self.assertEqual(check_rate_limit(self.user.pk), (False, 10)) # 6/min: um token a cada 10 s
+
+
+class CalculateValuationAPITests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw')
+        self.client.force_login(self.user)
+        patcher = mock.patch.object(process_valuation_request, 'delay')
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, inputs=INPUTS, key=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return self.client.post(reverse('chatbot:api_calculate'), json.dumps({'inputs': inputs}),
+                                content_type='application/json', **headers)
+
+    def test_creates_report_and_reserves_quota(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+        report = ValuationReport.objects.get(pk=response.json()['report_id'])
+        self.assertTrue(report.quota_reserved)
+        self.assertIsNotNone(report.deadline_at)
+        self.delay.assert_called_once_with(report_id=report.id)
+        self.assertEqual(self.redis.get(quota_key(self.user.pk)), '1')
+
+    def test_quota_exhausted(self):
+        self.redis.set(quota_key(self.user.pk), 3)
+        self.assertEqual(self.post().status_code, 403)
+        self.assertFalse(ValuationReport.objects.exists())
+
+    @override_settings(RATE_LIMIT_BURST=1, RATE_LIMIT_PER_MINUTE=1)
+    def test_rate_limited_request_gets_retry_after(self):
+        self.assertEqual(self.post().status_code, 200)
+        response = self.post({**INPUTS, 'tempo_operacao_anos': 5})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(ValuationReport.objects.count(), 1)
+
+    def test_publish_failure_fails_report_and_releases_everything(self):
+        self.delay.side_effect = ConnectionError("broker fora")
+        with self.assertLogs('chatbot.views', 'ERROR'):
+            response = self.post(key='pedido-1')
+        self.assertEqual(response.status_code, 500)
+        report = ValuationReport.objects.get()
+        self.assertEqual((report.status, report.quota_reserved, report.has_error),
+                         (ValuationReport.StatusChoices.FAILED, False, True))
+        self.assertEqual(self.redis.get(quota_key(self.user.pk)), '0')
+        # A deduplicação foi desfeita: a repetição cria um relatório novo
+        self.delay.side_effect = None
+        response = self.post(key='pedido-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.json()['report_id'], report.id)
+
+    def test_same_key_replays_the_report(self):
+        first = self.post(key='pedido-1').json()['report_id']
+        response = self.post(key='pedido-1')
+        self.assertEqual((response.json()['report_id'], response.json()['duplicate']), (first, True))
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.delay.assert_called_once()
+        self.assertEqual(self.redis.get(quota_key(self.user.pk)), '1') # A repetição não gasta quota
+
+    def test_key_reused_with_other_inputs(self):
+        self.post(key='pedido-1')
+        self.assertEqual(self.post({**INPUTS, 'tempo_operacao_anos': 5}, key='pedido-1').status_code, 422)
+
+    def test_identical_request_in_flight(self):
+        ValuationRequestClaim(self.user.pk, '', INPUTS).acquire() # Outro pedido ainda a criar o relatório
+        response = self.post()
+        self.assertEqual((response.status_code, response['Retry-After']), (409, '1'))
+
+    def test_identical_inputs_replay_unless_window_is_off(self):
+        first = self.post().json()['report_id']
+        self.assertEqual(self.post().json()['report_id'], first)
+        with override_settings(VALUATION_DEDUPE_WINDOW_SECONDS=0):
+            self.assertNotEqual(self.post().json()['report_id'], first)
+
+    def test_failed_report_is_redone_for_same_inputs_but_replayed_for_same_key(self):
+        first = self.post(key='pedido-1').json()['report_id']
+        ValuationReport.objects.filter(pk=first).update(status=ValuationReport.StatusChoices.FAILED)
+        self.assertEqual(self.post(key='pedido-1').json()['report_id'], first)
+        second = self.post().json()['report_id']
+        self.assertNotEqual(second, first)
+
+    def test_deleted_report_is_claimed_again(self):
+        first = self.post(key='pedido-1').json()['report_id']
+        ValuationReport.objects.filter(pk=first).delete()
+        second = self.post(key='pedido-1').json()['report_id']
+        self.assertNotEqual(second, first)
+        # As duas chaves passaram a apontar para o relatório novo
+        self.assertEqual(self.post(key='pedido-1').json()['report_id'], second)
+        self.assertEqual(self.post().json()['report_id'], second)
+
+
+@override_settings(AGENT_SINGLE_FLIGHT_WAIT_SECONDS=5, AGENT_SINGLE_FLIGHT_LOCK_SECONDS=10)
+class SingleFlightTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('chatbot.single_flight.POLL_SECONDS', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_leader_computes_and_shares_result(self):
+        compute = mock.Mock(return_value={'valuation': 1})
+        self.assertEqual(run_single_flight('k', compute), ({'valuation': 1}, False))
+        self.assertFalse(self.redis.exists(LOCK_PREFIX + 'k'))
+        # Outro worker que chega enquanto o resultado existe não chama o Gemini
+        self.redis.set(LOCK_PREFIX + 'k', 'outro')
+        follower = mock.Mock()
+        self.assertEqual(run_single_flight('k', follower), ({'valuation': 1}, True))
+        follower.assert_not_called()
+
+    def test_errors_are_not_shared(self):
+        run_single_flight('k', lambda: {'error': 'falhou'})
+        self.assertFalse(self.redis.exists(RESULT_PREFIX + 'k'))
+
+    def test_follower_takes_over_when_leader_lock_disappears(self):
+        self.redis.set(LOCK_PREFIX + 'k', 'lider', px=50) # Líder que morreu sem resultado
+        result, shared = run_single_flight('k', lambda: {'valuation': 2})
+        self.assertEqual((result, shared), ({'valuation': 2}, False))
+
+    def test_wait_is_bounded(self):
+        self.redis.set(LOCK_PREFIX + 'k', 'lider')
+        with self.assertLogs('chatbot.single_flight', 'INFO'):
+            self.assertEqual(run_single_flight('k', lambda: {'valuation': 3}, max_wait=0.05), ({'valuation': 3}, False))
+        self.assertEqual(run_single_flight('k', lambda: {'valuation': 4}, max_wait=0), ({'valuation': 4}, False))
+        self.assertEqual(self.redis.get(LOCK_PREFIX + 'k'), 'lider') # A trava do líder não é tocada
+
+
+@override_settings(GEMINI_MAX_CONCURRENCY=1, GEMINI_TOKENS_PER_MINUTE=600, GEMINI_SLOT_LEASE_SECONDS=60, GEMINI_THROTTLE_COOLDOWN_SECONDS=30)
+class GeminiLimiterTests(FakeRedisMixin, SimpleTestCase):
+    def test_concurrency_slot_is_held_until_release(self):
+        slot = gemini_limiter.acquire(10, max_wait=0)
+        with self.assertRaises(GeminiCapacityExceeded) as raised:
+            gemini_limiter.acquire(10, max_wait=0)
+        self.assertEqual(raised.exception.reason, 'concurrency')
+        slot.release()
+        gemini_limiter.acquire(10, max_wait=0).release()
+        stats = limiter_stats()
+        self.assertEqual((stats['acquired'], stats['rejected_concurrency'], stats['in_flight']), (2, 1, 0))
+
+    def test_token_budget_and_usage_refund(self):
+        with gemini_call(500) as slot:
+            slot.record_usage(100) # Gastou menos do que o estimado: 400 voltam ao bucket
+        self.assertAlmostEqual(limiter_stats()['tokens_available'], 500, delta=5)
+        with self.assertRaises(GeminiCapacityExceeded) as raised:
+            gemini_limiter.acquire(600, max_wait=0)
+        self.assertEqual(raised.exception.reason, 'budget')
+        self.assertGreaterEqual(raised.exception.retry_after, 10) # ~100 tokens a 10 tokens/s
+        self.assertEqual(limiter_stats()['tokens_used'], 100)
+
+    def test_429_pauses_every_worker(self):
+        with self.assertRaises(GeminiCapacityExceeded) as raised, self.assertLogs('chatbot.gemini_limiter', 'WARNING'):
+            with gemini_call(10):
+                raise google_exceptions.ResourceExhausted('quota')
+        self.assertEqual((raised.exception.reason, raised.exception.retry_after), ('throttled', 30))
+        with self.assertRaises(GeminiCapacityExceeded) as raised:
+            gemini_limiter.acquire(10, max_wait=0)
+        self.assertEqual(raised.exception.reason, 'cooldown')
+        self.assertEqual(limiter_stats()['in_flight'], 0) # A vaga foi devolvida mesmo com o erro
+
+    def test_fails_open_without_redis(self):
+        with mock.patch('chatbot.gemini_limiter.get_redis', side_effect=redis_exceptions.ConnectionError('fora')), \
+             self.assertLogs('chatbot.gemini_limiter', 'WARNING'):
+            slot = gemini_limiter.acquire(10, max_wait=0)
+        self.assertIsNone(slot.slot_id)
+
+
+class DeadlineTests(TestCase):
+    def test_stage_budget(self):
+        now = timezone.now()
+        deadline = now + timedelta(seconds=100)
+        self.assertEqual(stage_budget(deadline, 30, now=now), 30)
+        self.assertEqual(stage_budget(deadline, 30, reserve=80, now=now), 20)
+        self.assertEqual(stage_budget(deadline, 30, reserve=120, now=now), -20)
+        # Sem prazo: só o teto da etapa
+        self.assertEqual(stage_budget(None, 30, reserve=1000, now=now), 30)
+
+    def test_remaining_seconds(self):
+        now = timezone.now()
+        self.assertEqual(remaining_seconds(now - timedelta(seconds=5), now=now), -5)
+        self.assertIsNone(remaining_seconds(None, now=now))
+
+    def test_fits_before_deadline(self):
+        deadline = timezone.now() + timedelta(seconds=100)
+        self.assertTrue(fits_before_deadline(deadline, 30, reserve=60))
+        self.assertFalse(fits_before_deadline(deadline, 30, reserve=80))
+        self.assertFalse(fits_before_deadline(timezone.now() - timedelta(seconds=1), 0))
+        self.assertTrue(fits_before_deadline(None, 10_000, reserve=10_000))
+
+    @override_settings(REPORT_DEADLINE_SECONDS=720)
+    def test_report_deadline(self):
+        now = timezone.now()
+        self.assertEqual(report_deadline(now), now + timedelta(seconds=720))
+
+    def test_mark_timeout_keeps_the_first_reason(self):
+        user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw')
+        report = create_report(user)
+        with self.assertLogs('chatbot.deadlines', 'WARNING'):
+            self.assertTrue(mark_timeout(report.id, TimeoutReason.GAMMA_GENERATION))
+        self.assertFalse(mark_timeout(report.id, TimeoutReason.EMAIL))
+        report.refresh_from_db()
+        self.assertEqual(report.timeout_reason, TimeoutReason.GAMMA_GENERATION)
@@ -10,4 +10,11 @@ urlpatterns = [
     
     # Endpoint da API para calcular
     path('api/calculate/', views.calculate_valuation_view, name='api_calculate'),
+
+    # Endpoint da API de status (polling com ETag, long-poll ou SSE)
+    path('api/status/', views.report_status_view, name='api_status'),
+
+    # Endpoints da API de valuation em lote (JSONL/CSV)
+    path('api/batch/', views.batch_valuation_view, name='api_batch'),
+    path('api/batch/<int:batch_id>/', views.batch_status_view, name='api_batch_status'),
 ]
\ No newline at end of file
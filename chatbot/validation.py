@@ -0,0 +1,60 @@
+# chatbot/validation.py
+
+# --- FUNÇÃO DE VALIDAÇÃO BACKEND (Exemplo) ---
+def validate_inputs_backend(inputs):
+    """Valida os tipos e regras dos inputs no backend."""
+    errors = {}
+    validated_data = {}
+
+    # Valida faturamento_anual (número > 0)
+    try:
+        val = float(inputs.get('faturamento_anual', 0))
+        if val <= 0: raise ValueError("Deve ser positivo.")
+        validated_data['faturamento_anual'] = val
+    except (TypeError, ValueError):
+        errors['faturamento_anual'] = "Faturamento anual inválido ou não informado."
+        
+    # Valida custos_operacionais_mensais (número >= 0)
+    try:
+        val = float(inputs.get('custos_operacionais_mensais', 0))
+        if val < 0: raise ValueError("Não pode ser negativo.")
+        validated_data['custos_operacionais_mensais'] = val
+    except (TypeError, ValueError):
+        errors['custos_operacionais_mensais'] = "Custo operacional mensal inválido."
+
+    # Valida aliquota_imposto_lucro_perc (0 a 100)
+    try:
+        val = float(inputs.get('aliquota_imposto_lucro_perc', 0))
+        if not (0 <= val <= 100): raise ValueError("Deve estar entre 0 e 100.")
+        validated_data['aliquota_imposto_lucro_perc'] = val
+    except (TypeError, ValueError):
+        errors['aliquota_imposto_lucro_perc'] = "Alíquota de imposto inválida."
+        
+    # Valida projecao_crescimento_anual_perc (número)
+    try:
+        val = float(inputs.get('projecao_crescimento_anual_perc', 0))
+        validated_data['projecao_crescimento_anual_perc'] = val # Pode ser negativo
+    except (TypeError, ValueError):
+        errors['projecao_crescimento_anual_perc'] = "Projeção de crescimento inválida."
+        
+    # Valida setor_atuacao (texto não vazio)
+    val = str(inputs.get('setor_atuacao', '')).strip()
+    if not val: errors['setor_atuacao'] = "Setor de atuação não informado."
+    else: validated_data['setor_atuacao'] = val
+    
+    # Valida tempo_operacao_anos (inteiro >= 0)
+    try:
+        val = int(inputs.get('tempo_operacao_anos', 0))
+        if val < 0: raise ValueError("Não pode ser negativo.")
+        validated_data['tempo_operacao_anos'] = val
+    except (TypeError, ValueError):
+         errors['tempo_operacao_anos'] = "Tempo de operação inválido."
+         
+    # Valida diferencial_competitivo (texto não vazio)
+    val = str(inputs.get('diferencial_competitivo', '')).strip()
+    if not val: errors['diferencial_competitivo'] = "Diferencial competitivo não informado."
+    else: validated_data['diferencial_competitivo'] = val
+
+    if errors:
+        return None, errors # Retorna None e o dicionário de erros
+    return validated_data, None # Retorna dados validados e None para erros
@@ -0,0 +1,199 @@
+# chatbot/valuation_engine.py
+"""
+Núcleo determinístico do valuation (Múltiplo de Faturamento).
+
+Tudo aqui é Python puro: sem rede, sem banco de dados e sem Django.
+O Gemini deixa de fazer contas e passa a receber estes números prontos,
+escrevendo apenas a narrativa e o prompt do Gamma.
+"""
+import re
+import unicodedata
+
+# --- Faixas de múltiplos de faturamento para PMEs ---
+# Cada setor tem (mínimo, máximo) e a lista de palavras-chave usadas para
+# reconhecer o texto livre digitado pelo utilizador (casadas no início de
+# cada palavra, sem acentos; "ti" só casa como palavra inteira). A ORDEM importa:
+# "Serviços de TI" precisa ser testado antes de "Tecnologia" e de "Serviços".
+SETORES = [
+    {
+        "nome": "Serviços de TI (Consultoria/Agência)",
+        "faixa": (1.0, 2.5),
+        "palavras_chave": ("servicos de ti", "consultoria de ti", "consultoria ti", "ti", "agencia", "outsourcing"),
+    },
+    {
+        "nome": "Tecnologia (SaaS/Software)",
+        "faixa": (2.0, 6.0),
+        "palavras_chave": ("saas", "software", "tecnologia", "tech", "aplicativo", "app", "plataforma digital", "startup"),
+    },
+    {
+        "nome": "Varejo Tradicional",
+        "faixa": (0.25, 0.75),
+        "palavras_chave": ("varejo", "loja", "comercio", "mercado", "supermercado", "e-commerce", "ecommerce"),
+    },
+    {
+        "nome": "Indústria",
+        "faixa": (0.4, 1.0),
+        "palavras_chave": ("industria", "fabrica", "manufatura", "metalurgia"),
+    },
+    {
+        "nome": "Serviços Gerais/Profissionais",
+        "faixa": (0.75, 2.0),
+        "palavras_chave": ("servico", "consultoria", "advocacia", "contabilidade", "clinica", "saude", "educacao", "escola", "profissional"),
+    },
+]
+SETOR_PADRAO = {"nome": "Outros/Não especificado", "faixa": (0.5, 1.5), "palavras_chave": ()}
+
+# SaaS com crescimento muito alto pode ultrapassar o teto da faixa
+CRESCIMENTO_TECNOLOGIA_PREMIUM_PERC = 40.0
+TETO_TECNOLOGIA_PREMIUM = 8.0
+
+# Referências para posicionar o múltiplo DENTRO da faixa
+CRESCIMENTO_REFERENCIA_PERC = 30.0  # crescimento >= 30% a.a. leva ao topo (no critério crescimento)
+TEMPO_OPERACAO_REFERENCIA_ANOS = 10  # 10+ anos de operação leva ao topo (no critério maturidade)
+PESO_CRESCIMENTO = 0.6
+PESO_TEMPO_OPERACAO = 0.4
+
+
+def _normalizar(texto: str) -> str:
+    """Minúsculas e sem acentos, para comparar o setor digitado com as palavras-chave."""
+    texto = unicodedata.normalize("NFKD", str(texto or ""))
+    return "".join(c for c in texto if not unicodedata.combining(c)).lower().strip()
+
+
+def _limitar(valor: float, minimo: float = 0.0, maximo: float = 1.0) -> float:
+    return max(minimo, min(maximo, valor))
+
+
+def calcular_lucro_liquido(faturamento_anual: float, custos_operacionais_mensais: float, aliquota_imposto_lucro_perc: float) -> float:
+    """
+    Lucro Líquido = (Faturamento Anual - Custos Mensais * 12) * (1 - Alíquota / 100).
+    O imposto só incide sobre lucro positivo (prejuízo não gera imposto negativo).
+    """
+    lucro_operacional = float(faturamento_anual) - float(custos_operacionais_mensais) * 12
+    if lucro_operacional <= 0:
+        return round(lucro_operacional, 2)
+    return round(lucro_operacional * (1 - float(aliquota_imposto_lucro_perc) / 100), 2)
+
+
+def identificar_setor(setor_atuacao: str) -> dict:
+    """Retorna o dicionário do setor (nome + faixa) correspondente ao texto livre informado."""
+    texto = _normalizar(setor_atuacao)
+    for setor in SETORES:
+        for palavra in setor["palavras_chave"]:
+            padrao = rf"\b{re.escape(palavra)}\b" if len(palavra) <= 3 else rf"\b{re.escape(palavra)}"
+            if re.search(padrao, texto):
+                return setor
+    return SETOR_PADRAO
+
+
+def faixa_multiplo(setor_atuacao: str, projecao_crescimento_anual_perc: float = 0.0) -> tuple:
+    """Faixa (mínimo, máximo) do múltiplo de faturamento para o setor informado."""
+    setor = identificar_setor(setor_atuacao)
+    minimo, maximo = setor["faixa"]
+    if setor["nome"].startswith("Tecnologia") and float(projecao_crescimento_anual_perc) > CRESCIMENTO_TECNOLOGIA_PREMIUM_PERC:
+        maximo = TETO_TECNOLOGIA_PREMIUM
+    return minimo, maximo
+
+
+def refinar_multiplo(faixa: tuple, projecao_crescimento_anual_perc: float, tempo_operacao_anos: int) -> float:
+    """
+    Posiciona o múltiplo dentro da faixa: crescimento maior e mais tempo
+    de operação levam o múltiplo para a parte superior da faixa.
+    """
+    minimo, maximo = faixa
+    nota_crescimento = _limitar(float(projecao_crescimento_anual_perc) / CRESCIMENTO_REFERENCIA_PERC)
+    nota_maturidade = _limitar(float(tempo_operacao_anos) / TEMPO_OPERACAO_REFERENCIA_ANOS)
+    posicao = PESO_CRESCIMENTO * nota_crescimento + PESO_TEMPO_OPERACAO * nota_maturidade
+    return round(minimo + (maximo - minimo) * posicao, 2)
+
+
+def formatar_brl(valor: float) -> str:
+    """Formata um número no padrão brasileiro: 1234567.8 -> 'R$ 1.234.567,80'."""
+    sinal = "-" if valor < 0 else ""
+    texto = f"{abs(float(valor)):,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
+    return f"{sinal}R$ {texto}"
+
+
+def formatar_multiplo(multiplo: float) -> str:
+    return f"{multiplo:.2f}x"
+
+
+def _justificativa(setor_nome: str, projecao_crescimento_anual_perc: float, tempo_operacao_anos: int) -> str:
+    if projecao_crescimento_anual_perc >= 20:
+        crescimento = "crescimento projetado alto"
+    elif projecao_crescimento_anual_perc >= 8:
+        crescimento = "crescimento projetado moderado"
+    elif projecao_crescimento_anual_perc >= 0:
+        crescimento = "crescimento projetado baixo"
+    else:
+        crescimento = "retração projetada"
+    maturidade = "empresa consolidada" if tempo_operacao_anos >= 5 else "empresa em fase inicial"
+    return f"Múltiplo escolhido devido ao setor de {setor_nome}, {crescimento} e {maturidade}."
+
+
+def calcular_valuation(inputs_data: dict, user_razao_social: str) -> dict:
+    """
+    Calcula o valuation a partir dos inputs validados por validate_inputs_backend.
+
+    Retorna as chaves numéricas e factuais do relatório (valuation_calculado,
+    metodologia_usada e a parte factual de resumo_para_gamma) e um bloco
+    'calculo' com os valores intermediários, usado para montar o prompt do Gemini.
+    """
+    faturamento = float(inputs_data["faturamento_anual"])
+    custos_mensais = float(inputs_data["custos_operacionais_mensais"])
+    aliquota = float(inputs_data["aliquota_imposto_lucro_perc"])
+    crescimento = float(inputs_data["projecao_crescimento_anual_perc"])
+    tempo_operacao = int(inputs_data["tempo_operacao_anos"])
+    setor_atuacao = inputs_data["setor_atuacao"]
+    diferencial = inputs_data["diferencial_competitivo"]
+
+    setor = identificar_setor(setor_atuacao)
+    faixa = faixa_multiplo(setor_atuacao, crescimento)
+    multiplo = refinar_multiplo(faixa, crescimento, tempo_operacao)
+    lucro_liquido = calcular_lucro_liquido(faturamento, custos_mensais, aliquota)
+    valuation = round(faturamento * multiplo, 2)
+
+    justificativa = _justificativa(setor["nome"], crescimento, tempo_operacao)
+    crescimento_str = f"{crescimento:g}%"
+
+    return {
+        "valuation_calculado": valuation,
+        "metodologia_usada": f"Múltiplo de Faturamento (Setor: {setor['nome']}, Múltiplo: {formatar_multiplo(multiplo)}) - {justificativa}",
+        "resumo_para_gamma": {
+            "empresa_nome": user_razao_social,
+            "setor": setor_atuacao,
+            "tempo_operacao": f"{tempo_operacao} anos",
+            "diferencial": diferencial,
+            "snapshot_financeiro": f"Faturamento Anual: {formatar_brl(faturamento)}, Lucratividade Líquida Anual Estimada: {formatar_brl(lucro_liquido)}",
+            "valuation_estimado": formatar_brl(valuation),
+            "metodologia_resumo": f"Baseado em Múltiplo de Faturamento de {formatar_multiplo(multiplo)} para o setor.",
+            "principais_drivers": f"Faturamento atual de {formatar_brl(faturamento)} e potencial de crescimento de {crescimento_str} no setor {setor_atuacao}.",
+            "pontos_fortes": f"Principalmente {diferencial} e {tempo_operacao} anos no mercado.",
+            "pontos_atencao": f"Dependência do crescimento projetado ({crescimento_str}), concorrência no setor e necessidade de gestão de custos.",
+        },
+        "calculo": {
+            "lucro_liquido_anual": lucro_liquido,
+            "setor_referencia": setor["nome"],
+            "faixa_multiplo": list(faixa),
+            "multiplo": multiplo,
+        },
+    }
+
+
+def gerar_prompt_gamma(resultado: dict) -> str:
+    """
+    Prompt padrão para o Gamma, montado só com os números do motor.
+    Usado quando o Gemini falha ou demora: o relatório continua completo.
+    """
+    resumo = resultado["resumo_para_gamma"]
+    calculo = resultado["calculo"]
+    empresa = resumo["empresa_nome"]
+    return (
+        f"Crie uma apresentação concisa sobre a empresa {empresa}. Use um tom profissional e visual atraente. "
+        f"Slide 1: Título 'Valuation Estimado - {empresa}'. "
+        f"Slide 2: Sobre a Empresa (Setor: {resumo['setor']}, Tempo de Operação: {resumo['tempo_operacao']}, Principal Diferencial: {resumo['diferencial']}). "
+        f"Slide 3: Snapshot Financeiro ({resumo['snapshot_financeiro']}). "
+        f"Slide 4: Valuation Estimado (Valor: {resumo['valuation_estimado']}, Metodologia: Múltiplo de Faturamento {formatar_multiplo(calculo['multiplo'])}). "
+        f"Slide 5: Análise Resumida (Principais Drivers: {resumo['principais_drivers']} Pontos Fortes: {resumo['pontos_fortes']} Pontos de Atenção: {resumo['pontos_atencao']}). "
+        "Slide 6: Próximos Passos (Sugira foco em crescimento sustentável e otimização de custos)."
+    )
@@ -1,95 +1,139 @@
 # chatbot/views.py
+import csv
+import hashlib
 import json
-from django.http import JsonResponse
-from django.views.decorators.http import require_POST
+import logging
+import time
+import redis
+from datetime import timedelta
+from django.conf import settings
+from django.http import JsonResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.views.decorators.http import require_POST, require_GET
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
-from django.shortcuts import render
-from reports.models import ValuationReport
+from django.shortcuts import render, get_object_or_404
+from reports.models import ValuationReport, ValuationBatch
+from reports.views import REPORT_LIST_FIELDS
 from .tasks import process_valuation_request
+from .notifications import ReportUpdateListener
+from .validation import validate_inputs_backend
+from .batch import create_batch, batch_progress, detect_format, BatchFormatError
+from .quota import check_rate_limit, reserve_quota, release_quota
+from valuation.tracing import traced_view, annotate
+from .deadlines import report_deadline
+from .idempotency import ValuationRequestClaim, IdempotencyConflict, IdempotencyKeyError, clean_idempotency_key
 # Remova a importação antiga de CustomUser se não for mais usada aqui
 
+logger = logging.getLogger(__name__)
+
 MAX_FREE_USES = 3
+DASHBOARD_RECENT_REPORTS = 5 # Relatórios na lista "recentes" do dashboard
+
+# --- Endpoint de status ---
+MAX_STATUS_IDS = 20 # Máximo de relatórios por consulta
+# Long-poll e SSE só com settings.STATUS_REALTIME_ENABLED (workers gevent, ver entrypoint.sh)
+STATUS_LONG_POLL_MAX_WAIT = 25 # Segundos
+STATUS_STREAM_MAX_SECONDS = 55 # O EventSource reconecta sozinho depois disso
+STATUS_STREAM_HEARTBEAT = 15
+STATUS_QUEUE_REFRESH_SECONDS = 15 # Posição na fila (COUNT) recalculada no máximo a cada N segundos no SSE
+IN_FLIGHT_STATUSES = (ValuationReport.StatusChoices.PENDING, ValuationReport.StatusChoices.PROCESSING)
 
 @login_required
 def dashboard_view(request):
+    # Só os 5 mais recentes, e só as colunas que a lista mostra
     context = {
-        'reports': request.user.reports.all().order_by('-created_at')
+        'reports': request.user.reports.only(*REPORT_LIST_FIELDS).order_by('-created_at', '-id')[:DASHBOARD_RECENT_REPORTS],
+        'status_realtime': settings.STATUS_REALTIME_ENABLED,
+        'status_poll_interval_ms': settings.STATUS_POLL_INTERVAL_SECONDS * 1000,
     }
     return render(request, 'chatbot/dashboard.html', context)
 
-# --- FUNÇÃO DE VALIDAÇÃO BACKEND (Exemplo) ---
-def validate_inputs_backend(inputs):
-    """Valida os tipos e regras dos inputs no backend."""
-    errors = {}
-    validated_data = {}
+def _rate_limit_response(user):
+    """Resposta 429 (com Retry-After) se o utilizador excedeu o limite de taxa; senão None."""
+    allowed, retry_after = check_rate_limit(user.id)
+    if allowed:
+        return None
+    response = JsonResponse({
+        "status": "error",
+        "message": f"Muitos pedidos seguidos. Tente novamente em {retry_after} segundo(s)."
+    }, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
 
-    # Valida faturamento_anual (número > 0)
-    try:
-        val = float(inputs.get('faturamento_anual', 0))
-        if val <= 0: raise ValueError("Deve ser positivo.")
-        validated_data['faturamento_anual'] = val
-    except (TypeError, ValueError):
-        errors['faturamento_anual'] = "Faturamento anual inválido ou não informado."
-        
-    # Valida custos_operacionais_mensais (número >= 0)
-    try:
-        val = float(inputs.get('custos_operacionais_mensais', 0))
-        if val < 0: raise ValueError("Não pode ser negativo.")
-        validated_data['custos_operacionais_mensais'] = val
-    except (TypeError, ValueError):
-        errors['custos_operacionais_mensais'] = "Custo operacional mensal inválido."
 
-    # Valida aliquota_imposto_lucro_perc (0 a 100)
-    try:
-        val = float(inputs.get('aliquota_imposto_lucro_perc', 0))
-        if not (0 <= val <= 100): raise ValueError("Deve estar entre 0 e 100.")
-        validated_data['aliquota_imposto_lucro_perc'] = val
-    except (TypeError, ValueError):
-        errors['aliquota_imposto_lucro_perc'] = "Alíquota de imposto inválida."
-        
-    # Valida projecao_crescimento_anual_perc (número)
-    try:
-        val = float(inputs.get('projecao_crescimento_anual_perc', 0))
-        validated_data['projecao_crescimento_anual_perc'] = val # Pode ser negativo
-    except (TypeError, ValueError):
-        errors['projecao_crescimento_anual_perc'] = "Projeção de crescimento inválida."
-        
-    # Valida setor_atuacao (texto não vazio)
-    val = str(inputs.get('setor_atuacao', '')).strip()
-    if not val: errors['setor_atuacao'] = "Setor de atuação não informado."
-    else: validated_data['setor_atuacao'] = val
-    
-    # Valida tempo_operacao_anos (inteiro >= 0)
-    try:
-        val = int(inputs.get('tempo_operacao_anos', 0))
-        if val < 0: raise ValueError("Não pode ser negativo.")
-        validated_data['tempo_operacao_anos'] = val
-    except (TypeError, ValueError):
-         errors['tempo_operacao_anos'] = "Tempo de operação inválido."
-         
-    # Valida diferencial_competitivo (texto não vazio)
-    val = str(inputs.get('diferencial_competitivo', '')).strip()
-    if not val: errors['diferencial_competitivo'] = "Diferencial competitivo não informado."
-    else: validated_data['diferencial_competitivo'] = val
-
-    if errors:
-        return None, errors # Retorna None e o dicionário de erros
-    return validated_data, None # Retorna dados validados e None para erros
+def _quota_exceeded_response():
+    return JsonResponse({
+        "status": "error",
+        "message": "Você atingiu seu limite de simulações gratuitas."
+    }, status=403)
+
+
+def _existing_valuation_report(user, claim):
+    """
+    Relatório já criado para um pedido repetido (mesma Idempotency-Key ou
+    mesmos inputs dentro da janela), ou None se o pedido é novo (e a reserva
+    ficou com este pedido). Um relatório que falhou não bloqueia uma nova
+    simulação com os mesmos inputs (só a Idempotency-Key repete a resposta
+    original); um relatório apagado não bloqueia nenhuma das duas.
+    """
+    # Cada volta desfaz uma associação obsoleta; mais do que isso é corrida com outro pedido
+    for _ in range(3):
+        report_id = claim.acquire()
+        if report_id is None:
+            return None
+        report = ValuationReport.objects.filter(user=user, id=report_id).only('id', 'status').first()
+        if report is None:
+            claim.forget(report_id, idempotency_key=True)
+        elif report.status == ValuationReport.StatusChoices.FAILED and claim.source == 'inputs':
+            claim.forget(report_id)
+        else:
+            return report
+    raise IdempotencyConflict()
+
+
+def _abandon_report(report, claim):
+    """
+    A tarefa não chegou à fila (broker indisponível): o relatório fica FAILED
+    em vez de PENDING para sempre, a reserva de quota é devolvida uma única
+    vez (UPDATE condicional, como em tasks.py) e a deduplicação é desfeita.
+    """
+    abandoned = ValuationReport.objects.filter(pk=report.pk, quota_reserved=True).update(
+        quota_reserved=False,
+        status=ValuationReport.StatusChoices.FAILED,
+        result_data={"error": "Não foi possível iniciar a análise. Tente novamente."},
+        valuation_calculado=None,
+        has_error=True,
+    )
+    if abandoned:
+        release_quota(report.user_id)
+    claim.release()
+
+
+def _valuation_started_response(report_id, duplicate=False):
+    response = JsonResponse({
+        "status": "success",
+        "message": "Sua análise foi iniciada! O resultado aparecerá no seu dashboard em breve.",
+        "report_id": report_id,
+        "duplicate": duplicate,
+    })
+    if duplicate:
+        response['Idempotent-Replayed'] = 'true'
+    return response
+
 
 # --- View da API Atualizada ---
 @login_required
 @require_POST
 @csrf_exempt # Mantenha se não quiser configurar o token CSRF no JS
+@traced_view('chatbot.calculate_valuation')
 def calculate_valuation_view(request):
     """Recebe dados do chatbot, VALIDA NO BACKEND, e inicia a tarefa."""
     try:
-        if request.user.usage_count >= MAX_FREE_USES:
-            return JsonResponse({
-                "status": "error",
-                "message": "Você atingiu seu limite de simulações gratuitas."
-            }, status=403)
+        idempotency_key = clean_idempotency_key(request.headers.get('Idempotency-Key'))
+    except IdempotencyKeyError as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=400)
 
+    try:
         data = json.loads(request.body)
         raw_inputs = data.get('inputs')
 
@@ -108,25 +152,267 @@ def calculate_valuation_view(request):
                 "details": errors # Opcional: envia detalhes dos erros
             }, status=400) # Bad Request
 
+        # Pedido repetido (duplo clique, retentativa): devolve o relatório já
+        # criado, sem gastar quota nem disparar outra tarefa
+        claim = ValuationRequestClaim(request.user.id, idempotency_key, validated_inputs)
+        try:
+            existing_report = _existing_valuation_report(request.user, claim)
+        except IdempotencyConflict as e:
+            if e.reused:
+                return JsonResponse({"status": "error", "message": str(e)}, status=422)
+            response = JsonResponse({"status": "error", "message": "Pedido idêntico em processamento. Tente novamente."}, status=409)
+            response['Retry-After'] = '1'
+            return response
+        if existing_report is not None:
+            annotate(report_id=existing_report.id, duplicate=True)
+            return _valuation_started_response(existing_report.id, duplicate=True)
+
+        # Limite de taxa antes de qualquer escrita no banco ou tarefa (repetições não contam)
+        rate_limited = _rate_limit_response(request.user)
+        if rate_limited:
+            claim.release()
+            return rate_limited
+
+        # Reserva atómica de uma simulação (pedidos paralelos não passam do limite)
+        if not reserve_quota(request.user.id, MAX_FREE_USES):
+            claim.release()
+            return _quota_exceeded_response()
+
         # Cria o Relatório com os DADOS VALIDADOS
-        report = ValuationReport.objects.create(
-            user=request.user,
-            inputs_data=validated_inputs, # USA OS DADOS VALIDADOS
-            status=ValuationReport.StatusChoices.PENDING
-        )
+        try:
+            report = ValuationReport.objects.create(
+                user=request.user,
+                inputs_data=validated_inputs, # USA OS DADOS VALIDADOS
+                status=ValuationReport.StatusChoices.PENDING,
+                quota_reserved=True,
+                deadline_at=report_deadline(), # Prazo global: cada etapa recebe um orçamento do que resta
+            )
+        except Exception:
+            release_quota(request.user.id)
+            claim.release()
+            raise
+        annotate(report_id=report.id)
 
-        # Inicia a tarefa Celery
-        process_valuation_request.delay(report_id=report.id)
+        # Inicia a tarefa Celery; só depois as chaves passam a apontar para o relatório
+        try:
+            process_valuation_request.delay(report_id=report.id)
+        except Exception:
+            _abandon_report(report, claim)
+            raise
+        claim.complete(report.id)
 
-        return JsonResponse({
-            "status": "success",
-            "message": "Sua análise foi iniciada! O resultado aparecerá no seu dashboard em breve.",
-            "report_id": report.id
-        })
+        return _valuation_started_response(report.id)
 
     except json.JSONDecodeError:
         return JsonResponse({"status": "error", "message": "JSON mal formatado."}, status=400)
     except Exception as e:
         # Logar o erro real no servidor
-        print(f"Erro inesperado na view calculate_valuation: {e}") 
-        return JsonResponse({"status": "error", "message": "Ocorreu um erro inesperado no servidor."}, status=500)
\ No newline at end of file
+        logger.exception(f"Erro inesperado na view calculate_valuation: {e}")
+        return JsonResponse({"status": "error", "message": "Ocorreu um erro inesperado no servidor."}, status=500)
+
+
+# --- API de Status dos Relatórios ---
+def _parse_report_ids(raw):
+    """'1,2,3' -> [1, 2, 3] (ignora valores inválidos, limita a MAX_STATUS_IDS)."""
+    ids = []
+    for part in (raw or '').split(','):
+        part = part.strip()
+        if part.isdigit() and int(part) not in ids:
+            ids.append(int(part))
+    return ids[:MAX_STATUS_IDS]
+
+
+def report_status_payload(user, report_ids, queue_positions=None):
+    """
+    Estado resumido dos relatórios do utilizador (sem carregar os JSONs inteiros),
+    com posição na fila e previsão de conclusão para os que ainda estão na fila.
+
+    queue_positions (id -> posição) reaproveita posições já calculadas; as
+    que faltam são calculadas e acrescentadas ao dict.
+    """
+    rows = (
+        ValuationReport.objects
+        .filter(user=user, id__in=report_ids)
+        .order_by('-created_at')
+        .values('id', 'status', 'created_at', 'updated_at', 'gamma_presentation_url',
+                'gamma_status', 'valuation_calculado', 'timeout_reason')
+    )
+    avg_seconds = settings.REPORT_AVG_PROCESSING_SECONDS
+    payload = []
+    for row in rows:
+        in_flight = row['status'] in IN_FLIGHT_STATUSES
+        gamma_status = row['gamma_status']
+        queue_position = None
+        estimated_completion = None
+        if in_flight:
+            if queue_positions is not None and row['id'] in queue_positions:
+                queue_position = queue_positions[row['id']]
+            else:
+                # Relatórios (de todos os utilizadores) que entraram antes e ainda não terminaram
+                queue_position = ValuationReport.objects.filter(
+                    status__in=IN_FLIGHT_STATUSES, created_at__lt=row['created_at']
+                ).count()
+                if queue_positions is not None:
+                    queue_positions[row['id']] = queue_position
+            estimated_completion = row['created_at'] + timedelta(seconds=(queue_position + 1) * avg_seconds)
+        payload.append({
+            'id': row['id'],
+            'status': row['status'],
+            'gamma_status': gamma_status,
+            'valuation_calculado': row['valuation_calculado'],
+            'gamma_presentation_url': row['gamma_presentation_url'],
+            'timeout_reason': row['timeout_reason'] or None,
+            'updated_at': row['updated_at'].isoformat(),
+            'queue_position': queue_position,
+            'estimated_completion': estimated_completion.isoformat() if estimated_completion else None,
+            # Final: nada mais vai mudar (falhou, ou concluiu sem Gamma pendente)
+            'final': not in_flight and gamma_status != 'pending',
+        })
+    return payload
+
+
+def _status_etag(payload):
+    return '"' + hashlib.md5(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest() + '"'
+
+
+def _report_status_stream(user, report_ids):
+    """Gerador Server-Sent Events: envia o estado sempre que um aviso do Redis chega."""
+    listener = ReportUpdateListener(user.id, report_ids)
+    try:
+        started = time.monotonic()
+        last_etag = None
+        # Cada aviso do Redis relê o estado, mas não refaz o COUNT da fila a cada evento
+        queue_positions = {}
+        queue_refreshed = started
+        yield "retry: 3000\n\n"
+        while time.monotonic() - started < STATUS_STREAM_MAX_SECONDS:
+            if time.monotonic() - queue_refreshed >= STATUS_QUEUE_REFRESH_SECONDS:
+                queue_positions.clear()
+                queue_refreshed = time.monotonic()
+            payload = report_status_payload(user, report_ids, queue_positions)
+            etag = _status_etag(payload)
+            if etag != last_etag:
+                yield f"id: {etag}\ndata: {json.dumps({'reports': payload})}\n\n"
+                last_etag = etag
+            if all(item['final'] for item in payload):
+                yield "event: done\ndata: {}\n\n"
+                return
+            if not listener.wait(STATUS_STREAM_HEARTBEAT):
+                yield ": keep-alive\n\n"
+    finally:
+        listener.close()
+
+
+@login_required
+@require_GET
+def report_status_view(request):
+    """
+    Status de um ou vários relatórios: GET ?ids=1,2,3
+
+    - Polling simples com ETag / If-None-Match (responde 304 se nada mudou).
+    - Long-poll: &wait=N segura a resposta até N segundos à espera de mudança.
+    - SSE: &stream=1 devolve text/event-stream alimentado pelo Redis pub/sub.
+
+    Long-poll e SSE prendem o worker durante a espera: só são atendidos com
+    settings.STATUS_REALTIME_ENABLED (Gunicorn com gevent); sem isso, wait e
+    stream são ignorados e a resposta é a do polling simples.
+    """
+    realtime = settings.STATUS_REALTIME_ENABLED
+    report_ids = _parse_report_ids(request.GET.get('ids'))
+    if not report_ids:
+        return JsonResponse({"status": "error", "message": "Informe os ids dos relatórios (?ids=1,2)."}, status=400)
+
+    try:
+        if realtime and request.GET.get('stream') == '1':
+            response = StreamingHttpResponse(_report_status_stream(request.user, report_ids), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no' # Evita buffering em proxies (nginx)
+            return response
+
+        payload = report_status_payload(request.user, report_ids)
+        etag = _status_etag(payload)
+        client_etag = request.headers.get('If-None-Match')
+
+        # Long-poll: o cliente já tem este estado, então espera por uma mudança
+        try:
+            wait = min(int(request.GET.get('wait', 0)), STATUS_LONG_POLL_MAX_WAIT) if realtime else 0
+        except ValueError:
+            wait = 0
+        if wait > 0 and client_etag == etag and not all(item['final'] for item in payload):
+            listener = ReportUpdateListener(request.user.id, report_ids)
+            try:
+                listener.wait(wait)
+            finally:
+                listener.close()
+            payload = report_status_payload(request.user, report_ids)
+            etag = _status_etag(payload)
+    except redis.RedisError:
+        # Sem Redis não há SSE/long-poll: o cliente volta ao polling simples
+        return JsonResponse({"status": "error", "message": "Atualizações em tempo real indisponíveis."}, status=503)
+
+    if client_etag == etag:
+        return HttpResponseNotModified(headers={'ETag': etag})
+    response = JsonResponse({'reports': payload})
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+
+# --- API de Valuation em Lote (JSONL/CSV) ---
+@login_required
+@require_POST
+@csrf_exempt # Mesmo tratamento da API de cálculo
+@traced_view('chatbot.batch_valuation')
+def batch_valuation_view(request):
+    """
+    Recebe um ficheiro JSONL ou CSV (campo 'file', multipart) com vários
+    conjuntos de inputs e cria um lote de relatórios. Responde com o id do
+    lote, cujo progresso é consultado em batch_status_view.
+    """
+    uploaded = request.FILES.get('file')
+    if not uploaded:
+        return JsonResponse({"status": "error", "message": "Envie o ficheiro no campo 'file'."}, status=400)
+    try:
+        fmt = detect_format(uploaded.name, request.POST.get('format'))
+    except BatchFormatError as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=400)
+
+    rate_limited = _rate_limit_response(request.user)
+    if rate_limited:
+        return rate_limited
+
+    # Utilizadores comuns só podem criar relatórios até ao limite gratuito:
+    # reserva o que resta da quota e devolve depois o que o ficheiro não usou
+    max_reports = None
+    if not request.user.is_staff:
+        max_reports = reserve_quota(request.user.id, MAX_FREE_USES, count=MAX_FREE_USES)
+        if max_reports == 0:
+            return _quota_exceeded_response()
+
+    batch = None
+    try:
+        batch = create_batch(
+            request.user, uploaded.file, fmt, source_name=uploaded.name,
+            max_reports=max_reports, quota_reserved=max_reports is not None,
+        )
+    except (UnicodeDecodeError, csv.Error) as e:
+        return JsonResponse({"status": "error", "message": f"Não foi possível ler o ficheiro: {e}"}, status=400)
+    finally:
+        # Devolve a reserva que o lote não usou (toda, se o lote não foi criado por qualquer erro)
+        if max_reports:
+            release_quota(request.user.id, max_reports - (batch.accepted_count if batch else 0))
+
+    return JsonResponse({
+        "status": "success",
+        "message": f"Lote iniciado com {batch.accepted_count} relatório(s).",
+        **batch_progress(batch),
+    }, status=202)
+
+
+@login_required
+@require_GET
+def batch_status_view(request, batch_id):
+    """Progresso agregado de um lote do utilizador."""
+    batch = get_object_or_404(ValuationBatch, pk=batch_id, user=request.user)
+    return JsonResponse(batch_progress(batch))
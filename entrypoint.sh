@@ -9,8 +9,21 @@ set -e
 # and Render's worker service will implicitly override this CMD when it starts.
 
 # Default command (will be run by the web service)
-echo "Starting Gunicorn..."
-exec gunicorn valuation.wsgi:application --bind 0.0.0.0:${PORT:-8000}
+# Sync workers by default: the dashboard uses short ETag polling. SSE and
+# long-poll on the status API (STATUS_REALTIME_ENABLED=True) hold the
+# connection open, so they need an async worker (gevent) that keeps
+# heartbeating and serves other requests while a stream is open.
+if [ "${STATUS_REALTIME_ENABLED:-False}" = "True" ]; then
+    GUNICORN_WORKER_CLASS="${GUNICORN_WORKER_CLASS:-gevent}"
+else
+    GUNICORN_WORKER_CLASS="${GUNICORN_WORKER_CLASS:-sync}"
+fi
+echo "Starting Gunicorn (${GUNICORN_WORKER_CLASS} workers)..."
+exec gunicorn valuation.wsgi:application --bind 0.0.0.0:${PORT:-8000} \
+    --worker-class "${GUNICORN_WORKER_CLASS}" \
+    --workers "${WEB_CONCURRENCY:-2}" \
+    --worker-connections "${GUNICORN_WORKER_CONNECTIONS:-200}" \
+    --timeout "${GUNICORN_TIMEOUT:-30}"
 
 # Note: For the worker, Render will likely execute the container without
 # overriding the command specified in the Dockerfile's CMD if we don't
@@ -1,22 +1,52 @@
 # reports/admin.py
+from datetime import timedelta
 from django.contrib import admin
-from .models import ValuationReport
+from django.db.models import Q
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+from valuation.admin_mixins import LargeTableAdminMixin, digits_only
+from .metrics import PERCENTILES, stage_percentiles, usage_summary
+from .models import ValuationReport, ReportMetrics
+from .page_cache import invalidate_report_page
 import json # Para formatar o JSON
 from django.utils.safestring import mark_safe # Para exibir HTML formatado
 
 @admin.register(ValuationReport)
-class ValuationReportAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user_link', 'status', 'created_at', 'gamma_link_display')
-    list_filter = ('status', 'created_at')
-    search_fields = ('user__razao_social', 'user__cnpj', 'id')
-    readonly_fields = ('user', 'inputs_data_formatted', 'result_data_formatted', 'created_at', 'updated_at', 'gamma_presentation_url') # Campos não editáveis no admin
+class ValuationReportAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ('id', 'user_link', 'status', 'gamma_status', 'valuation_calculado', 'created_at', 'gamma_link_display')
+    list_filter = ('status', 'gamma_status', 'has_error', 'timeout_reason', 'created_at')
+    # Busca por id, prefixo de CNPJ ou razão social (ver get_search_results)
+    search_fields = ('=id', '^user__cnpj', 'user__razao_social')
+    search_help_text = "Id do relatório, CNPJ (ou início dele) ou razão social"
+    list_select_related = ('user',) # Um JOIN em vez de uma query por linha
+    list_deferred_fields = ('inputs_data', 'result_data') # JSONs não aparecem na listagem
+    readonly_fields = ('user', 'inputs_data_formatted', 'result_data_formatted', 'created_at', 'updated_at', 'gamma_presentation_url', 'valuation_calculado', 'has_error', 'deadline_at', 'timeout_reason') # Campos não editáveis no admin
     list_display_links = ('id',) # Torna o ID clicável
 
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Escolhe UMA condição indexável conforme o termo, em vez do OR de
+        icontains em todos os campos: números -> id ou prefixo do CNPJ
+        (índice de padrão do campo unique; só prefixo, sem busca no meio),
+        texto -> razão social (índice de trigramas em users).
+        """
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        digits = digits_only(term)
+        if digits:
+            condition = Q(user__cnpj__startswith=digits)
+            if len(digits) <= 12: # Ids curtos; um CNPJ completo tem 14 dígitos
+                condition |= Q(id=int(digits))
+            return queryset.filter(condition), False
+        return queryset.filter(user__razao_social__icontains=term), False
+
     # Campo customizado para exibir o user como link
     def user_link(self, obj):
         from django.urls import reverse
         from django.utils.html import format_html
-        link = reverse("admin:users_customuser_change", args=[obj.user.id])
+        link = reverse("admin:users_customuser_change", args=[obj.user_id])
         return format_html('<a href="{}">{}</a>', link, obj.user)
     user_link.short_description = 'Usuário' # Nome da coluna
 
@@ -38,15 +68,90 @@ class ValuationReportAdmin(admin.ModelAdmin):
         return mark_safe(f'<pre>{formatted_json}</pre>')
     result_data_formatted.short_description = 'Resultado da IA (JSON)'
 
+    # Edições e remoções feitas aqui descartam a página em cache (reports/page_cache.py)
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_report_page(obj.pk, obj.user_id)
+
+    def delete_model(self, request, obj):
+        invalidate_report_page(obj.pk, obj.user_id)
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        for report_id, user_id in queryset.values_list('pk', 'user_id'):
+            invalidate_report_page(report_id, user_id)
+        super().delete_queryset(request, queryset)
+
     # Organiza os campos no formulário de visualização/edição
     fieldsets = (
         (None, {
-            'fields': ('user', 'status', 'created_at', 'updated_at')
+            'fields': ('user', 'status', 'created_at', 'updated_at', 'deadline_at', 'timeout_reason')
         }),
         ('Dados Coletados', {
             'fields': ('inputs_data_formatted',),
         }),
         ('Resultados', {
-            'fields': ('result_data_formatted', 'gamma_presentation_url')
+            'fields': ('result_data_formatted', 'gamma_status', 'valuation_calculado', 'has_error', 'gamma_presentation_url')
         }),
-    )
\ No newline at end of file
+    )
+
+
+# Janelas da página de percentis: parâmetro ?window= -> (descrição, duração)
+METRICS_WINDOWS = {
+    '1h': ('Última hora', timedelta(hours=1)),
+    '24h': ('Últimas 24 horas', timedelta(hours=24)),
+    '7d': ('Últimos 7 dias', timedelta(days=7)),
+    '30d': ('Últimos 30 dias', timedelta(days=30)),
+}
+DEFAULT_METRICS_WINDOW = '24h'
+
+
+@admin.register(ReportMetrics)
+class ReportMetricsAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ('report', 'processing_started_at', 'agent_source', 'agent_provider', 'agent_hedged', 'queue_wait_ms',
+                    'gemini_ms', 'total_tokens', 'gamma_post_status', 'gamma_poll_count', 'gamma_generation_ms', 'end_to_end_ms')
+    list_filter = ('agent_source', 'agent_provider', 'agent_hedged', 'processing_started_at')
+    search_fields = ('=report__id',)
+    list_select_related = ('report',)
+    date_hierarchy = 'processing_started_at'
+    ordering = ('-processing_started_at',)
+    change_list_template = 'admin/reports/reportmetrics/change_list.html'
+
+    # Métricas são escritas só pelas tarefas
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        urls = [
+            path('percentis/', self.admin_site.admin_view(self.percentiles_view), name='reports_reportmetrics_percentiles'),
+        ]
+        return urls + super().get_urls()
+
+    def percentiles_view(self, request):
+        """p50/p95/p99 de cada etapa do pipeline na janela escolhida."""
+        window = request.GET.get('window', DEFAULT_METRICS_WINDOW)
+        if window not in METRICS_WINDOWS:
+            window = DEFAULT_METRICS_WINDOW
+        label, duration = METRICS_WINDOWS[window]
+        since = timezone.now() - duration
+        stages = stage_percentiles(since)
+        for stage in stages:
+            # Em segundos, na ordem de PERCENTILES
+            stage['seconds'] = [
+                round(stage[f'p{percentile}'] / 1000, 2) if stage[f'p{percentile}'] is not None else None
+                for percentile in PERCENTILES
+            ]
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': f"Percentis por etapa — {label}",
+            'windows': [(key, value[0]) for key, value in METRICS_WINDOWS.items()],
+            'window': window,
+            'percentiles': PERCENTILES,
+            'stages': stages,
+            'summary': usage_summary(since),
+        }
+        return TemplateResponse(request, 'admin/reports/reportmetrics/percentiles.html', context)
@@ -0,0 +1,62 @@
+# reports/backfill.py
+"""
+Preenchimento (backfill) das colunas gamma_status, valuation_calculado e
+has_error a partir do result_data dos relatórios já existentes.
+
+Corre em blocos por intervalo de id, cada bloco na sua própria transação
+curta, para não bloquear a tabela nem segurar um snapshot enorme: pode
+ser interrompido e retomado (--start-id) com a aplicação no ar. Usado pela
+migração 0008 e pelo comando backfill_report_columns.
+"""
+import logging
+import time
+from django.db import transaction
+from .models import result_columns
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_CHUNK_SIZE = 1000
+GAMMA_STATUSES = ('pending', 'completed', 'failed')
+
+
+def backfill_result_columns(report_model, chunk_size=BACKFILL_CHUNK_SIZE, start_id=0, pause_seconds=0.0, stdout=None):
+    """
+    Copia os campos do JSON para as colunas em todos os relatórios com id
+    >= start_id. Recebe o modelo como parâmetro para funcionar também com o
+    modelo histórico dentro de uma migração. Retorna quantas linhas mudou.
+    """
+    last_id = start_id - 1
+    updated_total = 0
+    while True:
+        rows = list(
+            report_model.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values('id', 'result_data', 'gamma_status', 'valuation_calculado', 'has_error')[:chunk_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+
+        changed = []
+        for row in rows:
+            data = row['result_data'] if isinstance(row['result_data'], dict) else {}
+            valuation, has_error = result_columns(data)
+            gamma_status = data.get('gamma_status') if data.get('gamma_status') in GAMMA_STATUSES else None
+            # Não sobrescreve uma coluna já preenchida pelo código novo
+            gamma_status = row['gamma_status'] or gamma_status
+            if (gamma_status, valuation, has_error) != (row['gamma_status'], row['valuation_calculado'], row['has_error']):
+                changed.append(report_model(id=row['id'], gamma_status=gamma_status, valuation_calculado=valuation, has_error=has_error))
+
+        if changed:
+            with transaction.atomic():
+                report_model.objects.bulk_update(changed, ['gamma_status', 'valuation_calculado', 'has_error'])
+            updated_total += len(changed)
+
+        message = f"Backfill até id {last_id}: {len(changed)} de {len(rows)} relatório(s) atualizados"
+        if stdout:
+            stdout.write(message)
+        logger.info(message)
+        if pause_seconds:
+            time.sleep(pause_seconds) # Dá folga ao banco entre blocos
+    return updated_total
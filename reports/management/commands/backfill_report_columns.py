@@ -0,0 +1,23 @@
+# reports/management/commands/backfill_report_columns.py
+from django.core.management.base import BaseCommand
+from reports.backfill import BACKFILL_CHUNK_SIZE, backfill_result_columns
+from reports.models import ValuationReport
+
+
+class Command(BaseCommand):
+    help = "Preenche gamma_status, valuation_calculado e has_error a partir do result_data, em blocos."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE, help="Relatórios por bloco")
+        parser.add_argument('--start-id', type=int, default=0, help="Retoma a partir deste id")
+        parser.add_argument('--pause', type=float, default=0.0, help="Pausa em segundos entre blocos")
+
+    def handle(self, *args, **options):
+        updated = backfill_result_columns(
+            ValuationReport,
+            chunk_size=options['chunk_size'],
+            start_id=options['start_id'],
+            pause_seconds=options['pause'],
+            stdout=self.stdout,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Backfill concluído: {updated} relatório(s) atualizados."))
@@ -0,0 +1,11 @@
+# reports/management/commands/report_page_cache_stats.py
+from django.core.management.base import BaseCommand
+from reports.page_cache import page_cache_stats
+
+
+class Command(BaseCommand):
+    help = "Mostra os contadores do cache da página de detalhe de relatório (hits, misses, invalidações, hit rate)."
+
+    def handle(self, *args, **options):
+        for name, value in page_cache_stats().items():
+            self.stdout.write(f"{name}: {value}")
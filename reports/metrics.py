@@ -0,0 +1,142 @@
+# reports/metrics.py
+"""
+Registo das métricas por relatório (ReportMetrics) e percentis por etapa.
+
+As tarefas Celery chamam record_metrics(report_id, campo=valor, ...) ao fim
+de cada etapa; contadores usam F() (ex: gamma_poll_count=F('gamma_poll_count') + 1).
+Uma falha ao gravar métricas é só registada no log: nunca interrompe o
+pipeline do relatório.
+
+stage_percentiles() calcula p50/p95/p99 de cada etapa numa janela de tempo:
+no PostgreSQL com percentile_cont (uma query), noutros bancos em Python.
+"""
+import logging
+import math
+import time
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Aggregate, Count, FloatField, Q, Sum
+from django.utils import timezone
+from .models import ReportMetrics
+
+logger = logging.getLogger(__name__)
+
+# (campo, descrição) na ordem do pipeline
+STAGES = (
+    ('queue_wait_ms', 'Fila até iniciar o valuation'),
+    ('engine_ms', 'Motor determinístico'),
+    ('gemini_ms', 'Agente Gemini'),
+    ('valuation_ms', 'Tarefa de valuation (total)'),
+    ('gamma_post_ms', 'Gamma: POST de geração'),
+    ('gamma_poll_http_ms', 'Gamma: consultas de status (HTTP)'),
+    ('gamma_generation_ms', 'Gamma: geração até concluir'),
+    ('email_ms', 'E-mail: montagem e fila'),
+    ('end_to_end_ms', 'Ponta a ponta'),
+)
+PERCENTILES = (50, 95, 99)
+
+
+def elapsed_ms(started: float) -> int:
+    """Milissegundos desde started (time.monotonic())."""
+    return int((time.monotonic() - started) * 1000)
+
+
+def ms_between(start, end):
+    """Milissegundos entre dois datetimes (None se faltar algum)."""
+    if not start or not end:
+        return None
+    return max(0, int((end - start).total_seconds() * 1000))
+
+
+def record_metrics(report_id, **fields):
+    """Atualiza (ou cria) as métricas do relatório com os campos dados."""
+    fields['updated_at'] = timezone.now() # update() não aplica o auto_now
+    try:
+        if ReportMetrics.objects.filter(report_id=report_id).update(**fields):
+            return
+        try:
+            with transaction.atomic():
+                ReportMetrics.objects.create(report_id=report_id)
+        except IntegrityError:
+            pass # Criado em paralelo por outra tarefa
+        ReportMetrics.objects.filter(report_id=report_id).update(**fields)
+    except Exception as e:
+        logger.warning(f"Não foi possível gravar métricas do Report {report_id}: {e}")
+
+
+class PercentileCont(Aggregate):
+    """percentile_cont(f) WITHIN GROUP (ORDER BY expr) do PostgreSQL."""
+    function = 'PERCENTILE_CONT'
+    template = '%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, percentile, **extra):
+        super().__init__(expression, fraction=float(percentile) / 100, **extra)
+
+
+def interpolated_percentile(sorted_values, percentile):
+    """Mesma interpolação linear do percentile_cont."""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * percentile / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def stage_percentiles(since=None):
+    """
+    Lista de {'field', 'label', 'count', 'p50', 'p95', 'p99'} (ms) por etapa,
+    para os relatórios iniciados desde `since` (None = todos).
+    """
+    queryset = ReportMetrics.objects.all()
+    if since is not None:
+        queryset = queryset.filter(processing_started_at__gte=since)
+
+    rows = []
+    if connection.vendor == 'postgresql':
+        aggregates = {}
+        for field, _label in STAGES:
+            aggregates[f'{field}__count'] = Count(field)
+            for percentile in PERCENTILES:
+                aggregates[f'{field}__p{percentile}'] = PercentileCont(field, percentile)
+        values = queryset.aggregate(**aggregates)
+        for field, label in STAGES:
+            row = {'field': field, 'label': label, 'count': values[f'{field}__count']}
+            row.update({f'p{percentile}': values[f'{field}__p{percentile}'] for percentile in PERCENTILES})
+            rows.append(row)
+        return rows
+
+    for field, label in STAGES:
+        samples = sorted(queryset.filter(**{f'{field}__isnull': False}).values_list(field, flat=True))
+        row = {'field': field, 'label': label, 'count': len(samples)}
+        row.update({f'p{percentile}': interpolated_percentile(samples, percentile) for percentile in PERCENTILES})
+        rows.append(row)
+    return rows
+
+
+def usage_summary(since=None) -> dict:
+    """Totais de tokens, retentativas e origem das respostas do agente na janela."""
+    queryset = ReportMetrics.objects.all()
+    if since is not None:
+        queryset = queryset.filter(processing_started_at__gte=since)
+    summary = queryset.aggregate(
+        reports=Count('report'),
+        prompt_tokens=Sum('prompt_tokens'),
+        cached_tokens=Sum('cached_tokens'),
+        output_tokens=Sum('output_tokens'),
+        total_tokens=Sum('total_tokens'),
+        valuation_retries=Sum('valuation_retries'),
+        gamma_post_retries=Sum('gamma_post_retries'),
+        gamma_polls=Sum('gamma_poll_count'),
+        email_retries=Sum('email_retries'),
+        agent_hedged=Count('report', filter=Q(agent_hedged=True)),
+    )
+    summary['agent_sources'] = {
+        ReportMetrics.AgentSourceChoices(row['agent_source']).label: row['total']
+        for row in queryset.exclude(agent_source='').values('agent_source').annotate(total=Count('report')).order_by()
+    }
+    summary['agent_providers'] = {
+        row['agent_provider']: row['total']
+        for row in queryset.exclude(agent_provider='').values('agent_provider').annotate(total=Count('report')).order_by()
+    }
+    return summary
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0003_valuationreport_gamma_presentation_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='valuationreport',
+            name='gamma_deadline',
+            field=models.DateTimeField(blank=True, help_text='Prazo limite para a geração Gamma terminar', null=True),
+        ),
+        migrations.AddField(
+            model_name='valuationreport',
+            name='gamma_generation_id',
+            field=models.CharField(blank=True, help_text='ID da geração devolvido pela API Gamma', max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='valuationreport',
+            name='gamma_poll_attempts',
+            field=models.PositiveIntegerField(default=0, help_text='Quantas consultas de status já foram feitas à API Gamma'),
+        ),
+    ]
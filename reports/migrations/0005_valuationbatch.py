@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0004_valuationreport_gamma_polling_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ValuationBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_name', models.CharField(blank=True, help_text='Nome do ficheiro importado', max_length=255)),
+                ('total_rows', models.PositiveIntegerField(default=0, help_text='Linhas lidas do ficheiro')),
+                ('accepted_count', models.PositiveIntegerField(default=0, help_text='Linhas válidas (viraram relatórios)')),
+                ('rejected_count', models.PositiveIntegerField(default=0, help_text='Linhas recusadas na validação')),
+                ('errors', models.JSONField(blank=True, default=list, help_text='Primeiros erros de validação (linha e motivo)')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='valuation_batches', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='valuationreport',
+            name='batch',
+            field=models.ForeignKey(blank=True, help_text='Lote de importação de origem (se houver)', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reports', to='reports.valuationbatch'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0005_valuationbatch'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='valuationreport',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='report_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0006_report_user_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='valuationreport',
+            name='gamma_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Gerando'), ('completed', 'Concluída'), ('failed', 'Falhou')], db_index=True, help_text='Estado da apresentação Gamma (vazio = não pedida)', max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='valuationreport',
+            name='has_error',
+            field=models.BooleanField(db_index=True, default=False, help_text="result_data contém uma chave 'error'"),
+        ),
+        migrations.AddField(
+            model_name='valuationreport',
+            name='valuation_calculado',
+            field=models.FloatField(blank=True, db_index=True, help_text="Valuation calculado (cópia de result_data['valuation_calculado'])", null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    from reports.backfill import backfill_result_columns
+    backfill_result_columns(apps.get_model('reports', 'ValuationReport'))
+
+
+class Migration(migrations.Migration):
+    # Sem transação única: cada bloco do backfill é confirmado separadamente
+    atomic = False
+
+    dependencies = [
+        ('reports', '0007_promote_result_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
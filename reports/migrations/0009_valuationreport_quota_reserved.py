@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0008_backfill_result_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='valuationreport',
+            name='quota_reserved',
+            field=models.BooleanField(default=False, help_text='Reservou uma simulação da quota (chatbot/quota.py) ainda não consumida nem devolvida'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.7 on 2026-10-18 20:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0009_valuationreport_quota_reserved'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportMetrics',
+            fields=[
+                ('report', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='metrics', serialize=False, to='reports.valuationreport')),
+                ('processing_started_at', models.DateTimeField(blank=True, null=True)),
+                ('processing_finished_at', models.DateTimeField(blank=True, null=True)),
+                ('queue_wait_ms', models.PositiveIntegerField(blank=True, help_text='Criação do relatório -> início da tarefa', null=True)),
+                ('engine_ms', models.PositiveIntegerField(blank=True, help_text='Motor determinístico', null=True)),
+                ('gemini_ms', models.PositiveIntegerField(blank=True, help_text='Chamada ao agente (inclui espera no limitador)', null=True)),
+                ('valuation_ms', models.PositiveIntegerField(blank=True, help_text='Duração total da última execução da tarefa', null=True)),
+                ('valuation_retries', models.PositiveIntegerField(default=0, help_text='Adiamentos por falta de capacidade no Gemini')),
+                ('agent_source', models.CharField(blank=True, choices=[('gemini', 'Chamada ao Gemini'), ('cache', 'Cache de respostas'), ('shared', 'Partilhada (single-flight)'), ('fallback', 'Narrativa padrão')], max_length=10)),
+                ('prompt_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('cached_tokens', models.PositiveIntegerField(blank=True, help_text='Tokens do prompt servidos pelo context cache', null=True)),
+                ('output_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('total_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('gamma_requested_at', models.DateTimeField(blank=True, help_text='Início da tarefa de geração', null=True)),
+                ('gamma_started_at', models.DateTimeField(blank=True, help_text='POST aceite pela API', null=True)),
+                ('gamma_finished_at', models.DateTimeField(blank=True, help_text='Geração concluída ou falhada', null=True)),
+                ('gamma_post_ms', models.PositiveIntegerField(blank=True, null=True)),
+                ('gamma_post_status', models.PositiveSmallIntegerField(blank=True, help_text='Código HTTP do último POST', null=True)),
+                ('gamma_post_retries', models.PositiveIntegerField(default=0)),
+                ('gamma_poll_count', models.PositiveIntegerField(default=0)),
+                ('gamma_poll_http_ms', models.PositiveIntegerField(blank=True, help_text='Soma do tempo HTTP das consultas de status', null=True)),
+                ('gamma_last_poll_status', models.PositiveSmallIntegerField(blank=True, help_text='Código HTTP da última consulta', null=True)),
+                ('gamma_generation_ms', models.PositiveIntegerField(blank=True, help_text='POST aceite -> geração concluída', null=True)),
+                ('email_queued_at', models.DateTimeField(blank=True, null=True)),
+                ('email_ms', models.PositiveIntegerField(blank=True, help_text='Montagem e entrada na fila de saída', null=True)),
+                ('email_retries', models.PositiveIntegerField(default=0)),
+                ('end_to_end_ms', models.PositiveIntegerField(blank=True, help_text='Criação do relatório -> fim do pipeline', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Métricas do relatório',
+                'verbose_name_plural': 'Métricas dos relatórios',
+                'indexes': [models.Index(fields=['processing_started_at'], name='metrics_started_idx')],
+            },
+        ),
+    ]
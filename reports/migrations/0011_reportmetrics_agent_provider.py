@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0010_reportmetrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportmetrics',
+            name='agent_hedged',
+            field=models.BooleanField(default=False, help_text='Houve um segundo pedido (hedge) ao agente'),
+        ),
+        migrations.AddField(
+            model_name='reportmetrics',
+            name='agent_provider',
+            field=models.CharField(blank=True, help_text='Quem respondeu (ex: gemini:gemini-2.5-flash, local)', max_length=64),
+        ),
+    ]
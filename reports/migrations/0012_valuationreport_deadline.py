@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 20:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0011_reportmetrics_agent_provider'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='valuationreport',
+            name='deadline_at',
+            field=models.DateTimeField(blank=True, help_text='Prazo global do relatório, definido quando o pedido é aceite', null=True),
+        ),
+        migrations.AddField(
+            model_name='valuationreport',
+            name='timeout_reason',
+            field=models.CharField(blank=True, choices=[('queue', 'Prazo esgotado na fila (antes do valuation)'), ('valuation_task', 'Tarefa de valuation passou do limite de tempo'), ('agent', 'Agente sem resposta no orçamento (narrativa padrão)'), ('gamma_start', 'Início da geração Gamma fora do orçamento'), ('gamma_generation', 'Geração Gamma não concluiu no prazo'), ('email', 'E-mail não enfileirado no prazo')], default='', help_text='Etapa que passou do orçamento de tempo (vazio = dentro do prazo)', max_length=20),
+        ),
+    ]
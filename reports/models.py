@@ -2,6 +2,33 @@
 from django.db import models
 from django.conf import settings
 
+def result_columns(result_data):
+    """(valuation_calculado, has_error) extraídos de um result_data."""
+    if not isinstance(result_data, dict):
+        return None, False
+    valuation = result_data.get('valuation_calculado')
+    return (float(valuation) if isinstance(valuation, (int, float)) else None), bool(result_data.get('error'))
+
+
+class ValuationBatch(models.Model):
+    """Lote de valuations importado de um ficheiro JSONL/CSV (carteira de clientes)."""
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='valuation_batches'
+    )
+    source_name = models.CharField(max_length=255, blank=True, help_text="Nome do ficheiro importado")
+    total_rows = models.PositiveIntegerField(default=0, help_text="Linhas lidas do ficheiro")
+    accepted_count = models.PositiveIntegerField(default=0, help_text="Linhas válidas (viraram relatórios)")
+    rejected_count = models.PositiveIntegerField(default=0, help_text="Linhas recusadas na validação")
+    errors = models.JSONField(default=list, blank=True, help_text="Primeiros erros de validação (linha e motivo)")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Lote #{self.id} de {self.user.razao_social} ({self.accepted_count} relatórios)"
+
+
 class ValuationReport(models.Model):
     """Armazena o resultado de um cálculo de valuation."""
     
@@ -11,6 +38,75 @@ class ValuationReport(models.Model):
         blank=True,
         help_text="URL da apresentação gerada pelo Gamma (se houver)"
     ) # <-- ADICIONE ESTE CAMPO
+
+    # --- Estado da geração Gamma (máquina de estados de polling) ---
+    gamma_generation_id = models.CharField(
+        max_length=100,
+        null=True,
+        blank=True,
+        help_text="ID da geração devolvido pela API Gamma"
+    )
+    gamma_poll_attempts = models.PositiveIntegerField(
+        default=0,
+        help_text="Quantas consultas de status já foram feitas à API Gamma"
+    )
+    gamma_deadline = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Prazo limite para a geração Gamma terminar"
+    )
+
+    class GammaStatusChoices(models.TextChoices):
+        PENDING = 'pending', 'Gerando'
+        COMPLETED = 'completed', 'Concluída'
+        FAILED = 'failed', 'Falhou'
+
+    # --- Campos "quentes" promovidos do result_data (filtros e transições sem reescrever o JSON) ---
+    gamma_status = models.CharField(
+        max_length=10,
+        choices=GammaStatusChoices.choices,
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text="Estado da apresentação Gamma (vazio = não pedida)"
+    )
+    valuation_calculado = models.FloatField(
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text="Valuation calculado (cópia de result_data['valuation_calculado'])"
+    )
+    has_error = models.BooleanField(
+        default=False,
+        db_index=True,
+        help_text="result_data contém uma chave 'error'"
+    )
+
+    # --- Prazo do relatório (chatbot/deadlines.py) ---
+    class TimeoutReasonChoices(models.TextChoices):
+        QUEUE = 'queue', 'Prazo esgotado na fila (antes do valuation)'
+        VALUATION_TASK = 'valuation_task', 'Tarefa de valuation passou do limite de tempo'
+        AGENT = 'agent', 'Agente sem resposta no orçamento (narrativa padrão)'
+        GAMMA_START = 'gamma_start', 'Início da geração Gamma fora do orçamento'
+        GAMMA_GENERATION = 'gamma_generation', 'Geração Gamma não concluiu no prazo'
+        EMAIL = 'email', 'E-mail não enfileirado no prazo'
+
+    deadline_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Prazo global do relatório, definido quando o pedido é aceite"
+    )
+    timeout_reason = models.CharField(
+        max_length=20,
+        choices=TimeoutReasonChoices.choices,
+        blank=True,
+        default='',
+        help_text="Etapa que passou do orçamento de tempo (vazio = dentro do prazo)"
+    )
+    quota_reserved = models.BooleanField(
+        default=False,
+        help_text="Reservou uma simulação da quota (chatbot/quota.py) ainda não consumida nem devolvida"
+    )
     
     class StatusChoices(models.TextChoices):
         PENDING = 'PENDING', 'Pendente'
@@ -23,6 +119,14 @@ class ValuationReport(models.Model):
         on_delete=models.CASCADE,
         related_name='reports'
     )
+    batch = models.ForeignKey(
+        ValuationBatch,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='reports',
+        help_text="Lote de importação de origem (se houver)"
+    )
     # Inputs que vieram do chatbot
     inputs_data = models.JSONField(help_text="JSON com as perguntas e respostas do chat")
     
@@ -45,5 +149,89 @@ class ValuationReport(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def set_result_data(self, data):
+        """
+        Define result_data e as colunas derivadas dele (valuation_calculado,
+        has_error). Retorna os campos alterados, para usar em update_fields.
+        """
+        self.result_data = data
+        self.valuation_calculado, self.has_error = result_columns(data)
+        return ['result_data', 'valuation_calculado', 'has_error']
+
+    class Meta:
+        indexes = [
+            # Listas por utilizador, mais recentes primeiro (paginação por cursor em reports/pagination.py)
+            models.Index(fields=['user', '-created_at', '-id'], name='report_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Relatório de {self.user.razao_social} em {self.created_at.strftime('%d/%m/%Y')}"
+
+class ReportMetrics(models.Model):
+    """
+    Tempos por etapa, uso de tokens, retentativas e códigos HTTP de um
+    relatório, preenchidos pelas tarefas Celery (ver reports/metrics.py).
+    Durações em milissegundos; vazias se a etapa não aconteceu.
+    """
+
+    class AgentSourceChoices(models.TextChoices):
+        GEMINI = 'gemini', 'Chamada ao Gemini'
+        CACHE = 'cache', 'Cache de respostas'
+        SHARED = 'shared', 'Partilhada (single-flight)'
+        FALLBACK = 'fallback', 'Narrativa padrão'
+
+    report = models.OneToOneField(
+        ValuationReport,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='metrics'
+    )
+
+    # --- Valuation (process_valuation_request) ---
+    processing_started_at = models.DateTimeField(null=True, blank=True)
+    processing_finished_at = models.DateTimeField(null=True, blank=True)
+    queue_wait_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Criação do relatório -> início da tarefa")
+    engine_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Motor determinístico")
+    gemini_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Chamada ao agente (inclui espera no limitador)")
+    valuation_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Duração total da última execução da tarefa")
+    valuation_retries = models.PositiveIntegerField(default=0, help_text="Adiamentos por falta de capacidade no Gemini")
+    agent_source = models.CharField(max_length=10, choices=AgentSourceChoices.choices, blank=True)
+    agent_provider = models.CharField(max_length=64, blank=True, help_text="Quem respondeu (ex: gemini:gemini-2.5-flash, local)")
+    agent_hedged = models.BooleanField(default=False, help_text="Houve um segundo pedido (hedge) ao agente")
+
+    # --- Uso de tokens (usage_metadata do Gemini) ---
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    cached_tokens = models.PositiveIntegerField(null=True, blank=True, help_text="Tokens do prompt servidos pelo context cache")
+    output_tokens = models.PositiveIntegerField(null=True, blank=True)
+    total_tokens = models.PositiveIntegerField(null=True, blank=True)
+
+    # --- Gamma ---
+    gamma_requested_at = models.DateTimeField(null=True, blank=True, help_text="Início da tarefa de geração")
+    gamma_started_at = models.DateTimeField(null=True, blank=True, help_text="POST aceite pela API")
+    gamma_finished_at = models.DateTimeField(null=True, blank=True, help_text="Geração concluída ou falhada")
+    gamma_post_ms = models.PositiveIntegerField(null=True, blank=True)
+    gamma_post_status = models.PositiveSmallIntegerField(null=True, blank=True, help_text="Código HTTP do último POST")
+    gamma_post_retries = models.PositiveIntegerField(default=0)
+    gamma_poll_count = models.PositiveIntegerField(default=0)
+    gamma_poll_http_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Soma do tempo HTTP das consultas de status")
+    gamma_last_poll_status = models.PositiveSmallIntegerField(null=True, blank=True, help_text="Código HTTP da última consulta")
+    gamma_generation_ms = models.PositiveIntegerField(null=True, blank=True, help_text="POST aceite -> geração concluída")
+
+    # --- E-mail ---
+    email_queued_at = models.DateTimeField(null=True, blank=True)
+    email_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Montagem e entrada na fila de saída")
+    email_retries = models.PositiveIntegerField(default=0)
+
+    end_to_end_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Criação do relatório -> fim do pipeline")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Métricas do relatório"
+        verbose_name_plural = "Métricas dos relatórios"
+        indexes = [
+            # Janelas de tempo da página de percentis (reports/admin.py)
+            models.Index(fields=['processing_started_at'], name='metrics_started_idx'),
+        ]
+
     def __str__(self):
-        return f"Relatório de {self.user.razao_social} em {self.created_at.strftime('%d/%m/%Y')}"
\ No newline at end of file
+        return f"Métricas do Relatório #{self.report_id}"
@@ -0,0 +1,100 @@
+# reports/page_cache.py
+"""
+Cache do corpo renderizado da página de detalhe (report_detail_view).
+
+Só relatórios finalizados entram no cache: FAILED, ou SUCCESS com a
+apresentação Gamma concluída, falhada ou não pedida. Eles não mudam mais,
+então um hit dispensa a query e a renderização do template. A chave inclui
+o id do utilizador: o fragmento só é gravado depois de a view confirmar
+que o relatório é dele, e outro utilizador nunca chega à mesma chave.
+
+As tarefas (chatbot/tasks.py) e o admin invalidam a entrada sempre que o
+relatório muda. O armazenamento é o cache padrão do Django
+(settings.CACHES, Redis); os contadores ficam no Redis compartilhado:
+- report_page_cache:stats -> hash com hits/misses/stores/invalidations/errors
+"""
+import logging
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from valuation.redis_client import get_redis
+from .models import ValuationReport
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = "report_page_cache:stats"
+# Incrementar ao mudar templates/reports/report_detail_body.html (fragmentos antigos deixam de ser lidos)
+FRAGMENT_VERSION = 1
+
+FINAL_GAMMA_STATUSES = (
+    ValuationReport.GammaStatusChoices.COMPLETED,
+    ValuationReport.GammaStatusChoices.FAILED,
+    None, # Apresentação não pedida
+)
+
+
+def report_page_key(user_id, report_id) -> str:
+    return f"report_page:v{FRAGMENT_VERSION}:{user_id}:{report_id}"
+
+
+def is_report_final(report) -> bool:
+    """O relatório já não muda (e a página pode ir para o cache)?"""
+    if report.status == ValuationReport.StatusChoices.FAILED:
+        return True
+    return report.status == ValuationReport.StatusChoices.SUCCESS and report.gamma_status in FINAL_GAMMA_STATUSES
+
+
+def _count(name: str):
+    try:
+        get_redis().hincrby(STATS_KEY, name, 1)
+    except redis.RedisError as e:
+        logger.warning(f"Contadores do cache de páginas indisponíveis: {e}")
+
+
+def get_report_page(user_id, report_id):
+    """Fragmento HTML em cache ou None. Falhas do Redis contam como miss."""
+    if not settings.REPORT_PAGE_CACHE_ENABLED:
+        return None
+    try:
+        html = cache.get(report_page_key(user_id, report_id))
+    except redis.RedisError as e:
+        logger.warning(f"Cache de páginas indisponível na leitura (Report {report_id}): {e}")
+        _count("errors")
+        return None
+    _count("hits" if html is not None else "misses")
+    return html
+
+
+def store_report_page(report, html: str):
+    """Guarda o fragmento de um relatório finalizado (os outros são ignorados)."""
+    if not settings.REPORT_PAGE_CACHE_ENABLED or not is_report_final(report):
+        return
+    try:
+        cache.set(report_page_key(report.user_id, report.pk), html, timeout=settings.REPORT_PAGE_CACHE_TTL_SECONDS)
+    except redis.RedisError as e:
+        logger.warning(f"Cache de páginas indisponível na escrita (Report {report.pk}): {e}")
+        _count("errors")
+        return
+    _count("stores")
+
+
+def invalidate_report_page(report_id, user_id):
+    """Remove o fragmento do relatório (chamado quando ele muda)."""
+    try:
+        deleted = cache.delete(report_page_key(user_id, report_id))
+    except redis.RedisError as e:
+        logger.warning(f"Cache de páginas indisponível na invalidação (Report {report_id}): {e}")
+        _count("errors")
+        return
+    if deleted:
+        _count("invalidations")
+
+
+def page_cache_stats() -> dict:
+    """Contadores do cache de páginas e hit rate."""
+    stats = {name: int(value) for name, value in get_redis().hgetall(STATS_KEY).items()}
+    for name in ("hits", "misses", "stores", "invalidations", "errors"):
+        stats.setdefault(name, 0)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
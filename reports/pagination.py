@@ -0,0 +1,93 @@
+# reports/pagination.py
+"""
+Paginação por cursor (keyset) para listas de relatórios.
+
+Em vez de OFFSET (que obriga o banco a ler e descartar todas as linhas
+anteriores), cada página continua a partir da última linha vista:
+WHERE (created_at, id) < (cursor). Com o índice (user, -created_at, -id)
+o custo de cada página é o mesmo, seja a primeira ou a milésima.
+"""
+import base64
+import binascii
+from datetime import datetime
+from django.db.models import Q
+
+ORDERING = ('-created_at', '-id')
+
+
+class InvalidCursor(ValueError):
+    """Cursor adulterado ou num formato antigo."""
+
+
+def encode_cursor(report) -> str:
+    raw = f"{report.created_at.isoformat()}|{report.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(str(e))
+
+
+class KeysetPage:
+    """Uma página de resultados e os cursores para a seguinte (mais antigos) e anterior (mais recentes)."""
+
+    def __init__(self, items, next_cursor=None, previous_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_paginate(queryset, page_size: int, after: str = None, before: str = None) -> KeysetPage:
+    """
+    Devolve uma página de `queryset` na ordem (-created_at, -id).
+
+    after: cursor da última linha da página atual -> página seguinte (mais antigos).
+    before: cursor da primeira linha da página atual -> página anterior (mais recentes).
+    Sem cursor, devolve a primeira página. Busca page_size + 1 linhas para
+    saber se há mais uma página sem precisar de COUNT(*).
+    """
+    if after:
+        created_at, pk = decode_cursor(after)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    elif before:
+        created_at, pk = decode_cursor(before)
+        queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+
+    if before:
+        # Caminha "para trás" pela ordem inversa e depois repõe a ordem normal
+        rows = list(queryset.order_by('created_at', 'id')[:page_size + 1])
+        has_more = len(rows) > page_size
+        items = list(reversed(rows[:page_size]))
+        return KeysetPage(
+            items,
+            next_cursor=encode_cursor(items[-1]) if items else None,
+            previous_cursor=encode_cursor(items[0]) if items and has_more else None,
+        )
+
+    rows = list(queryset.order_by(*ORDERING)[:page_size + 1])
+    has_more = len(rows) > page_size
+    items = rows[:page_size]
+    return KeysetPage(
+        items,
+        next_cursor=encode_cursor(items[-1]) if items and has_more else None,
+        previous_cursor=encode_cursor(items[0]) if items and after else None,
+    )
@@ -1,3 +1,214 @@
-from django.test import TestCase
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from .backfill import backfill_result_columns
+from .metrics import interpolated_percentile, stage_percentiles
+from .models import ReportMetrics, ValuationReport
+from .page_cache import invalidate_report_page, is_report_final, page_cache_stats, report_page_key
+from .pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_paginate
+from valuation.testing import FakeRedisMixin
 
-# Create your tests here.
+
+def create_user(cnpj='12345678000199'):
+    return get_user_model().objects.create_user(cnpj, f'{cnpj}@example.com', 'ACME', 'senha')
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user()
+        base = timezone.now()
+        reports = ValuationReport.objects.bulk_create(
+            ValuationReport(user=cls.user, inputs_data={}) for _ in range(7)
+        )
+        # Dois relatórios com o mesmo created_at: o id desempata
+        created = [base - timedelta(minutes=minutes) for minutes in (0, 1, 2, 2, 3, 4, 5)]
+        for report, created_at in zip(reports, created):
+            report.created_at = created_at
+        ValuationReport.objects.bulk_update(reports, ['created_at'])
+        cls.expected = list(
+            ValuationReport.objects.filter(user=cls.user).order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+
+    def ids(self, page):
+        return [report.id for report in page]
+
+    def queryset(self):
+        return ValuationReport.objects.filter(user=self.user)
+
+    def test_walks_every_page_forwards_and_backwards(self):
+        first = keyset_paginate(self.queryset(), 3)
+        self.assertEqual(self.ids(first), self.expected[:3])
+        self.assertFalse(first.has_previous)
+
+        second = keyset_paginate(self.queryset(), 3, after=first.next_cursor)
+        self.assertEqual(self.ids(second), self.expected[3:6])
+        self.assertTrue(second.has_previous)
+
+        last = keyset_paginate(self.queryset(), 3, after=second.next_cursor)
+        self.assertEqual(self.ids(last), self.expected[6:])
+        self.assertFalse(last.has_next)
+
+        back = keyset_paginate(self.queryset(), 3, before=last.previous_cursor)
+        self.assertEqual(self.ids(back), self.expected[3:6])
+        self.assertTrue(back.has_previous)
+        self.assertTrue(back.has_next)
+
+        back_to_first = keyset_paginate(self.queryset(), 3, before=back.previous_cursor)
+        self.assertEqual(self.ids(back_to_first), self.expected[:3])
+        self.assertFalse(back_to_first.has_previous)
+        self.assertEqual(back_to_first.next_cursor, first.next_cursor)
+
+    def test_cursor_round_trip(self):
+        report = ValuationReport.objects.get(pk=self.expected[0])
+        self.assertEqual(decode_cursor(encode_cursor(report)), (report.created_at, report.pk))
+
+    def test_tampered_cursor(self):
+        report = ValuationReport.objects.get(pk=self.expected[0])
+        for cursor in ('lixo', '!!!', encode_cursor(report)[:-4], 'bm9wZQ', 'MjAyNC0wMS0wMXxhYmM'):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(InvalidCursor):
+                    keyset_paginate(self.queryset(), 3, after=cursor)
+                with self.assertRaises(InvalidCursor):
+                    keyset_paginate(self.queryset(), 3, before=cursor)
+
+    @override_settings(REPORT_HISTORY_PAGE_SIZE=3)
+    def test_history_view_pages_and_recovers_from_bad_cursor(self):
+        self.client.force_login(self.user)
+        url = reverse('reports:report_history')
+        first = self.client.get(url)
+        self.assertEqual(self.ids(first.context['reports']), self.expected[:3])
+        second = self.client.get(url, {'after': first.context['page'].next_cursor})
+        self.assertEqual(self.ids(second.context['reports']), self.expected[3:6])
+        self.assertRedirects(self.client.get(url, {'after': 'lixo'}), url)
+
+
+class BackfillResultColumnsTests(TestCase):
+    def test_copies_json_fields_without_overwriting_filled_columns(self):
+        user = create_user()
+        ok = ValuationReport.objects.create(user=user, inputs_data={}, result_data={'valuation_calculado': 1500, 'gamma_status': 'completed'})
+        error = ValuationReport.objects.create(user=user, inputs_data={}, result_data={'error': 'falhou', 'gamma_status': 'desconhecido'})
+        already = ValuationReport.objects.create(
+            user=user, inputs_data={}, result_data={'valuation_calculado': 10, 'gamma_status': 'pending'},
+            gamma_status='failed', valuation_calculado=10.0,
+        )
+        empty = ValuationReport.objects.create(user=user, inputs_data={}, result_data=None)
+
+        updated = backfill_result_columns(ValuationReport, chunk_size=2)
+        self.assertEqual(updated, 2)
+
+        ok.refresh_from_db()
+        self.assertEqual((ok.gamma_status, ok.valuation_calculado, ok.has_error), ('completed', 1500.0, False))
+        error.refresh_from_db()
+        self.assertEqual((error.gamma_status, error.valuation_calculado, error.has_error), (None, None, True))
+        already.refresh_from_db()
+        self.assertEqual(already.gamma_status, 'failed')
+        empty.refresh_from_db()
+        self.assertEqual((empty.gamma_status, empty.valuation_calculado, empty.has_error), (None, None, False))
+
+        # Segunda passagem: nada a mudar; start_id limita o intervalo
+        self.assertEqual(backfill_result_columns(ValuationReport), 0)
+        ValuationReport.objects.filter(pk=ok.pk).update(valuation_calculado=None)
+        self.assertEqual(backfill_result_columns(ValuationReport, start_id=ok.pk + 1), 0)
+        self.assertEqual(backfill_result_columns(ValuationReport, start_id=ok.pk), 1)
+
+
+class ValuationReportAdminSearchTests(TestCase):
+    def test_digits_search_id_or_cnpj_prefix(self):
+        admin = get_user_model().objects.create_superuser('11111111000111', 'admin@example.com', 'Admin', 'senha')
+        report = ValuationReport.objects.create(user=create_user(), inputs_data={})
+        other = ValuationReport.objects.create(user=admin, inputs_data={})
+        self.client.force_login(admin)
+        url = reverse('admin:reports_valuationreport_changelist')
+
+        def search(term):
+            return sorted(item.pk for item in self.client.get(url, {'q': term}).context['cl'].result_list)
+
+        self.assertEqual(search('12.345'), [report.pk])
+        self.assertEqual(search(str(other.pk)), [other.pk])
+        self.assertEqual(search('678000199'), []) # Só prefixo do CNPJ
+        self.assertEqual(search('acme'), [report.pk])
+
+
+class InterpolatedPercentileTests(SimpleTestCase):
+    def test_linear_interpolation(self):
+        values = [10, 20, 30, 40]
+        self.assertEqual(interpolated_percentile(values, 0), 10)
+        self.assertEqual(interpolated_percentile(values, 100), 40)
+        self.assertEqual(interpolated_percentile(values, 50), 25)
+        self.assertAlmostEqual(interpolated_percentile(values, 95), 38.5)
+
+    def test_edge_cases(self):
+        self.assertIsNone(interpolated_percentile([], 50))
+        self.assertEqual(interpolated_percentile([7], 99), 7)
+
+
+class StagePercentilesTests(TestCase):
+    def test_ignores_missing_stages_and_filters_by_window(self):
+        user = create_user()
+        now = timezone.now()
+        for engine_ms, started in ((10, now), (30, now), (None, now), (1000, now - timedelta(hours=2))):
+            report = ValuationReport.objects.create(user=user, inputs_data={})
+            ReportMetrics.objects.create(report=report, engine_ms=engine_ms, processing_started_at=started)
+
+        rows = {row['field']: row for row in stage_percentiles(since=now - timedelta(hours=1))}
+        self.assertEqual((rows['engine_ms']['count'], rows['engine_ms']['p50']), (2, 20))
+        self.assertEqual((rows['gemini_ms']['count'], rows['gemini_ms']['p95']), (0, None))
+        self.assertEqual({row['field']: row['count'] for row in stage_percentiles()}['engine_ms'], 3)
+
+
+class ReportPageCacheTests(FakeRedisMixin, TestCase):
+    Status = ValuationReport.StatusChoices
+    Gamma = ValuationReport.GammaStatusChoices
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = create_user()
+        self.client.force_login(self.user)
+
+    def detail(self, report):
+        return self.client.get(reverse('reports:report_detail', args=[report.pk]))
+
+    def test_final_statuses(self):
+        cases = [
+            (self.Status.FAILED, self.Gamma.PENDING, True),
+            (self.Status.SUCCESS, self.Gamma.COMPLETED, True),
+            (self.Status.SUCCESS, None, True),
+            (self.Status.SUCCESS, self.Gamma.PENDING, False),
+            (self.Status.PROCESSING, None, False),
+        ]
+        for status, gamma_status, final in cases:
+            with self.subTest(status=status, gamma_status=gamma_status):
+                self.assertIs(is_report_final(ValuationReport(status=status, gamma_status=gamma_status)), final)
+
+    def test_final_report_is_served_from_cache_until_invalidated(self):
+        report = ValuationReport.objects.create(user=self.user, inputs_data={}, status=self.Status.FAILED, result_data={'error': 'motivo A'})
+        self.assertContains(self.detail(report), 'motivo A')
+        ValuationReport.objects.filter(pk=report.pk).update(result_data={'error': 'motivo B'})
+        self.assertContains(self.detail(report), 'motivo A') # Hit: sem query nem renderização
+        invalidate_report_page(report.pk, self.user.pk)
+        self.assertContains(self.detail(report), 'motivo B')
+        stats = page_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores'], stats['invalidations']), (1, 2, 2, 1))
+        self.assertEqual(stats['hit_rate'], round(1 / 3, 4))
+
+    def test_unfinished_report_is_not_cached(self):
+        report = ValuationReport.objects.create(user=self.user, inputs_data={}, status=self.Status.PROCESSING)
+        self.detail(report)
+        self.assertIsNone(cache.get(report_page_key(self.user.pk, report.pk)))
+
+    def test_other_user_never_reaches_the_cached_page(self):
+        report = ValuationReport.objects.create(user=self.user, inputs_data={}, status=self.Status.FAILED)
+        self.detail(report)
+        self.client.force_login(create_user('98765432000199'))
+        self.assertEqual(self.detail(report).status_code, 404)
+
+    @override_settings(REPORT_PAGE_CACHE_ENABLED=False)
+    def test_disabled(self):
+        report = ValuationReport.objects.create(user=self.user, inputs_data={}, status=self.Status.FAILED)
+        self.detail(report)
+        self.assertIsNone(cache.get(report_page_key(self.user.pk, report.pk)))
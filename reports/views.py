@@ -1,7 +1,15 @@
 # reports/views.py
-from django.shortcuts import render, get_object_or_404
+from django.conf import settings
+from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from .models import ValuationReport
+from .page_cache import get_report_page, store_report_page
+from .pagination import keyset_paginate, InvalidCursor
+
+# Colunas usadas nas listas de relatórios (histórico e dashboard)
+REPORT_LIST_FIELDS = ('id', 'user_id', 'status', 'created_at')
 
 @login_required # Garante que apenas usuários logados acessem
 def report_history_view(request):
@@ -12,12 +20,24 @@ def report_history_view(request):
     
     # 1. Busca no banco de dados
     # Filtra os relatórios para mostrar APENAS os do usuário atual (request.user)
-    # Ordena pelos mais recentes primeiro
-    user_reports = ValuationReport.objects.filter(user=request.user).order_by('-created_at')
+    # e carrega só as colunas da tabela (sem os JSONs de inputs/resultado).
+    # Paginação por cursor: ?after= (mais antigos) / ?before= (mais recentes)
+    user_reports = ValuationReport.objects.filter(user=request.user).only(*REPORT_LIST_FIELDS)
+    try:
+        page = keyset_paginate(
+            user_reports,
+            settings.REPORT_HISTORY_PAGE_SIZE,
+            after=request.GET.get('after'),
+            before=request.GET.get('before'),
+        )
+    except InvalidCursor:
+        # Cursor inválido (link antigo ou editado à mão): volta à primeira página
+        return redirect('reports:report_history')
     
     # 2. Define o contexto para enviar ao template
     context = {
-        'reports': user_reports
+        'reports': page,
+        'page': page,
     }
     
     # 3. Renderiza o novo template que vamos criar
@@ -30,22 +50,31 @@ def report_detail_view(request, pk):
     View para a página de 'Detalhe do Relatório'.
     Mostra os resultados de um relatório específico.
     'pk' (Primary Key) é o ID do relatório vindo da URL.
+
+    O corpo da página de relatórios finalizados vem do cache
+    (reports/page_cache.py), sem query nem renderização do JSON.
     """
     
-    # 1. Busca o relatório específico.
-    # get_object_or_404 é um atalho do Django que:
-    # - Tenta buscar o relatório (pk=pk, user=request.user)
-    # - Se não encontrar (ou se o relatório for de OUTRO usuário), 
-    #   ele automaticamente retorna um erro 404 (Not Found).
-    # Isso é EXCELENTE para segurança.
-    report = get_object_or_404(ValuationReport, pk=pk, user=request.user)
+    # 1. Cache por (utilizador, relatório): só existe se a posse já foi verificada abaixo
+    report_body = get_report_page(request.user.pk, pk)
+    if report_body is None:
+        # Busca o relatório específico.
+        # get_object_or_404 é um atalho do Django que:
+        # - Tenta buscar o relatório (pk=pk, user=request.user)
+        # - Se não encontrar (ou se o relatório for de OUTRO usuário), 
+        #   ele automaticamente retorna um erro 404 (Not Found).
+        # Isso é EXCELENTE para segurança.
+        report = get_object_or_404(ValuationReport, pk=pk, user=request.user)
+        # O 'result_data' (JSON com o feedback da IA) estará dentro de 'report.result_data'.
+        # Renderizado sem request: o fragmento não pode depender da sessão
+        report_body = render_to_string('reports/report_detail_body.html', {'report': report})
+        store_report_page(report, report_body)
     
     # 2. Define o contexto
     context = {
-        'report': report
-        # O 'result_data' (JSON com o feedback da IA)
-        # estará dentro de 'report.result_data'
+        'report_id': pk,
+        'report_body': mark_safe(report_body),
     }
     
     # 3. Renderiza o template de detalhe
-    return render(request, 'reports/report_detail.html', context)
\ No newline at end of file
+    return render(request, 'reports/report_detail.html', context)
@@ -5,6 +5,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatInput = document.getElementById('chat-input');
     const chatSendBtn = document.getElementById('chat-send-btn');
     const chatWindow = document.getElementById('chat-window');
+    const recentReports = document.getElementById('recent-reports');
 
     // --- Estado do Chat ---
     let currentQuestionIndex = 0;
@@ -18,6 +19,9 @@ document.addEventListener('DOMContentLoaded', () => {
         { id: 'diferencial_competitivo', text: "Qual você considera o maior diferencial ou vantagem competitiva do seu negócio?", type: 'text' }
     ];
     const chatInputs = {}; // Respostas serão armazenadas aqui
+    // Chave de idempotência da simulação atual: retentativas (falha de rede, duplo clique)
+    // reenviam a mesma chave e o servidor devolve o mesmo relatório
+    let idempotencyKey = null;
 
     // --- Funções Auxiliares ---
     function addChatMessage(message, type = 'bot') {
@@ -117,8 +121,127 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // --- Status ao vivo do Histórico Recente ---
+    // Por omissão, polling curto com ETag/If-None-Match (o servidor responde 304
+    // se nada mudou). Com STATUS_REALTIME_ENABLED no servidor (data-status-realtime)
+    // usa SSE (/chatbot/api/status/?stream=1) e, na falta dele, long-poll.
+    const STATUS_BADGES = {
+        SUCCESS: { cls: 'text-bg-success', text: 'Concluído' },
+        PROCESSING: { cls: 'text-bg-warning', text: 'Processando' },
+        PENDING: { cls: 'text-bg-warning', text: 'Processando' },
+        FAILED: { cls: 'text-bg-danger', text: 'Falha' },
+    };
+    let statusSource = null;
+    let statusPollTimer = null;
+    let statusEtag = null;
+    const statusRealtime = recentReports.dataset.statusRealtime === '1';
+    const statusPollInterval = parseInt(recentReports.dataset.statusPollInterval, 10) || 5000;
+
+    function updateReportItem(report) {
+        const item = recentReports.querySelector(`[data-report-id="${report.id}"]`);
+        if (!item) return;
+        item.dataset.reportStatus = report.status;
+        item.dataset.reportFinal = report.final ? '1' : '0';
+        const badge = item.querySelector('.report-status-badge');
+        const config = STATUS_BADGES[report.status] || STATUS_BADGES.FAILED;
+        badge.className = `badge ${config.cls} rounded-pill report-status-badge`;
+        badge.textContent = config.text;
+        if (report.queue_position !== null && report.queue_position > 0) {
+            badge.title = `Posição na fila: ${report.queue_position}`;
+        } else {
+            badge.removeAttribute('title');
+        }
+    }
+
+    function addReportItem(reportId) {
+        // Resposta repetida (pedido deduplicado): o relatório já está na lista
+        if (recentReports.querySelector(`[data-report-id="${reportId}"]`)) return;
+        const empty = document.getElementById('recent-reports-empty');
+        if (empty) empty.remove();
+        const item = document.createElement('a');
+        item.href = `/reports/detail/${reportId}/`;
+        item.className = 'list-group-item list-group-item-action d-flex justify-content-between align-items-center';
+        item.dataset.reportId = reportId;
+        item.dataset.reportStatus = 'PENDING';
+        item.innerHTML = `
+            <div>
+                <span class="fw-medium">Relatório #${reportId}</span>
+                <small class="d-block text-muted">${new Date().toLocaleString('pt-BR', { dateStyle: 'short', timeStyle: 'short' })}</small>
+            </div>
+            <span class="badge text-bg-warning rounded-pill report-status-badge">Processando</span>`;
+        recentReports.prepend(item);
+        // Mantém apenas os 5 mais recentes, como no template
+        recentReports.querySelectorAll('[data-report-id]').forEach((el, index) => { if (index >= 5) el.remove(); });
+    }
+
+    function watchedReportIds() {
+        // Relatórios que ainda podem mudar (inclui SUCCESS com apresentação Gamma pendente)
+        return Array.from(recentReports.querySelectorAll('[data-report-id]'))
+            .filter(el => el.dataset.reportFinal !== '1' && el.dataset.reportStatus !== 'FAILED')
+            .map(el => el.dataset.reportId);
+    }
+
+    function handleStatusPayload(data) {
+        (data.reports || []).forEach(updateReportItem);
+    }
+
+    function stopWatchingReports() {
+        if (statusSource) { statusSource.close(); statusSource = null; }
+        if (statusPollTimer) { clearTimeout(statusPollTimer); statusPollTimer = null; }
+    }
+
+    function pollReportStatus(ids) {
+        const headers = statusEtag ? { 'If-None-Match': statusEtag } : {};
+        const wait = statusRealtime ? '&wait=20' : '';
+        fetch(`/chatbot/api/status/?ids=${ids.join(',')}${wait}`, { headers })
+            .then(response => {
+                if (response.status === 304) return null;
+                if (!response.ok) throw new Error(`Erro ${response.status}`);
+                statusEtag = response.headers.get('ETag');
+                return response.json();
+            })
+            .then(data => { if (data) handleStatusPayload(data); })
+            .catch(error => console.warn('Falha ao consultar status:', error))
+            .finally(() => {
+                const pending = watchedReportIds();
+                const delay = statusRealtime ? 2000 : statusPollInterval;
+                if (pending.length) statusPollTimer = setTimeout(() => pollReportStatus(pending), delay);
+            });
+    }
+
+    function watchReports() {
+        stopWatchingReports();
+        const ids = watchedReportIds();
+        if (!ids.length) return;
+        statusEtag = null;
+        if (!statusRealtime || !window.EventSource) {
+            pollReportStatus(ids);
+            return;
+        }
+        statusSource = new EventSource(`/chatbot/api/status/?ids=${ids.join(',')}&stream=1`);
+        statusSource.onmessage = (event) => handleStatusPayload(JSON.parse(event.data));
+        statusSource.addEventListener('done', stopWatchingReports);
+        statusSource.onerror = () => {
+            // Sem SSE (ex: Redis indisponível): cai para o polling com ETag
+            if (statusSource && statusSource.readyState === EventSource.CLOSED) {
+                statusSource = null;
+                pollReportStatus(watchedReportIds());
+            }
+        };
+    }
+
+    function newIdempotencyKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    }
+
     // --- Lógica da API ---
     calculateBtn.addEventListener('click', () => {
+        if (!idempotencyKey) {
+            idempotencyKey = newIdempotencyKey();
+        }
         calculateBtn.disabled = true;
         calculateBtn.innerHTML = `<span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span> Processando...`;
         apiFeedback.innerHTML = '<div class="alert alert-info small">Iniciando análise... Isso pode levar algum tempo.</div>';
@@ -127,6 +250,7 @@ document.addEventListener('DOMContentLoaded', () => {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'Idempotency-Key': idempotencyKey,
                 // Se CSRF_exempt não estiver ativo na view, adicione o token:
                 // 'X-CSRFToken': getCookie('csrftoken')
             },
@@ -140,7 +264,13 @@ document.addEventListener('DOMContentLoaded', () => {
                         <strong>Sucesso!</strong> ${body.message}
                         <button type="button" class="btn-close" data-bs-dismiss="alert" aria-label="Close"></button>
                     </div>`;
+                // Mostra o novo relatório no Histórico Recente e acompanha o status ao vivo
+                if (body.report_id) {
+                    addReportItem(body.report_id);
+                    watchReports();
+                }
                 // --- RESETAR O CHAT PARA NOVA SIMULAÇÃO ---
+                idempotencyKey = null; // A próxima simulação usa uma chave nova
                 // Limpa as respostas armazenadas
                 Object.keys(chatInputs).forEach(key => { chatInputs[key] = null; });
                 currentQuestionIndex = 0;
@@ -178,5 +308,6 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- Iniciar o Chat ---
     calculateBtn.disabled = true; // Começa desabilitado
     askQuestion(); // Faz a primeira pergunta
+    watchReports(); // Acompanha relatórios que ainda estão a ser processados
 
 });
\ No newline at end of file
@@ -1,10 +1,15 @@
 # users/admin.py
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
+from django.db.models import Q
+import redis
+from chatbot.quota import sync_quota
+from valuation.admin_mixins import LargeTableAdminMixin, digits_only
 from .forms import CustomUserCreationForm # Importa o formulário de criação
-from .models import CustomUser
+from .mail import schedule_outbox_flush
+from .models import CustomUser, OutboundEmail
 
-class CustomUserAdmin(UserAdmin):
+class CustomUserAdmin(LargeTableAdminMixin, UserAdmin):
     # Usa o nosso formulário customizado para a página "Adicionar utilizador"
     add_form = CustomUserCreationForm
 
@@ -24,7 +29,26 @@ class CustomUserAdmin(UserAdmin):
     )
     
     # --- O que pode ser pesquisado ---
-    search_fields = ('cnpj', 'email', 'razao_social', 'telefone')
+    # (a condição usada depende do termo, ver get_search_results)
+    search_fields = ('^cnpj', '^email', 'razao_social')
+    search_help_text = "CNPJ (ou o início dele), e-mail ou razão social"
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Uma condição indexável por termo: números -> prefixo do CNPJ (índice
+        varchar_pattern_ops que o Django cria no Postgres para o campo unique;
+        a busca no meio do CNPJ não é suportada), com '@' -> prefixo do
+        e-mail, texto -> razão social (trigramas, users/migrations/0004).
+        """
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        digits = digits_only(term)
+        if digits:
+            return queryset.filter(cnpj__startswith=digits), False
+        if '@' in term:
+            return queryset.filter(email__istartswith=term), False
+        return queryset.filter(razao_social__icontains=term), False
     
     # --- Filtros laterais ---
     list_filter = ('is_staff', 'is_active', 'date_joined')
@@ -68,5 +92,49 @@ class CustomUserAdmin(UserAdmin):
     )
     # --- FIM DA CORREÇÃO ---
 
+    # --- Quota no Redis (chatbot/quota.py) ---
+    # O contador quota:used:<id> só é semeado do banco quando não existe:
+    # alterar usage_count aqui tem de o reconciliar, senão a mudança não conta
+    actions = ['sync_quotas']
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'usage_count' in form.changed_data:
+            self._sync_quota(request, obj)
+
+    @admin.action(description="Reconciliar quota no Redis com o banco")
+    def sync_quotas(self, request, queryset):
+        synced = sum(self._sync_quota(request, user) for user in queryset.only('pk', 'cnpj', 'razao_social'))
+        self.message_user(request, f"Quota reconciliada para {synced} utilizador(es).")
+
+    def _sync_quota(self, request, user):
+        try:
+            sync_quota(user.pk)
+            return True
+        except redis.RedisError as e:
+            self.message_user(request, f"Não foi possível reconciliar a quota de {user}: {e}", level=messages.WARNING)
+            return False
+
 # Registra o modelo CustomUser com a configuração CustomUserAdmin
-admin.site.register(CustomUser, CustomUserAdmin)
\ No newline at end of file
+admin.site.register(CustomUser, CustomUserAdmin)
+
+
+# --- Fila de saída de e-mails (estado de entrega e reenvio) ---
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ('id', 'kind', 'to_email', 'subject', 'status', 'attempts', 'created_at', 'sent_at')
+    list_filter = ('status', 'kind', 'created_at')
+    search_fields = ('to_email', 'subject')
+    ordering = ('-created_at',)
+    readonly_fields = ('created_at', 'claimed_at', 'sent_at', 'attempts', 'last_error')
+    list_deferred_fields = ('body', 'html_body')
+    actions = ['retry_emails']
+
+    @admin.action(description="Reenviar e-mails selecionados")
+    def retry_emails(self, request, queryset):
+        updated = queryset.exclude(status=OutboundEmail.StatusChoices.SENT).update(
+            status=OutboundEmail.StatusChoices.PENDING, attempts=0, last_error='', claimed_at=None
+        )
+        if updated:
+            schedule_outbox_flush(immediate=True)
+        self.message_user(request, f"{updated} e-mail(s) recolocado(s) na fila de envio.")
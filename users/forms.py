@@ -1,6 +1,7 @@
 # apps/users/forms.py
 from django import forms
-from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
+from django.contrib.auth.forms import UserCreationForm, AuthenticationForm, PasswordResetForm
+from django.db import transaction
 from .models import CustomUser
 import re
 
@@ -64,4 +65,21 @@ class UserProfileUpdateForm(forms.ModelForm):
         )
         
         # Reordena os campos
-        self.order_fields(['cnpj', 'razao_social', 'email', 'ddd', 'telefone'])
\ No newline at end of file
+        self.order_fields(['cnpj', 'razao_social', 'email', 'ddd', 'telefone'])
+
+
+class CustomPasswordResetForm(PasswordResetForm):
+    """
+    Formulário de "Esqueci a senha" que entrega o e-mail a uma tarefa Celery
+    em vez de falar com o servidor SMTP durante o pedido.
+    """
+    def send_mail(self, subject_template_name, email_template_name, context,
+                  from_email, to_email, html_email_template_name=None):
+        from .tasks import send_password_reset_email
+
+        user_id = context['user'].pk
+        context = {key: value for key, value in context.items() if key != 'user'}
+        transaction.on_commit(lambda: send_password_reset_email.delay(
+            user_id, subject_template_name, email_template_name, context,
+            from_email=from_email, html_email_template_name=html_email_template_name,
+        ))
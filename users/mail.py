@@ -0,0 +1,137 @@
+# users/mail.py
+"""
+Fila de saída de e-mails (OutboundEmail).
+
+Quem quer enviar um e-mail chama enqueue_email(); a mensagem é gravada e
+um flush é agendado. Para não abrir uma sessão SMTP/TLS por mensagem, os
+flushes são agrupados: no máximo um fica agendado por intervalo
+(EMAIL_OUTBOX_FLUSH_INTERVAL) e, se a fila já tiver um lote completo
+(EMAIL_OUTBOX_BATCH_SIZE), o flush é disparado de imediato.
+"""
+import html
+import logging
+import re
+import threading
+import redis
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.template import TemplateDoesNotExist, engines, loader
+from django.utils.html import strip_tags
+from valuation.redis_client import get_redis
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SCHEDULED_KEY = "email_outbox:flush_scheduled"
+
+# E-mails enviados pela aplicação (prefixos para render_email)
+EMAIL_TEMPLATE_PREFIXES = ('users/gamma_report', 'users/account_activation')
+
+# Versões em texto plano compiladas a partir dos templates HTML (uma vez por processo)
+_plain_text_templates = {}
+_plain_text_lock = threading.Lock()
+_NON_TEXT_BLOCKS = re.compile(r"<(head|style|script)\b.*?</\1>", re.IGNORECASE | re.DOTALL)
+_LINE_BREAKS = re.compile(r"<br\s*/?>", re.IGNORECASE)
+_BLANK_LINES = re.compile(r"\n\s*\n\s*\n+")
+
+
+def _plain_text_template(html_template_name):
+    """
+    Template de texto plano derivado do template HTML: as tags HTML são
+    removidas do CÓDIGO-FONTE do template (não do resultado de cada envio) e
+    o texto resultante é compilado uma única vez. As variáveis e tags do
+    Django continuam no template, por isso o resultado equivale ao
+    strip_tags() que antes era feito a cada mensagem (sem o <head>/<style>).
+    """
+    template = _plain_text_templates.get(html_template_name)
+    if template is None:
+        with _plain_text_lock:
+            template = _plain_text_templates.get(html_template_name)
+            if template is None:
+                source = loader.get_template(html_template_name).template.source
+                text = html.unescape(strip_tags(_LINE_BREAKS.sub("\n", _NON_TEXT_BLOCKS.sub("", source))))
+                text = _BLANK_LINES.sub("\n\n", "\n".join(line.strip() for line in text.splitlines())).strip()
+                template = engines['django'].from_string("{% autoescape off %}" + text + "{% endautoescape %}")
+                _plain_text_templates[html_template_name] = template
+    return template
+
+
+def warm_email_templates():
+    """Compila no arranque as versões em texto plano dos e-mails que não têm .txt próprio."""
+    for template_prefix in EMAIL_TEMPLATE_PREFIXES:
+        try:
+            loader.get_template(f"{template_prefix}_email.txt")
+        except TemplateDoesNotExist:
+            _plain_text_template(f"{template_prefix}_email.html")
+
+
+def render_email(template_prefix, context):
+    """
+    Renderiza (assunto, texto, html) de '<prefixo>_subject.txt',
+    '<prefixo>_email.txt' e '<prefixo>_email.html'. Sem o .txt, usa a versão
+    em texto plano compilada a partir do HTML.
+    """
+    subject = "".join(loader.render_to_string(f"{template_prefix}_subject.txt", context).splitlines()).strip()
+    html_body = loader.render_to_string(f"{template_prefix}_email.html", context)
+    try:
+        body = loader.render_to_string(f"{template_prefix}_email.txt", context)
+    except TemplateDoesNotExist:
+        body = _plain_text_template(f"{template_prefix}_email.html").render(context)
+    return subject, body.strip() + "\n", html_body
+
+
+def enqueue_email(to_email, subject, body, html_body='', kind='', from_email=None, immediate=False) -> OutboundEmail:
+    """
+    Grava a mensagem na fila de saída e agenda o envio. immediate=True
+    dispara o flush já (e-mails que o utilizador está à espera, como a
+    ativação de conta), sem esperar o intervalo de agrupamento.
+    """
+    email = OutboundEmail.objects.create(
+        kind=kind,
+        to_email=to_email,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        subject=subject[:255],
+        body=body,
+        html_body=html_body,
+    )
+    logger.info(f"E-mail {email.id} ({kind or 'sem tipo'}) enfileirado para {to_email}")
+    schedule_outbox_flush(immediate=immediate)
+    return email
+
+
+def schedule_outbox_flush(immediate=False):
+    """
+    Agenda um flush da fila. Com um lote completo pendente, dispara já;
+    caso contrário agenda um único flush para daqui a FLUSH_INTERVAL
+    segundos (os pedidos seguintes nesse intervalo entram no mesmo lote).
+    """
+    from .tasks import flush_email_outbox
+
+    pending = OutboundEmail.objects.filter(status=OutboundEmail.StatusChoices.PENDING)
+    if immediate or pending.count() >= settings.EMAIL_OUTBOX_BATCH_SIZE:
+        flush_email_outbox.delay()
+        return
+
+    interval = settings.EMAIL_OUTBOX_FLUSH_INTERVAL
+    try:
+        scheduled = get_redis().set(FLUSH_SCHEDULED_KEY, "1", nx=True, ex=max(1, interval))
+    except redis.RedisError as e:
+        logger.warning(f"Redis indisponível ao agendar flush de e-mails: {e}")
+        scheduled = True # Sem coordenação: melhor um flush a mais do que um e-mail parado
+    if scheduled:
+        flush_email_outbox.apply_async(countdown=interval)
+
+
+def clear_flush_schedule():
+    """Chamado no início do flush: novos e-mails voltam a poder agendar outro."""
+    try:
+        get_redis().delete(FLUSH_SCHEDULED_KEY)
+    except redis.RedisError:
+        pass
+
+
+def build_message(email: OutboundEmail, connection) -> EmailMultiAlternatives:
+    msg = EmailMultiAlternatives(email.subject, email.body, email.from_email or None, [email.to_email], connection=connection)
+    if email.html_body:
+        msg.attach_alternative(email.html_body, "text/html")
+    return msg
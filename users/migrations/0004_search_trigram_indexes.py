@@ -0,0 +1,41 @@
+from django.db import migrations
+
+# Índices de trigramas (pg_trgm) para a busca do admin: icontains/istartswith
+# viram UPPER(coluna::text) LIKE '%termo%', que um índice B-tree não serve.
+# Só no Postgres; noutros bancos (ex: SQLite local) a migração não faz nada.
+# O CNPJ não tem índice de trigramas: a busca por CNPJ é só por prefixo
+# (cnpj LIKE '123%'), servida pelo índice varchar_pattern_ops (*_like) que o
+# Django já cria para o campo unique. Ver get_search_results em users/admin.py
+# e reports/admin.py.
+TRIGRAM_INDEXES = {
+    'users_customuser_razao_social_trgm': 'razao_social',
+    'users_customuser_email_trgm': 'email',
+}
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for name, column in TRIGRAM_INDEXES.items():
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON users_customuser USING gin (UPPER("{column}"::text) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name in TRIGRAM_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_outboundemail'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -117,4 +117,41 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     REQUIRED_FIELDS = ['email', 'razao_social']
 
     def __str__(self):
-        return f"{self.razao_social} ({self.cnpj})"
\ No newline at end of file
+        return f"{self.razao_social} ({self.cnpj})"
+
+class OutboundEmail(models.Model):
+    """
+    Fila de saída de e-mails. As mensagens são gravadas aqui e enviadas em
+    lotes pela tarefa flush_email_outbox (users/tasks.py), reutilizando uma
+    única conexão SMTP por lote.
+    """
+
+    class StatusChoices(models.TextChoices):
+        PENDING = 'PENDING', 'Pendente'
+        SENDING = 'SENDING', 'Enviando'
+        SENT = 'SENT', 'Enviado'
+        FAILED = 'FAILED', 'Falhou'
+
+    kind = models.CharField(max_length=50, blank=True, help_text="Tipo da mensagem (ex: gamma_report)")
+    to_email = models.EmailField()
+    from_email = models.CharField(max_length=255, blank=True)
+    subject = models.CharField(max_length=255)
+    body = models.TextField(help_text="Versão em texto plano")
+    html_body = models.TextField(blank=True)
+    status = models.CharField(
+        max_length=10,
+        choices=StatusChoices.choices,
+        default=StatusChoices.PENDING,
+        db_index=True
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True, help_text="Quando um flush reservou a mensagem")
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.get_status_display()}: {self.subject} -> {self.to_email}"
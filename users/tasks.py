@@ -0,0 +1,175 @@
+# users/tasks.py
+import logging
+import smtplib
+from datetime import timedelta
+from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.template import loader
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from valuation.tracing import start_span
+from .mail import build_message, clear_flush_schedule, enqueue_email, render_email, schedule_outbox_flush
+from .models import CustomUser, OutboundEmail
+from .tokens import account_activation_token
+
+logger = logging.getLogger(__name__)
+
+# Mensagens reservadas por um flush que morreu (ex: worker reiniciado) voltam à fila depois disto
+STALE_CLAIM_SECONDS = 600
+
+
+def _claim_batch(batch_size):
+    """Reserva (status SENDING) até batch_size mensagens pendentes e devolve-as."""
+    Status = OutboundEmail.StatusChoices
+    stale_before = timezone.now() - timedelta(seconds=STALE_CLAIM_SECONDS)
+    with transaction.atomic():
+        ids = list(
+            OutboundEmail.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=Status.PENDING)
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if len(ids) < batch_size:
+            ids += list(
+                OutboundEmail.objects
+                .select_for_update(skip_locked=True)
+                .filter(status=Status.SENDING, claimed_at__lt=stale_before)
+                .values_list('id', flat=True)[:batch_size - len(ids)]
+            )
+        OutboundEmail.objects.filter(id__in=ids).update(status=Status.SENDING, claimed_at=timezone.now())
+    return list(OutboundEmail.objects.filter(id__in=ids).order_by('created_at'))
+
+
+def _release(emails):
+    """Devolve à fila mensagens reservadas que não chegaram a ser tentadas."""
+    OutboundEmail.objects.filter(id__in=[email.id for email in emails]).update(
+        status=OutboundEmail.StatusChoices.PENDING, claimed_at=None
+    )
+
+
+def _record_failure(email, error):
+    email.attempts += 1
+    email.last_error = str(error)[:1000]
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboundEmail.StatusChoices.FAILED
+        logger.error(f"E-mail {email.id} para {email.to_email} desistido após {email.attempts} tentativas: {error}")
+    else:
+        email.status = OutboundEmail.StatusChoices.PENDING
+        logger.warning(f"Falha ao enviar e-mail {email.id} para {email.to_email} (tentativa {email.attempts}): {error}")
+    email.claimed_at = None
+    email.save(update_fields=['attempts', 'last_error', 'status', 'claimed_at'])
+
+
+@shared_task(bind=True, max_retries=5)
+def flush_email_outbox(self):
+    """
+    Envia um lote da fila de saída sobre UMA conexão SMTP (um handshake TLS
+    por lote, não por mensagem). Se o servidor não aceitar a conexão, o lote
+    inteiro volta à fila e a tarefa é reagendada com backoff. Enquanto houver
+    lotes completos pendentes, encadeia um novo flush.
+    """
+    clear_flush_schedule()
+    batch_size = settings.EMAIL_OUTBOX_BATCH_SIZE
+    emails = _claim_batch(batch_size)
+    if not emails:
+        return 0
+
+    sent = 0
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        # 1. Falha da sessão (DNS, TLS, autenticação): o lote todo tenta de novo
+        _release(emails)
+        logger.error(f"Não foi possível abrir conexão SMTP para lote de {len(emails)} e-mail(s): {e}")
+        raise self.retry(exc=e, countdown=min(30 * 2 ** self.request.retries, 900))
+
+    try:
+        for index, email in enumerate(emails):
+            try:
+                with start_span("smtp.send", kind="client", email_id=email.id, email_kind=email.kind):
+                    connection.send_messages([build_message(email, connection)])
+            except smtplib.SMTPServerDisconnected as e:
+                # 2. Conexão caiu a meio do lote: esta conta como tentativa, as restantes voltam à fila
+                _record_failure(email, e)
+                _release(emails[index + 1:])
+                raise self.retry(exc=e, countdown=min(30 * 2 ** self.request.retries, 900))
+            except SoftTimeLimitExceeded:
+                # soft_time_limit: o que não foi enviado volta à fila para o próximo flush
+                _release(emails[index:])
+                logger.warning(f"Tempo da tarefa esgotado; {len(emails) - index} e-mail(s) devolvido(s) à fila.")
+                schedule_outbox_flush()
+                return sent
+            except Exception as e:
+                # 3. Erro só desta mensagem (ex: destinatário recusado): segue com as outras
+                _record_failure(email, e)
+                continue
+            email.status = OutboundEmail.StatusChoices.SENT
+            email.attempts += 1
+            email.sent_at = timezone.now()
+            email.last_error = ''
+            email.save(update_fields=['status', 'attempts', 'sent_at', 'last_error'])
+            sent += 1
+    finally:
+        connection.close()
+
+    logger.info(f"Lote de e-mails enviado: {sent}/{len(emails)} mensagem(ns) numa só conexão SMTP")
+
+    # 4. Ainda há fila: outro lote já, ou o próximo flush agendado pelo intervalo
+    if len(emails) >= batch_size:
+        flush_email_outbox.delay()
+    elif OutboundEmail.objects.filter(status=OutboundEmail.StatusChoices.PENDING).exists():
+        schedule_outbox_flush()
+    return sent
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def send_activation_email(self, user_id, protocol, domain):
+    """
+    Renderiza o e-mail de ativação de conta e coloca-o na fila de saída com
+    envio imediato. Corre fora do pedido de cadastro, que já terminou.
+    """
+    try:
+        user = CustomUser.objects.get(pk=user_id)
+        if user.is_active:
+            logger.info(f"Usuário {user_id} já está ativo. E-mail de ativação não enviado.")
+            return
+        context = {
+            'user': user,
+            'protocol': protocol,
+            'domain': domain,
+            'uid': urlsafe_base64_encode(force_bytes(user.pk)),
+            'token': account_activation_token.make_token(user),
+        }
+        subject, plain_message, html_message = render_email('users/account_activation', context)
+        enqueue_email(user.email, subject, plain_message, html_body=html_message, kind='activation', immediate=True)
+    except CustomUser.DoesNotExist:
+        logger.error(f"Usuário {user_id} não encontrado em send_activation_email.")
+    except Exception as e:
+        logger.error(f"Erro ao preparar e-mail de ativação do usuário {user_id}: {e}", exc_info=True)
+        raise self.retry(exc=e)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def send_password_reset_email(self, user_id, subject_template_name, email_template_name, context,
+                              from_email=None, html_email_template_name=None):
+    """
+    Versão em tarefa de PasswordResetForm.send_mail (ver CustomPasswordResetForm):
+    o contexto chega sem o objeto 'user', que é recarregado aqui.
+    """
+    try:
+        user = CustomUser.objects.get(pk=user_id)
+        context = dict(context, user=user)
+        subject = ''.join(loader.render_to_string(subject_template_name, context).splitlines())
+        body = loader.render_to_string(email_template_name, context)
+        html_body = loader.render_to_string(html_email_template_name, context) if html_email_template_name else ''
+        enqueue_email(user.email, subject, body, html_body=html_body, kind='password_reset', from_email=from_email, immediate=True)
+    except CustomUser.DoesNotExist:
+        logger.error(f"Usuário {user_id} não encontrado em send_password_reset_email.")
+    except Exception as e:
+        logger.error(f"Erro ao preparar e-mail de redefinição de senha do usuário {user_id}: {e}", exc_info=True)
+        raise self.retry(exc=e)
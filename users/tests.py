@@ -1,3 +1,160 @@
-from django.test import TestCase
+import smtplib
+from datetime import timedelta
+from unittest import mock
+from django.core import mail
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from valuation.testing import FakeRedisMixin
+from .mail import enqueue_email
+from .models import CustomUser, OutboundEmail
+from .tasks import STALE_CLAIM_SECONDS, flush_email_outbox, send_activation_email
 
-# Create your tests here.
+Status = OutboundEmail.StatusChoices
+
+
+@override_settings(
+    EMAIL_OUTBOX_BATCH_SIZE=3, EMAIL_OUTBOX_FLUSH_INTERVAL=30, EMAIL_OUTBOX_MAX_ATTEMPTS=2,
+    DEFAULT_FROM_EMAIL='noreply@example.com',
+)
+class EmailOutboxTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        for target in ('delay', 'apply_async'):
+            patcher = mock.patch.object(flush_email_outbox, target)
+            setattr(self, target, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def enqueue(self, n, **kwargs):
+        return [enqueue_email(f'user{i}@example.com', f'Assunto {i}', 'Corpo', **kwargs) for i in range(n)]
+
+    def test_flushes_are_coalesced_per_interval(self):
+        self.enqueue(2)
+        self.apply_async.assert_called_once_with(countdown=30)
+        self.delay.assert_not_called()
+
+    def test_full_batch_or_immediate_flushes_at_once(self):
+        self.enqueue(3)
+        self.delay.assert_called_once_with()
+        self.delay.reset_mock()
+        OutboundEmail.objects.all().delete()
+        self.enqueue(1, immediate=True)
+        self.delay.assert_called_once_with()
+
+    def test_batch_is_sent_over_one_connection(self):
+        self.enqueue(2)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open') as open_connection:
+            self.assertEqual(flush_email_outbox(), 2)
+        open_connection.assert_called_once()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(OutboundEmail.objects.filter(status=Status.SENT, attempts=1).count(), 2)
+
+    def test_stale_claims_are_taken_again(self):
+        stale, fresh = self.enqueue(2)
+        OutboundEmail.objects.filter(pk=stale.pk).update(
+            status=Status.SENDING, claimed_at=timezone.now() - timedelta(seconds=STALE_CLAIM_SECONDS + 1))
+        OutboundEmail.objects.filter(pk=fresh.pk).update(status=Status.SENDING, claimed_at=timezone.now())
+        self.assertEqual(flush_email_outbox(), 1)
+        self.assertEqual([message.to for message in mail.outbox], [[stale.to_email]])
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.status, Status.SENDING)
+
+    def test_rejected_message_is_retried_then_failed(self):
+        rejected, accepted = self.enqueue(2)
+
+        def send_messages(backend, messages):
+            if messages[0].to == [rejected.to_email]:
+                raise smtplib.SMTPRecipientsRefused({rejected.to_email: (550, b'no such user')})
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', send_messages), \
+             self.assertLogs('users.tasks', 'WARNING'):
+            self.assertEqual(flush_email_outbox(), 1)
+            rejected.refresh_from_db()
+            self.assertEqual((rejected.status, rejected.attempts), (Status.PENDING, 1))
+            self.assertEqual(flush_email_outbox(), 0)
+        rejected.refresh_from_db()
+        self.assertEqual((rejected.status, rejected.attempts), (Status.FAILED, 2))
+        self.assertIn('no such user', rejected.last_error)
+
+    def test_connection_failure_returns_whole_batch(self):
+        self.enqueue(2)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=smtplib.SMTPConnectError(421, 'busy')), \
+             self.assertLogs('users.tasks', 'ERROR'), self.assertRaises(smtplib.SMTPConnectError):
+            flush_email_outbox()
+        self.assertEqual(OutboundEmail.objects.filter(status=Status.PENDING, attempts=0, claimed_at=None).count(), 2)
+
+    def test_disconnect_mid_batch_counts_current_and_returns_rest(self):
+        first, second, third = self.enqueue(3)
+        calls = []
+
+        def send_messages(backend, messages):
+            calls.append(messages[0].to)
+            if len(calls) == 2:
+                raise smtplib.SMTPServerDisconnected('caiu')
+            return len(messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', send_messages), \
+             self.assertLogs('users.tasks', 'WARNING'), self.assertRaises(smtplib.SMTPServerDisconnected):
+            flush_email_outbox()
+        statuses = {email.pk: (email.status, email.attempts) for email in OutboundEmail.objects.all()}
+        self.assertEqual(statuses, {first.pk: (Status.SENT, 1), second.pk: (Status.PENDING, 1), third.pk: (Status.PENDING, 0)})
+
+
+@override_settings(DEFAULT_FROM_EMAIL='noreply@example.com')
+class ActivationEmailTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(flush_email_outbox, 'delay')
+        self.flush = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_registration_defers_email_to_celery_after_commit(self):
+        data = {
+            'razao_social': 'ACME', 'cnpj': '12345678000199', 'email': 'acme@example.com',
+            'ddd': '11', 'telefone': '999999999', 'password1': 'S3nha-Forte-123', 'password2': 'S3nha-Forte-123',
+        }
+        with mock.patch.object(send_activation_email, 'delay') as task:
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.post(reverse('users:register'), data)
+                task.assert_not_called() # Só depois do commit
+            self.assertEqual(len(callbacks), 1)
+            callbacks[0]()
+        self.assertRedirects(response, reverse('users:registration_confirm_email'))
+        user = CustomUser.objects.get(cnpj='12345678000199')
+        task.assert_called_once_with(user.pk, 'http', 'testserver')
+        self.assertFalse(user.is_active)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_task_queues_activation_email_for_immediate_flush(self):
+        user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw', is_active=False)
+        send_activation_email(user.pk, 'https', 'valuation.example.com')
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.kind, email.to_email, email.status), ('activation', 'acme@example.com', Status.PENDING))
+        self.assertIn('https://valuation.example.com/', email.body)
+        self.flush.assert_called_once_with()
+
+    def test_task_skips_active_users(self):
+        user = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME', 'pw')
+        send_activation_email(user.pk, 'https', 'valuation.example.com')
+        self.assertFalse(OutboundEmail.objects.exists())
+
+
+class CustomUserAdminSearchTests(TestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_superuser('11111111000111', 'admin@example.com', 'Admin', 'pw')
+        self.acme = CustomUser.objects.create_user('12345678000199', 'acme@example.com', 'ACME Ltda', 'pw', telefone='12345678')
+        self.client.force_login(self.admin)
+
+    def search(self, term):
+        response = self.client.get(reverse('admin:users_customuser_changelist'), {'q': term})
+        return [user.pk for user in response.context['cl'].result_list]
+
+    def test_cnpj_search_is_prefix_only(self):
+        self.assertEqual(self.search('12.345.678'), [self.acme.pk])
+        self.assertEqual(self.search('5678000199'), []) # Meio do CNPJ (ou telefone): sem índice, sem busca
+
+    def test_email_prefix_and_razao_social(self):
+        self.assertEqual(self.search('acme@'), [self.acme.pk])
+        self.assertEqual(self.search('ltda'), [self.acme.pk])
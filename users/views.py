@@ -8,9 +8,8 @@ from django.contrib.auth.decorators import login_required
 from django.views.generic import TemplateView
 
 # Importações para envio de email e tokens
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
 from django.contrib.sites.shortcuts import get_current_site
+from django.db import transaction
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes, force_str
 from django.http import HttpResponse, HttpResponseRedirect # Adicionado HttpResponseRedirect
@@ -20,9 +19,11 @@ import logging # Adicionado logging
 from .forms import (
     CustomUserCreationForm,
     CustomAuthenticationForm,
+    CustomPasswordResetForm,
     UserProfileUpdateForm
 )
 from .models import CustomUser
+from .tasks import send_activation_email as send_activation_email_task
 from .tokens import account_activation_token
 
 # Configura o logger
@@ -30,37 +31,18 @@ logger = logging.getLogger(__name__)
 
 # --- FUNÇÃO PARA ENVIAR EMAIL DE ATIVAÇÃO ---
 def send_activation_email(request, user):
+    """
+    Agenda o e-mail de ativação numa tarefa Celery, disparada só depois do
+    commit do usuário (o worker precisa de o encontrar no banco). O pedido
+    de cadastro não espera pela renderização nem pelo SMTP.
+    """
     current_site = get_current_site(request)
-    subject = render_to_string('users/account_activation_subject.txt', {'user': user}).strip()
-    uid = urlsafe_base64_encode(force_bytes(user.pk))
-    token = account_activation_token.make_token(user)
-
-    context = {
-        'user': user,
-        # Determina o protocolo (http ou https)
-        'protocol': 'https' if request.is_secure() else 'http',
-        # Pega o domínio do site atual (ex: localhost:8000 ou seu domínio .onrender.com)
-        'domain': current_site.domain,
-        'uid': uid,
-        'token': token,
-    }
-
-    # Renderiza corpo em HTML e TXT
-    html_message = render_to_string('users/account_activation_email.html', context)
-    plain_message = render_to_string('users/account_activation_email.txt', context)
-
-    # Usa o email configurado em settings.py como remetente
-    from_email = settings.DEFAULT_FROM_EMAIL
-    to_email = user.email
-
-    try:
-        msg = EmailMultiAlternatives(subject, plain_message, from_email, [to_email])
-        msg.attach_alternative(html_message, "text/html")
-        msg.send()
-        logger.info(f"E-mail de ativação enviado para {to_email}")
-    except Exception as e:
-        logger.error(f"Erro ao enviar e-mail de ativação para {to_email}: {e}")
-        # Considerar como lidar com falha no envio (ex: logar erro crítico)
+    # Determina o protocolo (http ou https) e o domínio (ex: localhost:8000 ou seu domínio .onrender.com)
+    protocol = 'https' if request.is_secure() else 'http'
+    domain = current_site.domain
+    user_id = user.pk
+    transaction.on_commit(lambda: send_activation_email_task.delay(user_id, protocol, domain))
+    logger.info(f"E-mail de ativação agendado para o usuário {user_id}")
 
 
 # --- RegisterView (VERSÃO CORRETA COM ATIVAÇÃO POR EMAIL) ---
@@ -76,7 +58,7 @@ class RegisterView(CreateView):
         user.is_active = False # Define usuário como inativo até confirmação
         user.save()
 
-        # Envia o email de ativação
+        # Agenda o email de ativação (enviado pelo Celery após o commit)
         send_activation_email(self.request, user)
 
         # Retorna o redirecionamento para success_url
@@ -136,6 +118,7 @@ class CustomLoginView(auth_views.LoginView):
 
 # --- Views de Recuperação de Senha (Sem mudanças, apenas checando imports) ---
 class CustomPasswordResetView(auth_views.PasswordResetView):
+    form_class = CustomPasswordResetForm # Envio do e-mail via Celery
     template_name = 'users/password_reset_form.html'
     email_template_name = 'users/password_reset_email.html'
     subject_template_name = 'users/password_reset_subject.txt'
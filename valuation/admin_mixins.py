@@ -0,0 +1,33 @@
+# valuation/admin_mixins.py
+"""
+Configuração comum do admin para tabelas que crescem sem limite
+(relatórios, utilizadores): contagens limitadas, JSONs grandes fora da
+listagem e busca que aproveita os índices (prefixo/trigramas).
+"""
+import re
+from .paginators import EstimatedCountPaginator
+
+
+def digits_only(term):
+    """'12.345.678/0001-99' -> '12345678000199' (None se houver letras)."""
+    if re.fullmatch(r"[\d./\-\s()]+", term):
+        return re.sub(r"\D", "", term)
+    return None
+
+
+class LargeTableAdminMixin:
+    """
+    - paginator com contagem estimada acima de ADMIN_EXACT_COUNT_LIMIT;
+    - sem o segundo COUNT(*) do "mostrar todos" (show_full_result_count);
+    - list_deferred_fields: colunas pesadas (JSON) adiadas só na listagem.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_deferred_fields = ()
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        match = getattr(request, 'resolver_match', None)
+        if self.list_deferred_fields and match and match.url_name and match.url_name.endswith('_changelist'):
+            queryset = queryset.defer(*self.list_deferred_fields)
+        return queryset
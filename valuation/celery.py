@@ -1,7 +1,9 @@
 # valuation/celery.py
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 from django.conf import settings
+from . import tracing # noqa: F401 (liga os sinais de rastreio do Celery e do banco)
 
 # Define o módulo de settings do Django para o 'celery'
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'valuation.settings')
@@ -12,4 +14,26 @@ app = Celery('valuation')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Autodiscover: Procura por tarefas em arquivos 'tasks.py' em cada app
-app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
\ No newline at end of file
+app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+def consumes_queue(name: str) -> bool:
+    """Este worker consome a fila? (-Q do comando; sem -Q consome todas.)"""
+    return name in app.amqp.queues.consume_from
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Executado uma vez em cada processo filho do worker (após o fork do prefork)."""
+    # Cria o cliente Gemini do processo antes da primeira tarefa (só nos workers da fila gemini)
+    if consumes_queue('gemini'):
+        from chatbot.gemini_client import warm_up
+        warm_up()
+        if settings.GEMINI_FALLBACK_MODEL_NAME:
+            warm_up(settings.GEMINI_FALLBACK_MODEL_NAME) # Modelo de reserva do hedge (chatbot/llm_providers.py)
+    # Templates dos e-mails já compilados para a primeira tarefa
+    if settings.TEMPLATE_CACHE:
+        from .template_cache import warm_templates
+        from users.mail import warm_email_templates
+        warm_templates()
+        warm_email_templates()
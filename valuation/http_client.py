@@ -0,0 +1,110 @@
+# valuation/http_client.py
+"""
+Camada HTTP compartilhada para integrações externas (Gamma e futuras).
+
+Cada integração recebe uma requests.Session nomeada, criada uma vez por
+processo, com pool de conexões keep-alive, timeout padrão e retentativa
+com backoff para erros transitórios. Timeouts e política de retentativa
+ficam configurados aqui (e em settings.HTTP_*), não espalhados pelas tarefas.
+"""
+import logging
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Status que indicam falha transitória do servidor (vale a pena tentar de novo)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_lock = threading.Lock()
+_sessions = {}
+_sessions_pid = None
+
+
+class TimeoutSession(requests.Session):
+    """Session que aplica um timeout padrão quando a chamada não informa um."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.default_timeout)
+        return super().request(method, url, **kwargs)
+
+
+def _build_session(retries, pool_maxsize):
+    session = TimeoutSession(timeout=(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=settings.HTTP_RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUS_CODES,
+        # POST não é idempotente: só é repetido em falhas de conexão (pedido não chegou ao servidor)
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,  # devolve a última resposta; quem chama usa raise_for_status()
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(name, retries=None, pool_maxsize=None):
+    """
+    Retorna a Session nomeada deste processo (ex: 'gamma'), criando-a na
+    primeira chamada. Após um fork (PID diferente) as sessões são recriadas,
+    pois sockets herdados do processo pai não podem ser partilhados.
+    """
+    global _sessions_pid
+    with _lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(name)
+        if session is None:
+            session = _build_session(
+                retries=settings.HTTP_MAX_RETRIES if retries is None else retries,
+                pool_maxsize=settings.HTTP_POOL_MAXSIZE if pool_maxsize is None else pool_maxsize,
+            )
+            _sessions[name] = session
+        return session
+
+
+def close_sessions():
+    """Fecha todas as sessões deste processo (ex: no encerramento do worker)."""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def connection_stats():
+    """
+    Estatísticas de reaproveitamento de conexões por sessão deste processo:
+    pedidos feitos, conexões abertas e quantos pedidos reutilizaram conexão.
+    """
+    stats = {}
+    with _lock:
+        for name, session in _sessions.items():
+            total_requests = 0
+            total_connections = 0
+            for adapter in {id(a): a for a in session.adapters.values()}.values():
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    total_requests += pool.num_requests
+                    total_connections += pool.num_connections
+            stats[name] = {
+                "requests": total_requests,
+                "connections": total_connections,
+                "reused": max(0, total_requests - total_connections),
+            }
+    return stats
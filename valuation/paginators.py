@@ -0,0 +1,57 @@
+# valuation/paginators.py
+"""
+Paginador para tabelas grandes no admin.
+
+O Paginator padrão faz SELECT COUNT(*) sobre a listagem inteira em cada
+página, o que no Postgres percorre a tabela toda. EstimatedCountPaginator
+conta exatamente só até settings.ADMIN_EXACT_COUNT_LIMIT linhas
+(COUNT sobre um subselect com LIMIT); acima disso usa a estimativa do
+planeador do Postgres, que é instantânea.
+"""
+import json
+import logging
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.utils.functional import cached_property
+
+logger = logging.getLogger(__name__)
+
+
+def estimated_count(queryset):
+    """
+    Estimativa de linhas do Postgres: reltuples para a tabela sem filtros,
+    'Plan Rows' do EXPLAIN para listagens filtradas. None noutros bancos.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        if not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            # -1 = tabela ainda não analisada (VACUUM/ANALYZE)
+            return int(row[0]) if row and row[0] >= 0 else None
+        plan = json.loads(queryset.order_by().explain(format='json'))
+        return int(plan[0]['Plan']['Plan Rows'])
+    except (DatabaseError, ValueError, KeyError, IndexError, TypeError) as e:
+        logger.warning(f"Não foi possível estimar o total de {queryset.model.__name__}: {e}")
+        return None
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        limit = settings.ADMIN_EXACT_COUNT_LIMIT
+        queryset = self.object_list
+        if not hasattr(queryset, 'query'):
+            return super().count
+        # COUNT(*) de um subselect com LIMIT: para no limite em vez de varrer tudo
+        bounded = queryset.order_by().values('pk')[:limit + 1].count()
+        if bounded <= limit:
+            return bounded
+        estimate = estimated_count(queryset)
+        if estimate is None:
+            return super().count
+        return max(estimate, bounded)
@@ -0,0 +1,27 @@
+# valuation/redis_client.py
+"""
+Cliente Redis compartilhado pelo projeto (cache da IA, contadores, etc.).
+
+Uma conexão (pool) por processo: após um fork do Celery (prefork) o PID
+muda e o pool herdado do processo pai é descartado e recriado.
+"""
+import os
+import redis
+from django.conf import settings
+
+_client = None
+_client_pid = None
+
+
+def get_redis():
+    """Retorna o cliente Redis deste processo, criando-o na primeira chamada."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = redis.Redis.from_url(
+            settings.REDIS_URL,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            decode_responses=True,
+        )
+        _client_pid = os.getpid()
+    return _client
@@ -3,16 +3,27 @@ Django settings for valuation project.
 """
 
 import os
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 import dj_database_url
+from kombu import Queue
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 load_dotenv(BASE_DIR / '.env')
 
+# `python manage.py test` roda sem serviços externos: SQLite local, cache em
+# memória e chave de teste quando as variáveis não estão definidas. O Redis é
+# substituído pelo fakeredis nos testes (valuation/testing.py)
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 GAMMA_API_KEY = os.environ.get('GAMMA_API_KEY')
-SECRET_KEY = os.environ.get('SECRET_KEY')
+# Pode apontar para um servidor local substituto em testes
+GAMMA_API_URL = os.environ.get('GAMMA_API_URL', 'https://public-api.gamma.app/v0.2')
+# Vazio = API pública do Gemini (gRPC); um endereço (ex: http://127.0.0.1:8701) usa REST contra ele
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT', '')
+SECRET_KEY = os.environ.get('SECRET_KEY') or ('test-secret-key' if TESTING else None)
 DEBUG = os.environ.get('DEBUG', 'False') == 'True'
 ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', 'localhost 127.0.0.1').split(' ')
 CSRF_TRUSTED_ORIGINS = os.environ.get('DJANGO_CSRF_TRUSTED_ORIGINS', 'http://localhost:8000').split(' ')
@@ -46,11 +57,18 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'valuation.urls' # Verifique nome da pasta (deve ser 'valuation' ou 'avaliação')
 
+# Templates compilados ficam em memória (loader em cache). Ligado por omissão
+# fora do DEBUG; em desenvolvimento cada pedido relê os ficheiros do disco.
+TEMPLATE_CACHE = os.environ.get('TEMPLATE_CACHE', str(not DEBUG)) == 'True'
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -58,13 +76,14 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            'loaders': [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)] if TEMPLATE_CACHE else TEMPLATE_LOADERS,
         },
     },
 ]
 
 WSGI_APPLICATION = 'valuation.wsgi.application' # Verifique nome da pasta
 
-DATABASE_URL = os.environ.get('DATABASE_URL')
+DATABASE_URL = os.environ.get('DATABASE_URL') or (f"sqlite:///{BASE_DIR / 'test_db.sqlite3'}" if TESTING else None)
 DATABASES = {
     'default': dj_database_url.config(default=DATABASE_URL, conn_max_age=600) if DATABASE_URL else {}
 }
@@ -113,15 +132,174 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Sao_Paulo'
 
+# --- Filas por etapa do pipeline ---
+# gemini: processamento do valuation (sensível à latência do utilizador)
+# gamma: início e polling das apresentações (lento, muito tempo em I/O)
+# email: e-mails (baratos); maintenance: tudo o que não tem rota (padrão)
+# Um worker sem -Q consome todas as filas abaixo; no docker-compose cada
+# fila tem o seu próprio worker, por isso uma fila cheia de polls do Gamma
+# não atrasa um valuation novo.
+CELERY_TASK_QUEUES = (
+    Queue('gemini'),
+    Queue('gamma'),
+    Queue('email'),
+    Queue('maintenance'),
+)
+CELERY_TASK_DEFAULT_QUEUE = 'maintenance'
+CELERY_TASK_ROUTES = {
+    'chatbot.tasks.process_valuation_request': {'queue': 'gemini'},
+    'chatbot.tasks.generate_gamma_presentation': {'queue': 'gamma'},
+    'chatbot.tasks.poll_gamma_generation': {'queue': 'gamma'},
+    'chatbot.tasks.send_gamma_report_email': {'queue': 'email'},
+    'users.tasks.*': {'queue': 'email'},
+}
+# Confirma a mensagem só depois de a tarefa terminar: se o worker morrer, outra instância a executa
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+# Cada processo reserva uma tarefa de cada vez (tarefas longas não ficam presas atrás de outras)
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.environ.get('CELERY_WORKER_PREFETCH_MULTIPLIER', '1'))
+# Nenhuma view lê resultados das tarefas: não escreve no result backend
+CELERY_TASK_IGNORE_RESULT = True
+# Nenhuma tarefa prende um worker indefinidamente: SoftTimeLimitExceeded no soft,
+# o processo filho é terminado no hard (tarefas podem definir limites próprios)
+CELERY_TASK_SOFT_TIME_LIMIT = int(os.environ.get('CELERY_TASK_SOFT_TIME_LIMIT', '120'))
+CELERY_TASK_TIME_LIMIT = int(os.environ.get('CELERY_TASK_TIME_LIMIT', '150'))
+# Tempo até o Redis reentregar uma tarefa não confirmada (acks_late). Tem de
+# ser maior que a tarefa mais longa somada ao maior countdown/ETA agendado.
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'visibility_timeout': int(os.environ.get('CELERY_VISIBILITY_TIMEOUT', '3600')),
+}
+
+# Rastreio de ponta a ponta (valuation/tracing.py): view -> tarefas Celery -> banco/Gemini/Gamma.
+# O exportador é o caminho de uma classe com export(dict); o padrão grava JSONL local.
+# Desligado por omissão: o JSONL é uma escrita síncrona por span num ficheiro sem
+# rotação. Para investigar, ligue com amostragem baixa (e spans de SQL só se preciso).
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'False') == 'True'
+TRACING_SAMPLE_RATE = float(os.environ.get('TRACING_SAMPLE_RATE', '0.05'))
+TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER', 'valuation.tracing.JSONLExporter')
+TRACING_JSONL_PATH = os.environ.get('TRACING_JSONL_PATH', str(BASE_DIR / 'traces' / 'traces.jsonl'))
+TRACING_DB_QUERIES = os.environ.get('TRACING_DB_QUERIES', 'False') == 'True'
+
+# Redis compartilhado (cache da IA, contadores). No Render vem em REDIS_URL.
+REDIS_URL = os.environ.get('REDIS_URL', CELERY_BROKER_URL)
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '2'))
+
+# Cache do Django no mesmo Redis (prefixo próprio). Usado pelo cache da página
+# de detalhe de relatórios finalizados (reports/page_cache.py)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'valuation',
+        'OPTIONS': {
+            'socket_timeout': REDIS_SOCKET_TIMEOUT,
+            'socket_connect_timeout': REDIS_SOCKET_TIMEOUT,
+        },
+    }
+}
+if TESTING:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+REPORT_PAGE_CACHE_ENABLED = os.environ.get('REPORT_PAGE_CACHE_ENABLED', 'True') == 'True'
+REPORT_PAGE_CACHE_TTL_SECONDS = int(os.environ.get('REPORT_PAGE_CACHE_TTL_SECONDS', str(24 * 3600)))
+
+# Camada HTTP compartilhada para integrações externas (valuation/http_client.py)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '2'))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', '0.5'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+
+# Lê a resposta do Gemini em streaming, gravando cada campo assim que fica completo
+GEMINI_STREAMING = os.environ.get('GEMINI_STREAMING', 'True') == 'True'
+
+# Limitador global do Gemini (chatbot/gemini_limiter.py), partilhado por todos os workers
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', '4'))
+GEMINI_TOKENS_PER_MINUTE = int(os.environ.get('GEMINI_TOKENS_PER_MINUTE', '250000'))
+GEMINI_OUTPUT_TOKENS_ESTIMATE = int(os.environ.get('GEMINI_OUTPUT_TOKENS_ESTIMATE', '1500'))
+GEMINI_SLOT_LEASE_SECONDS = int(os.environ.get('GEMINI_SLOT_LEASE_SECONDS', '180'))
+GEMINI_LIMITER_MAX_WAIT = float(os.environ.get('GEMINI_LIMITER_MAX_WAIT', '20'))
+GEMINI_THROTTLE_COOLDOWN_SECONDS = int(os.environ.get('GEMINI_THROTTLE_COOLDOWN_SECONDS', '10'))
+GEMINI_DEFER_MAX_RETRIES = int(os.environ.get('GEMINI_DEFER_MAX_RETRIES', '10'))
+GEMINI_DEFER_JITTER_SECONDS = int(os.environ.get('GEMINI_DEFER_JITTER_SECONDS', '5'))
+
+# Context cache das instruções fixas do agente (chatbot/context_cache.py). A API
+# exige um mínimo de tokens por cache; abaixo dele usa-se só system_instruction.
+# Desligado por omissão: a SYSTEM_INSTRUCTION atual (~500 tokens) fica abaixo do
+# mínimo, por isso só vale ligar quando as instruções fixas crescerem.
+GEMINI_CONTEXT_CACHE = os.environ.get('GEMINI_CONTEXT_CACHE', 'False') == 'True'
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get('GEMINI_CONTEXT_CACHE_TTL_SECONDS', '3600'))
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('GEMINI_CONTEXT_CACHE_MIN_TOKENS', '1024'))
+
+# Provedores do agente (chatbot/llm_providers.py): modelo rápido de reserva, hedge pelo p95
+# observado e SLO (passado o SLO, o relatório usa a narrativa padrão do motor)
+GEMINI_FALLBACK_MODEL_NAME = os.environ.get('GEMINI_FALLBACK_MODEL_NAME', 'gemini-2.5-flash-lite')
+LLM_SLO_SECONDS = float(os.environ.get('LLM_SLO_SECONDS', '30'))
+LLM_HEDGING = os.environ.get('LLM_HEDGING', 'True') == 'True'
+LLM_HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get('LLM_HEDGE_DEFAULT_DELAY_SECONDS', '12'))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('LLM_HEDGE_MIN_DELAY_SECONDS', '2'))
+LLM_LATENCY_SAMPLES = int(os.environ.get('LLM_LATENCY_SAMPLES', '200'))
+LLM_LATENCY_MIN_SAMPLES = int(os.environ.get('LLM_LATENCY_MIN_SAMPLES', '20'))
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.environ.get('LLM_REQUEST_TIMEOUT_SECONDS', '60'))
+LLM_MAX_PARALLEL_REQUESTS = int(os.environ.get('LLM_MAX_PARALLEL_REQUESTS', '8'))
+
+# Prazo global de cada relatório (chatbot/deadlines.py) e teto das etapas sem teto próprio
+# (o agente usa LLM_SLO_SECONDS; a geração Gamma, GAMMA_TIMEOUT_SECONDS em chatbot/tasks.py)
+REPORT_DEADLINE_SECONDS = int(os.environ.get('REPORT_DEADLINE_SECONDS', '720'))
+GAMMA_START_BUDGET_SECONDS = float(os.environ.get('GAMMA_START_BUDGET_SECONDS', '45'))
+EMAIL_BUDGET_SECONDS = float(os.environ.get('EMAIL_BUDGET_SECONDS', '60'))
+
+# Tempo médio de processamento de um relatório (previsão de conclusão no endpoint de status)
+REPORT_AVG_PROCESSING_SECONDS = int(os.environ.get('REPORT_AVG_PROCESSING_SECONDS', '30'))
+
+# Status ao vivo no dashboard. Desligado: polling curto com ETag (funciona com
+# workers sync). Ligado: SSE/long-poll, que seguram a conexão aberta e exigem
+# workers assíncronos no Gunicorn (entrypoint.sh passa a usar gevent)
+STATUS_REALTIME_ENABLED = os.environ.get('STATUS_REALTIME_ENABLED', 'False') == 'True'
+STATUS_POLL_INTERVAL_SECONDS = int(os.environ.get('STATUS_POLL_INTERVAL_SECONDS', '5'))
+
+# Admin: acima deste número de linhas a listagem mostra um total estimado (valuation/paginators.py)
+ADMIN_EXACT_COUNT_LIMIT = int(os.environ.get('ADMIN_EXACT_COUNT_LIMIT', '10000'))
+
+# Limite de taxa por utilizador (token bucket em chatbot/quota.py) nas APIs de cálculo
+RATE_LIMIT_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_MINUTE', '6'))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', '3'))
+
+# Relatórios por página no histórico (paginação por cursor)
+REPORT_HISTORY_PAGE_SIZE = int(os.environ.get('REPORT_HISTORY_PAGE_SIZE', '20'))
+
+# Cache de respostas do agente Gemini (chatbot/cache.py)
+AGENT_CACHE_ENABLED = os.environ.get('AGENT_CACHE_ENABLED', 'True') == 'True'
+AGENT_CACHE_TTL_SECONDS = int(os.environ.get('AGENT_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+AGENT_CACHE_MAX_ENTRIES = int(os.environ.get('AGENT_CACHE_MAX_ENTRIES', '5000'))
+
+# Pedidos de cálculo repetidos (chatbot/idempotency.py): a mesma Idempotency-Key
+# devolve o mesmo relatório; inputs idênticos dentro da janela também (0 = desliga)
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', str(24 * 3600)))
+VALUATION_DEDUPE_WINDOW_SECONDS = int(os.environ.get('VALUATION_DEDUPE_WINDOW_SECONDS', '300'))
+# Single-flight do agente (chatbot/single_flight.py): quanto um worker espera pela
+# chamada idêntica de outro (0 = desliga) e TTL da trava (maior que uma chamada ao Gemini).
+# A espera é ainda limitada pela tarefa: soft_time_limit menos a própria chamada
+# (GEMINI_LIMITER_MAX_WAIT + LLM_SLO_SECONDS) e o prazo do relatório
+AGENT_SINGLE_FLIGHT_WAIT_SECONDS = int(os.environ.get('AGENT_SINGLE_FLIGHT_WAIT_SECONDS', '90'))
+AGENT_SINGLE_FLIGHT_LOCK_SECONDS = int(os.environ.get('AGENT_SINGLE_FLIGHT_LOCK_SECONDS', '180'))
+
+# Fila de saída de e-mails (users/mail.py): mensagens enviadas em lotes numa só conexão SMTP
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', '50'))
+EMAIL_OUTBOX_FLUSH_INTERVAL = int(os.environ.get('EMAIL_OUTBOX_FLUSH_INTERVAL', '30'))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', '5'))
+
 if DEBUG:
     # Em desenvolvimento, use o backend de e-mail do console
-    EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+    EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
 else:
     # Em produção, use o backend de e-mail SMTP
-    EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-    EMAIL_HOST = 'smtp.gmail.com'
-    EMAIL_PORT = 587
-    EMAIL_USE_TLS = True
+    EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+    # Host/porta configuráveis para apontar para um servidor SMTP local em testes
+    # (ex: python -m aiosmtpd -n -l localhost:1025 com EMAIL_USE_TLS=False)
+    EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.gmail.com')
+    EMAIL_PORT = int(os.environ.get('EMAIL_PORT', '587'))
+    EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
+    EMAIL_TIMEOUT = int(os.environ.get('EMAIL_TIMEOUT', '30'))
     EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
     EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
     DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', EMAIL_HOST_USER)
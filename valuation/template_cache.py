@@ -0,0 +1,46 @@
+# valuation/template_cache.py
+"""
+Aquecimento do cache de templates.
+
+Com o loader em cache (settings.TEMPLATE_CACHE), cada template é lido e
+compilado na primeira vez que é usado em cada processo. warm_templates()
+faz essa compilação no arranque (gunicorn e workers Celery), para que o
+primeiro pedido de cada página/e-mail não pague esse custo.
+"""
+import logging
+import time
+from pathlib import Path
+from django.template import TemplateSyntaxError, engines
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_SUFFIXES = ('.html', '.txt')
+
+
+def _template_names(engine):
+    """Nomes dos templates do projeto (settings.TEMPLATES DIRS). Os do admin compilam no primeiro uso."""
+    names = set()
+    for directory in engine.dirs:
+        root = Path(directory)
+        if not root.is_dir():
+            continue
+        for path in root.rglob('*'):
+            if path.suffix in TEMPLATE_SUFFIXES and path.is_file():
+                names.add(path.relative_to(root).as_posix())
+    return sorted(names)
+
+
+def warm_templates() -> int:
+    """Compila todos os templates do projeto para o cache deste processo. Retorna quantos."""
+    backend = engines['django']
+    started = time.monotonic()
+    loaded = 0
+    for name in _template_names(backend.engine):
+        try:
+            backend.get_template(name)
+            loaded += 1
+        except TemplateSyntaxError as e:
+            # Não impede o arranque; o erro aparece quando a página for pedida
+            logger.debug(f"Template {name} não pré-compilado: {e}")
+    logger.info(f"{loaded} template(s) pré-compilado(s) em {(time.monotonic() - started) * 1000:.0f} ms")
+    return loaded
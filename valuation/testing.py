@@ -0,0 +1,31 @@
+# valuation/testing.py
+"""
+Apoio aos testes do projeto.
+
+Rodar a suíte: `pip install -r requirements-dev.txt` e `python manage.py test`.
+Sem DATABASE_URL/SECRET_KEY os settings usam SQLite e uma chave de teste
+(ver TESTING em valuation/settings.py); nenhum serviço externo é preciso.
+
+FakeRedisMixin troca o cliente de valuation/redis_client.py por um fakeredis
+(com suporte a Lua) limpo em cada teste, para exercitar os scripts de cota,
+idempotência, limitador etc. sem um Redis real.
+"""
+import os
+import fakeredis
+from valuation import redis_client
+
+
+class FakeRedisMixin:
+    """Mixin para TestCase: self.redis é o fakeredis devolvido por get_redis()."""
+
+    def setUp(self):
+        super().setUp()
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        self._saved_client = (redis_client._client, redis_client._client_pid)
+        redis_client._client = self.redis
+        redis_client._client_pid = os.getpid()
+
+    def tearDown(self):
+        redis_client._client, redis_client._client_pid = self._saved_client
+        self.redis.flushall()
+        super().tearDown()
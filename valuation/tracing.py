@@ -0,0 +1,374 @@
+# valuation/tracing.py
+"""
+Rastreio (tracing) de ponta a ponta de um relatório: pedido HTTP -> tarefas
+Celery (incluindo retries e tarefas encadeadas) -> consultas ao banco e
+chamadas ao Gemini e ao Gamma.
+
+- Contexto no formato W3C traceparent (00-<trace_id>-<span_id>-<flags>),
+  guardado numa contextvar (vale para threads e para o processo atual).
+- traced_view: abre o span raiz de uma view (continua um traceparent
+  recebido no cabeçalho, se houver) e devolve X-Trace-Id na resposta. Em
+  respostas em streaming (SSE) o span só fecha quando o corpo termina.
+- Celery: before_task_publish escreve o traceparent do span atual nos
+  cabeçalhos de TODA mensagem publicada (.delay(), apply_async(),
+  self.retry()); task_prerun/task_postrun abrem e fecham o span da tarefa
+  como filho desse contexto.
+- Banco: um execute_wrapper em cada conexão cria um span por query, só
+  quando há um rastreio ativo.
+- start_span(): spans manuais (Gemini, Gamma, ...).
+
+Os spans terminados vão para o exportador de settings.TRACING_EXPORTER
+(caminho de uma classe com export(dict)); o padrão, JSONLExporter, escreve
+uma linha JSON por span em settings.TRACING_JSONL_PATH.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from celery.signals import before_task_publish, task_postrun, task_prerun, task_retry, task_failure
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_HEADER = "traceparent"
+MAX_STATEMENT_LENGTH = 500
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    """Uma operação com início e fim dentro de um rastreio."""
+
+    def __init__(self, name, trace_id, parent_id=None, kind="internal", sampled=True, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.error = None
+        self.start_time = time.time()
+        self._start_monotonic = time.monotonic()
+        self.duration_ms = None
+        self.end_deferred = False # Resposta em streaming: quem fecha é _StreamSpan
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if self.duration_ms is not None or self.end_deferred:
+            return
+        self.duration_ms = round((time.monotonic() - self._start_monotonic) * 1000, 3)
+        if self.sampled:
+            _export(self.to_dict())
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start_time,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+            "pid": os.getpid(),
+        }
+
+
+def parse_traceparent(value):
+    """(trace_id, span_id, sampled) de um cabeçalho traceparent, ou None se inválido."""
+    try:
+        version, trace_id, span_id, flags = (value or "").strip().split("-")
+        int(trace_id, 16), int(span_id, 16), int(flags, 16)
+    except (ValueError, AttributeError):
+        return None
+    if version != "00" or len(trace_id) != 32 or len(span_id) != 16 or trace_id == "0" * 32:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def annotate(**attributes):
+    """Acrescenta atributos ao span atual (sem efeito fora de um rastreio)."""
+    span = _current_span.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+def current_trace_id():
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+def _new_span(name, kind, traceparent=None, attributes=None):
+    """Filho do traceparent dado, senão do span atual, senão raiz de um novo rastreio (com amostragem)."""
+    remote = parse_traceparent(traceparent) if traceparent else None
+    parent = _current_span.get()
+    if remote:
+        trace_id, parent_id, sampled = remote
+    elif parent:
+        trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+    else:
+        trace_id, parent_id = os.urandom(16).hex(), None
+        sampled = random.random() < settings.TRACING_SAMPLE_RATE
+    return Span(name, trace_id, parent_id, kind, sampled, attributes)
+
+
+@contextmanager
+def start_span(name, kind="internal", traceparent=None, **attributes):
+    """
+    Abre um span filho do atual (ou raiz) durante o bloco. Exceções marcam o
+    span com erro e propagam normalmente.
+
+        with start_span("gamma.start_generation", kind="client") as span:
+            response = ...
+            span.set_attribute("http.status_code", response.status_code)
+    """
+    if not settings.TRACING_ENABLED:
+        yield _NOOP_SPAN
+        return
+    span = _new_span(name, kind, traceparent, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+class _NoopSpan:
+    """Span usado com o rastreio desligado (aceita e ignora atributos)."""
+    trace_id = None
+    span_id = None
+    traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+# --- Exportadores ---
+
+class JSONLExporter:
+    """Uma linha JSON por span, num ficheiro local (um descritor por processo)."""
+
+    def __init__(self, path=None):
+        self.path = str(path or settings.TRACING_JSONL_PATH)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def export(self, span: dict):
+        line = json.dumps(span, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+                self._pid = os.getpid()
+            # Uma escrita por linha em modo append: processos diferentes não intercalam linhas
+            self._file.write(line)
+            self._file.flush()
+
+
+class LoggingExporter:
+    """Envia os spans para o log (logger valuation.tracing, nível INFO)."""
+
+    def export(self, span: dict):
+        logger.info(json.dumps(span, ensure_ascii=False, default=str))
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = import_string(settings.TRACING_EXPORTER)()
+    return _exporter
+
+
+def _export(span_data):
+    try:
+        get_exporter().export(span_data)
+    except Exception as e:
+        # O rastreio nunca interrompe o pedido nem a tarefa
+        logger.warning(f"Falha ao exportar span '{span_data.get('name')}': {e}")
+
+
+# --- Views ---
+
+class _StreamSpan:
+    """
+    Corpo em streaming de uma view: repassa os pedaços e fecha o span quando
+    o corpo termina, falha ou a resposta é fechada (ex: o cliente saiu).
+    """
+
+    def __init__(self, span, content):
+        self.span = span
+        self.content = content
+
+    def __iter__(self):
+        try:
+            yield from self.content
+        except GeneratorExit:
+            self.span.set_attribute("http.client_disconnected", True)
+            raise
+        except BaseException as e:
+            self.span.set_error(e)
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        # Chamado também pelo Django em response.close()
+        self.span.end_deferred = False
+        self.span.end()
+
+
+def traced_view(name):
+    """Decorator: span raiz (kind=server) para a view, com X-Trace-Id na resposta."""
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            with start_span(
+                name,
+                kind="server",
+                traceparent=request.headers.get(TRACEPARENT_HEADER),
+                **{"http.method": request.method, "http.path": request.path},
+            ) as span:
+                if getattr(request, "user", None) is not None and request.user.is_authenticated:
+                    span.set_attribute("user_id", request.user.pk)
+                response = view_func(request, *args, **kwargs)
+                span.set_attribute("http.status_code", response.status_code)
+                if response.status_code >= 500:
+                    span.set_error(f"HTTP {response.status_code}")
+                if span.trace_id:
+                    response["X-Trace-Id"] = span.trace_id
+                    if response.streaming:
+                        # Sem isto o span mediria só a criação da resposta (~0ms)
+                        span.end_deferred = True
+                        span.set_attribute("http.streaming", True)
+                        response.streaming_content = _StreamSpan(span, response.streaming_content)
+                return response
+        return wrapper
+    return decorator
+
+
+# --- Celery ---
+
+_task_spans = {} # task_id -> (span, token da contextvar)
+
+
+@before_task_publish.connect
+def inject_trace_headers(headers=None, **kwargs):
+    """Toda mensagem publicada leva o traceparent do span atual (inclusive self.retry())."""
+    span = _current_span.get()
+    if settings.TRACING_ENABLED and span is not None and headers is not None:
+        headers[TRACEPARENT_HEADER] = span.traceparent
+
+
+def _request_traceparent(request):
+    # No worker os cabeçalhos da mensagem viram atributos do request; em apply() ficam em request.headers
+    return getattr(request, TRACEPARENT_HEADER, None) or (getattr(request, "headers", None) or {}).get(TRACEPARENT_HEADER)
+
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, args=None, **kwargs):
+    if not settings.TRACING_ENABLED or task is None:
+        return
+    request = task.request
+    span = _new_span(
+        f"celery.task {task.name}",
+        "consumer",
+        traceparent=_request_traceparent(request),
+        attributes={
+            "celery.task_id": task_id,
+            "celery.retries": request.retries or 0,
+            "celery.queue": (request.delivery_info or {}).get("routing_key"),
+            "celery.args": repr(args)[:200],
+        },
+    )
+    _task_spans[task_id] = (span, _current_span.set(span))
+
+
+@task_retry.connect
+def mark_task_retry(request=None, reason=None, **kwargs):
+    entry = _task_spans.get(getattr(request, "id", None))
+    if entry:
+        entry[0].set_attribute("celery.retry_reason", str(reason)[:200])
+
+
+@task_failure.connect
+def mark_task_failure(task_id=None, exception=None, **kwargs):
+    entry = _task_spans.get(task_id)
+    if entry:
+        entry[0].set_error(exception)
+
+
+@task_postrun.connect
+def end_task_span(task_id=None, state=None, **kwargs):
+    entry = _task_spans.pop(task_id, None)
+    if entry is None:
+        return
+    span, token = entry
+    span.set_attribute("celery.state", state)
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        _current_span.set(None) # Contexto diferente do prerun (não deve acontecer no prefork)
+    span.end()
+
+
+# --- Banco de dados ---
+
+def _db_span_wrapper(execute, sql, params, many, context):
+    """Um span por query, só dentro de um rastreio ativo."""
+    if not settings.TRACING_DB_QUERIES or _current_span.get() is None:
+        return execute(sql, params, many, context)
+    with start_span("db.query", kind="client", **{
+        "db.vendor": context["connection"].vendor,
+        "db.statement": sql[:MAX_STATEMENT_LENGTH],
+        "db.many": many,
+    }):
+        return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_db_tracing(connection=None, **kwargs):
+    if connection is not None and _db_span_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_span_wrapper)
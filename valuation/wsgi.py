@@ -6,4 +6,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'valuation.settings')
 
 application = get_wsgi_application()
+
+# Pré-compila os templates antes do primeiro pedido (loader em cache em produção)
+from django.conf import settings
+if settings.TEMPLATE_CACHE:
+    from .template_cache import warm_templates
+    warm_templates()
 # NENHUMA linha do WhiteNoise aqui
\ No newline at end of file